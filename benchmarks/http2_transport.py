@@ -0,0 +1,169 @@
+"""
+Compares many concurrent entity fetches over the HTTP/1.1 requests session and over the HTTP/2 transport
+(multiplexed connections), against local stand-in servers serving the same payload: a threaded HTTP/1.1
+server and a cleartext HTTP/2 (prior knowledge) server. Prints the throughput and the number of connections
+each transport opened.
+
+needs: pip install httpx[http2]
+
+usage: python benchmarks/http2_transport.py [--requests 2000] [--concurrency 200] [--rows 50]
+"""
+
+import argparse
+import json
+import os
+import socket
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import finbox_bankconnect as fbc
+import finbox_bankconnect.connector as connector
+
+ENTITY_ID = "5b0f1a1e-3c1e-4c55-9a0e-2b7f6d1c9e21"
+
+def payload(rows):
+    transactions = [{"date": "2019-10-01 00:00:00", "amount": 100.0, "transaction_note": "NOTE {}".format(i)} for i in range(rows)]
+    return json.dumps({
+        "progress": [{"statement_id": "s1", "status": "completed"}],
+        "accounts": [{"account_id": "a"}],
+        "fraud": {"fraud_type": []},
+        "transactions": transactions
+    }).encode('utf-8')
+
+class HTTP1Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, body):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), HTTP1Handler)
+        self.body = body
+        self.connections = 0
+
+    def get_request(self):
+        self.connections += 1
+        return HTTPServer.get_request(self)
+
+class HTTP1Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1' # keep-alive
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(self.server.body)))
+        self.end_headers()
+        self.wfile.write(self.server.body)
+
+    def log_message(self, *args):
+        pass
+
+class HTTP2Server:
+    """Minimal cleartext HTTP/2 server (prior knowledge) answering every request with the body"""
+
+    def __init__(self, body):
+        self.body = body
+        self.connections = 0
+        self.socket = socket.socket()
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind(('127.0.0.1', 0))
+        self.socket.listen(128)
+        self.server_address = self.socket.getsockname()
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def serve_forever(self):
+        while True:
+            try:
+                client, address = self.socket.accept()
+            except OSError:
+                return
+            self.connections += 1
+            thread = threading.Thread(target=self.handle, args=(client,))
+            thread.daemon = True
+            thread.start()
+
+    def handle(self, client):
+        import h2.config
+        import h2.connection
+        import h2.events
+        import h2.exceptions
+        connection = h2.connection.H2Connection(config=h2.config.H2Configuration(client_side=False))
+        connection.initiate_connection()
+        client.sendall(connection.data_to_send())
+        pending = dict() # stream id -> remaining body
+        try:
+            while True:
+                data = client.recv(65535)
+                if not data:
+                    return
+                for event in connection.receive_data(data):
+                    if isinstance(event, h2.events.RequestReceived):
+                        connection.send_headers(event.stream_id, [
+                            (':status', '200'), ('content-type', 'application/json'), ('content-length', str(len(self.body)))])
+                        pending[event.stream_id] = self.body
+                # send as much as the flow control windows allow
+                for stream_id in list(pending):
+                    body = pending[stream_id]
+                    size = min(len(body), connection.local_flow_control_window(stream_id), connection.max_outbound_frame_size)
+                    while size > 0:
+                        connection.send_data(stream_id, body[:size])
+                        body = body[size:]
+                        size = min(len(body), connection.local_flow_control_window(stream_id), connection.max_outbound_frame_size)
+                    if body:
+                        pending[stream_id] = body
+                    else:
+                        connection.end_stream(stream_id)
+                        del pending[stream_id]
+                client.sendall(connection.data_to_send())
+        except (OSError, h2.exceptions.ProtocolError):
+            return
+        finally:
+            client.close()
+
+    def close(self):
+        self.socket.close()
+
+def run(client, requests, concurrency):
+    def fetch(i):
+        status_code, content = connector.fetch_raw(ENTITY_ID, 'transactions', client)
+        assert status_code == 200
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(fetch, range(requests)))
+    return time.perf_counter() - started
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=200)
+    parser.add_argument("--rows", type=int, default=50, help="transactions in each response")
+    args = parser.parse_args()
+
+    body = payload(args.rows)
+    http1_server = HTTP1Server(body)
+    threading.Thread(target=http1_server.serve_forever, daemon=True).start()
+    http2_server = HTTP2Server(body)
+
+    results = []
+    for name, server, http2 in [("HTTP/1.1 (requests)", http1_server, False), ("HTTP/2 (httpx)", http2_server, 'prior_knowledge')]:
+        client = fbc.Client(api_key="benchmark", base_url="http://{}:{}".format(*server.server_address), http2=http2,
+            max_concurrent_requests=None, connection_pool_size=args.concurrency)
+        run(client, min(args.requests, args.concurrency), args.concurrency) # warm up
+        seconds = run(client, args.requests, args.concurrency)
+        results.append((name, seconds, server.connections))
+
+    print("{} requests, {} concurrent, {} bytes each".format(args.requests, args.concurrency, len(body)))
+    print("{:<22} {:>10} {:>10} {:>12}".format("transport", "seconds", "req/s", "connections"))
+    for name, seconds, connections in results:
+        print("{:<22} {:>10.2f} {:>10.0f} {:>12}".format(name, seconds, args.requests / seconds, connections))
+
+    http1_server.shutdown()
+    http2_server.close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+"""
+Measures the cold import time of the package in fresh interpreters, and checks that importing the package
+doesn't pull in the HTTP stack or the optional accelerators (JSON, NumPy, Arrow) before they are used
+
+usage: python benchmarks/import_time.py [--runs 20] [--max-ms 50]
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# modules which must stay unimported after the statement is run
+SCENARIOS = [
+    ("import finbox_bankconnect", ["requests", "urllib3", "finbox_bankconnect.entity", "orjson", "numpy", "pyarrow"]),
+    ("from finbox_bankconnect.utils import is_valid_uuid4", ["requests", "urllib3", "finbox_bankconnect.entity", "orjson", "numpy", "pyarrow"]),
+    ("import finbox_bankconnect; finbox_bankconnect.Entity", ["requests", "urllib3", "orjson", "numpy", "pyarrow"]),
+]
+
+PROBE = """
+import sys, time, json
+start = time.perf_counter()
+{statement}
+elapsed = time.perf_counter() - start
+print(json.dumps({{"ms": elapsed * 1000, "loaded": [m for m in {forbidden!r} if m in sys.modules]}}))
+"""
+
+def measure(statement, forbidden):
+    """Runs the statement in a fresh interpreter, returns (milliseconds, list of forbidden modules loaded)"""
+    output = subprocess.check_output([sys.executable, "-c", PROBE.format(statement=statement, forbidden=forbidden)], cwd=ROOT)
+    result = json.loads(output.decode('utf-8'))
+    return result["ms"], result["loaded"]
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--runs", type=int, default=20)
+    parser.add_argument("--max-ms", type=float, default=None, help="fail if the median import time is above this")
+    args = parser.parse_args()
+
+    failed = False
+    for statement, forbidden in SCENARIOS:
+        timings = []
+        loaded = []
+        for _ in range(args.runs):
+            ms, loaded = measure(statement, forbidden)
+            timings.append(ms)
+        timings.sort()
+        median = timings[len(timings) // 2]
+        print("{:<60} median {:7.2f} ms  min {:7.2f} ms".format(statement, median, timings[0]))
+        if loaded:
+            print("  eagerly imported: {}".format(", ".join(loaded)))
+            failed = True
+        if args.max_ms is not None and median > args.max_ms:
+            print("  above the {} ms budget".format(args.max_ms))
+            failed = True
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,74 @@
+"""
+Measures the bytes saved and the time taken by the pdf optimizer on a generated scanned statement: pages with
+a scanned image each, the same bank logo stored again on every page, page thumbnails and no object streams,
+like the files of many scanning apps. Pass --file to measure a real statement instead (a copy is rewritten).
+
+needs: pip install pikepdf
+
+usage: python benchmarks/pdf_optimizer.py [--pages 40] [--file statement.pdf] [--password PASSWORD]
+"""
+
+import argparse
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+import zlib
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pikepdf
+from finbox_bankconnect.pdf_optimizer import PdfOptimizer
+
+def image(pdf, data, width, height):
+    stream = pikepdf.Stream(pdf, zlib.compress(data, 1))
+    stream.Type = pikepdf.Name.XObject
+    stream.Subtype = pikepdf.Name.Image
+    stream.Width = width
+    stream.Height = height
+    stream.ColorSpace = pikepdf.Name.DeviceGray
+    stream.BitsPerComponent = 8
+    stream.Filter = pikepdf.Name.FlateDecode
+    return stream
+
+def scanned_statement(path, pages):
+    random.seed(1)
+    logo = bytes(bytearray(random.randrange(4) * 60 for _ in range(300 * 300)))
+    pdf = pikepdf.new()
+    for _ in range(pages):
+        page = pdf.add_blank_page(page_size=(1240, 1754))
+        # mostly white scan with sparse ink
+        scan = bytes(bytearray(random.randrange(256) if random.random() < 0.15 else 255 for _ in range(1240 * 1754)))
+        page.Resources = pikepdf.Dictionary(XObject=pikepdf.Dictionary(Logo=image(pdf, logo, 300, 300), Scan=image(pdf, scan, 1240, 1754)))
+        page.Contents = pikepdf.Stream(pdf, b"q 1240 0 0 1754 0 0 cm /Scan Do Q q 300 0 0 300 40 1414 cm /Logo Do Q")
+        page.obj.Thumb = pdf.make_indirect(pikepdf.Stream(pdf, zlib.compress(os.urandom(20000))))
+    pdf.save(path, object_stream_mode=pikepdf.ObjectStreamMode.disable)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--pages", type=int, default=40)
+    parser.add_argument("--file")
+    parser.add_argument("--password")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "statement.pdf")
+        if args.file:
+            shutil.copyfile(args.file, path)
+        else:
+            scanned_statement(path, args.pages)
+        optimizer = PdfOptimizer(workers=1)
+        started_at = time.monotonic()
+        result = optimizer.submit(path, args.password).result()
+        elapsed = time.monotonic() - started_at
+        optimizer.close()
+        if result.error is not None:
+            print("not optimized: {}".format(result.error))
+            return
+        print("original {:.1f} MB, optimized {:.1f} MB, saved {:.1%} in {:.2f}s".format(result.original_size / 1e6,
+            result.optimized_size / 1e6, result.bytes_saved / result.original_size, elapsed))
+
+if __name__ == "__main__":
+    main()
@@ -1,3 +1,5 @@
+import sys
+
 name = "finbox_bankconnect"
 api_key = None
 api_version = 'v1'
@@ -5,6 +7,41 @@ max_retry_limit = 2
 base_url = 'https://portal.finbox.in'
 poll_timeout = 10 # seconds
 poll_interval = 2 # seconds
+connection_pool_size = 32 # connections kept alive to base_url
+http2 = False # True to multiplex requests over HTTP/2 if httpx[http2] is installed (see transport), else HTTP/1.1
+conditional_cache_size = 256 # entity responses kept for conditional requests (ETag / Last-Modified), 0 to disable
+rate_limit = None # maximum requests per second, None for no limit
+connect_timeout = 5 # seconds to wait for a connection, None for no limit
+read_timeout = 60 # seconds to wait for response data, None for no limit
+hedge_percentile = None # e.g. 95 to send GET requests again when slower than that percentile (see hedging), None to disable
+hedge_budget = 0.05 # hedges sent at most per GET request
+cache_memory_budget = None # bytes of entity data kept cached uncompressed (see cache), None for no limit
+cache_spill_directory = None # directory to spill evicted entity data to, None to keep it compressed in memory
+derived_views = False # True to derive salary, lender and recurring rows from the tagged transactions (see views)
+upload_preflight = False # True to check statement pdf files locally before uploading them (see preflight)
+account_index_path = None # file indexing the fetched accounts of all entities (see account_index), None to disable
+max_concurrent_requests = 32 # requests in flight at once, the rest wait by priority (see scheduler), None for no limit
+reserved_interactive_requests = 4 # slots of max_concurrent_requests usable by interactive priority requests only
 
 #TODO: Add authentication mode and also secret key + timestamp based authentication mode
-from finbox_bankconnect.entity import Entity
+
+# the Entity and Client classes (and with them the connector) are imported on first access, so that importing
+# the package stays cheap for code only using the configuration or utils (e.g. serverless cold starts)
+if sys.version_info < (3, 7):
+    # module level __getattr__ needs python 3.7+
+    from finbox_bankconnect.entity import Entity
+    from finbox_bankconnect.client import Client
+
+def __getattr__(attribute):
+    if attribute == 'Entity':
+        from finbox_bankconnect.entity import Entity
+        globals()['Entity'] = Entity
+        return Entity
+    if attribute == 'Client':
+        from finbox_bankconnect.client import Client
+        globals()['Client'] = Client
+        return Client
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, attribute))
+
+def __dir__():
+    return sorted(list(globals()) + ['Entity', 'Client'])
@@ -0,0 +1,307 @@
+"""Persistent index of the bank accounts of the entities, to find the same account under different entities
+
+With finbox_bankconnect.account_index_path set (or the account_index_path argument of a Client), the accounts
+fetched by get_accounts (and get_fraud_info, which fetches them too) and the identity fetched by get_identity
+are added to a hash file at that path (dbm, using the best module available, e.g. GNU dbm). The accounts are
+keyed on the normalized account number with the IFSC, or with the normalized account holder name if the
+IFSC isn't known (see account_key). Finding the other entities sharing an account is then one hash lookup,
+whatever the number of entities indexed, and adding an entity to an account writes a few small records,
+whatever the number of entities already having it.
+
+Masked account numbers (e.g. XXXXXXXX7890) aren't account keys, as different accounts share them. All the
+accounts are also indexed on their last POSSIBLE_MATCH_DIGITS digits with the IFSC or name (see
+possible_match_key), so that possible_matches finds the entities which may have the same account, masked or not.
+
+dbm files can't be written by several processes at once, so use one index file per writing process (or
+write from one process only). Without GNU dbm (or ndbm) the portable dbm.dumb module is used, which keeps the
+keys in memory, so prefer a python built with GNU dbm for indexes of millions of entities.
+
+metrics counters:
+account_index_duplicates -- accounts added for an entity which were already indexed for another entity
+account_index_possible_matches -- possible match keys added for an entity which another entity already had
+account_index_errors -- accounts not indexed because the file couldn't be written
+
+Example:
+finbox_bankconnect.account_index_path = "/var/lib/bankconnect/accounts"
+entity.get_accounts()
+index = account_index.open_index(finbox_bankconnect.account_index_path)
+index.shared_accounts(entity.entity_id) # {account key: [other entity ids]}
+"""
+import atexit
+import dbm
+import json
+import threading
+import finbox_bankconnect.metrics as metrics
+from finbox_bankconnect.matching import normalize_account_number, normalize_name
+
+# errors of the underlying dbm module, and of the file system
+ERRORS = (OSError,) + tuple(dbm.error)
+
+POSSIBLE_MATCH_DIGITS = 4 # last digits of the account numbers compared for possible matches
+
+_COUNT_PREFIX = 'c:' # account key -> number of entities having it
+_HOLDER_PREFIX = 'h:' # account key and position -> JSON list of the entity_id, holder name (or null) and,
+                      # for the possible match keys, whether the account number is masked
+_POSITION_PREFIX = 'p:' # account key and entity_id -> position of the entity among the holders of the key
+_ENTITY_PREFIX = 'e:' # entity_id -> JSON list of its account keys
+_POSSIBLE_PREFIX = 'm:' # entity_id -> JSON list of its possible match keys
+
+def _key(number, ifsc, name):
+    ifsc = "".join(character for character in (ifsc or '').upper() if character.isalnum())
+    if ifsc:
+        return "{}|ifsc:{}".format(number, ifsc)
+    name = normalize_name(name)
+    if name:
+        return "{}|name:{}".format(number, name)
+    return "{}|".format(number)
+
+def account_key(account_number, ifsc=None, name=None):
+    """Returns the index key string of an account, None if the account number is missing or masked
+
+    arguments:
+    account_number -- account number string
+    ifsc (optional) -- IFSC string of the branch
+    name (optional) -- account holder name string, used if the IFSC isn't given
+    """
+    number = normalize_account_number(account_number)
+    if not number or 'X' in number:
+        return None
+    return _key(number, ifsc, name)
+
+def possible_match_key(account_number, ifsc=None, name=None):
+    """Returns the possible match key string of an account (masked or not), None if its account number doesn't
+        end with POSSIBLE_MATCH_DIGITS digits
+
+    arguments:
+    account_number -- account number string (masked digits as X or *)
+    ifsc (optional) -- IFSC string of the branch
+    name (optional) -- account holder name string, used if the IFSC isn't given
+    """
+    digits = normalize_account_number(account_number)[-POSSIBLE_MATCH_DIGITS:]
+    if len(digits) < POSSIBLE_MATCH_DIGITS or 'X' in digits:
+        return None
+    return _key("~" + digits, ifsc, name)
+
+def _entries(accounts, identity):
+    # returns the dictionaries of account key -> holder name and of possible match key -> (holder name, masked)
+    # of the accounts and identity of an entity
+    identity = identity or dict()
+    identity_name = identity.get('name')
+    entries = dict()
+    possible = dict()
+    identity_indexed = False
+
+    def add(account_number, ifsc, name):
+        key = account_key(account_number, ifsc, name)
+        if key is not None:
+            entries[key] = normalize_name(name) or None
+        key = possible_match_key(account_number, ifsc, name)
+        if key is not None:
+            possible[key] = (normalize_name(name) or None, 'X' in normalize_account_number(account_number))
+
+    for account in accounts or ():
+        # the identity names the holder of its account, which is also one of the accounts
+        is_identity_account = bool(identity) and (
+            (identity.get('account_id') is not None and identity.get('account_id') == account.get('account_id'))
+            or (identity.get('account_number') is not None and identity.get('account_number') == account.get('account_number')))
+        name = account.get('name') or (identity_name if is_identity_account else None)
+        if normalize_account_number(account.get('account_number')):
+            add(account.get('account_number'), account.get('ifsc'), name)
+            identity_indexed = identity_indexed or is_identity_account
+    if identity and not identity_indexed:
+        add(identity.get('account_number'), identity.get('ifsc'), identity_name)
+    return entries, possible
+
+class AccountIndex:
+    """Persistent hash index of the accounts of the entities, see the module documentation"""
+
+    def __init__(self, path):
+        """Opens (or creates) the index file
+
+        arguments:
+        path -- path of the index file (the dbm module may add an extension)
+        """
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = dbm.open(path, 'c')
+
+    def _load(self, key, default):
+        value = self._db.get(key.encode('utf-8'))
+        if value is None:
+            return default
+        return json.loads(value.decode('utf-8'))
+
+    def _store(self, key, value):
+        self._db[key.encode('utf-8')] = json.dumps(value, sort_keys=True).encode('utf-8')
+
+    def _records(self, key):
+        # returns the dictionary of entity_id -> holder record of the account key, one read per holder
+        records = dict()
+        for position in range(self._load(_COUNT_PREFIX + key, 0)):
+            record = self._load("{}{}#{}".format(_HOLDER_PREFIX, key, position), None)
+            if record is not None:
+                records[record[0]] = record
+        return records
+
+    def _holders(self, key):
+        # returns the dictionary of entity_id -> holder name of the account key
+        return dict((entity_id, record[1]) for entity_id, record in self._records(key).items())
+
+    def _add_holder(self, key, entity_id, record):
+        # adds (or updates) the holder record of the entity for the account key, returns the other entity ids
+        position_key = "{}{}#{}".format(_POSITION_PREFIX, key, entity_id)
+        position = self._load(position_key, None)
+        if position is not None:
+            holder_key = "{}{}#{}".format(_HOLDER_PREFIX, key, position)
+            previous = self._load(holder_key, None)
+            if record[1] is None and previous is not None:
+                # a name once known is kept
+                record = [entity_id, previous[1]] + record[2:]
+            if record != previous:
+                self._store(holder_key, record)
+            return sorted(other for other in self._holders(key) if other != entity_id)
+        others = sorted(self._holders(key))
+        position = self._load(_COUNT_PREFIX + key, 0)
+        self._store("{}{}#{}".format(_HOLDER_PREFIX, key, position), record)
+        self._store(position_key, position)
+        self._store(_COUNT_PREFIX + key, position + 1)
+        if others:
+            metrics.increment('account_index_duplicates' if not key.startswith('~') else 'account_index_possible_matches')
+        return others
+
+    def _add_keys(self, prefix, entity_id, keys):
+        indexed = self._load(prefix + entity_id, [])
+        missing = [key for key in keys if key not in indexed]
+        if missing:
+            self._store(prefix + entity_id, indexed + sorted(missing))
+
+    def add(self, entity_id, accounts=None, identity=None):
+        """Indexes the accounts of the entity, returns the dictionary of account key -> list of the other entity ids
+            already having that account (only for the accounts shared with other entities)
+
+        arguments:
+        entity_id -- entity id string
+        accounts (optional) -- list of account dictionary (account_number, ifsc, ...) as returned by get_accounts
+        identity (optional) -- identity dictionary (name, account_number, ...) as returned by get_identity
+        """
+        entries, possible = _entries(accounts, identity)
+        shared = dict()
+        with self._lock:
+            for key, name in entries.items():
+                others = self._add_holder(key, entity_id, [entity_id, name])
+                if others:
+                    shared[key] = others
+            for key, (name, masked) in possible.items():
+                self._add_holder(key, entity_id, [entity_id, name, masked])
+            self._add_keys(_ENTITY_PREFIX, entity_id, entries)
+            self._add_keys(_POSSIBLE_PREFIX, entity_id, possible)
+        return shared
+
+    def entities(self, account_number, ifsc=None, name=None):
+        """Returns the dictionary of entity_id -> normalized holder name (None if not known) of the entities having
+            the account
+
+        arguments:
+        account_number -- account number string
+        ifsc (optional) -- IFSC string of the branch
+        name (optional) -- account holder name string, used if the IFSC isn't given
+        """
+        key = account_key(account_number, ifsc, name)
+        if key is None:
+            return dict()
+        with self._lock:
+            return self._holders(key)
+
+    def accounts(self, entity_id):
+        """Returns the list of the account keys indexed for the entity
+
+        arguments:
+        entity_id -- entity id string
+        """
+        with self._lock:
+            return self._load(_ENTITY_PREFIX + entity_id, [])
+
+    def shared_accounts(self, entity_id):
+        """Returns the dictionary of account key -> list of the other entity ids having that account, for the
+            accounts of the entity shared with other entities
+
+        arguments:
+        entity_id -- entity id string
+        """
+        shared = dict()
+        with self._lock:
+            for key in self._load(_ENTITY_PREFIX + entity_id, []):
+                others = sorted(other for other in self._holders(key) if other != entity_id)
+                if others:
+                    shared[key] = others
+        return shared
+
+    def possible_matches(self, entity_id):
+        """Returns the dictionary of possible match key -> list of the other entity ids whose account may be the
+            same (same last digits and IFSC or name, one of them masked), leaving out the entities sharing an
+            account for sure
+
+        arguments:
+        entity_id -- entity id string
+        """
+        sure = set(other for others in self.shared_accounts(entity_id).values() for other in others)
+        possible = dict()
+        with self._lock:
+            for key in self._load(_POSSIBLE_PREFIX + entity_id, []):
+                records = self._records(key)
+                masked = entity_id in records and records[entity_id][2]
+                # two account numbers shown in full are the same only if their account keys are
+                others = sorted(other for other, record in records.items()
+                    if other != entity_id and other not in sure and (masked or record[2]))
+                if others:
+                    possible[key] = others
+        return possible
+
+    def sync(self):
+        """Writes the pending changes to the file, if the dbm module buffers them"""
+        with self._lock:
+            if hasattr(self._db, 'sync'):
+                self._db.sync()
+
+    def close(self):
+        """Closes the index file"""
+        with self._lock:
+            self._db.close()
+
+_indexes = dict() # path -> AccountIndex
+_indexes_lock = threading.Lock()
+
+def open_index(path):
+    """Returns the AccountIndex of the path, opened once per process
+
+    arguments:
+    path -- path of the index file
+    """
+    with _indexes_lock:
+        index = _indexes.get(path)
+        if index is None:
+            index = _indexes[path] = AccountIndex(path)
+        return index
+
+def close_all():
+    """Closes the indexes opened by open_index"""
+    with _indexes_lock:
+        for index in _indexes.values():
+            index.close()
+        _indexes.clear()
+
+atexit.register(close_all)
+
+def index_entity(path, entity_id, accounts, identity=None):
+    """Adds the accounts of the entity to the index at the path, counting (not raising) the errors writing it
+
+    arguments:
+    path -- path of the index file
+    entity_id -- entity id string
+    accounts -- list of account dictionary
+    identity (optional) -- identity dictionary
+    """
+    try:
+        open_index(path).add(entity_id, accounts, identity)
+    except ERRORS:
+        metrics.increment('account_index_errors')
@@ -0,0 +1,202 @@
+"""Process wide memory budget for the data cached by Entity instances
+
+The transactions, salary and lender transactions stores and the recurring transactions lists cached by
+Entity instances are accounted against finbox_bankconnect.cache_memory_budget (bytes, None for no limit).
+When the cached data exceeds it, the least recently used payloads (idle for at least MIN_IDLE_SECONDS) are
+compressed, and kept in memory or spilled to a file in finbox_bankconnect.cache_spill_directory if set.
+The next getter call for an evicted payload reloads it transparently, or fetches it again from the API if
+its spill file is gone.
+
+The sizes are estimates from a sample of the rows, use usage() to observe them.
+"""
+import os
+import pickle
+import sys
+import threading
+import time
+import uuid
+import weakref
+import zlib
+from collections import OrderedDict
+import finbox_bankconnect
+import finbox_bankconnect.metrics as metrics
+
+# payloads used more recently than this are never evicted, so a getter isn't left without the data it just loaded
+MIN_IDLE_SECONDS = 1.0
+
+# rows sampled to estimate the size of a payload
+_SAMPLE_ROWS = 32
+
+def estimate_size(rows):
+    """Returns the estimated bytes used by a list of row dictionaries
+
+    arguments:
+    rows -- list of dictionary
+    """
+    count = len(rows)
+    if not count:
+        return sys.getsizeof(rows)
+    step = max(1, count // _SAMPLE_ROWS)
+    sample = [rows[index] for index in range(0, count, step)]
+    per_row = sum(_row_size(row) for row in sample) / len(sample)
+    return int(sys.getsizeof(rows) + per_row * count)
+
+def _row_size(row):
+    # the keys are shared between the rows (interned by the decoder), so only the values are counted
+    if isinstance(row, dict):
+        return sys.getsizeof(row) + sum(sys.getsizeof(value) for value in row.values())
+    return sys.getsizeof(row)
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+class PackedPayload:
+    """Compressed payload of an evicted entry, kept in memory or spilled to a file"""
+
+    def __init__(self, payload, spill_directory=None):
+        data = zlib.compress(pickle.dumps(payload, pickle.HIGHEST_PROTOCOL), 1)
+        self.size = len(data)
+        self.data = data
+        self.path = None
+        if spill_directory is not None:
+            path = os.path.join(spill_directory, "finbox-{}.spill".format(uuid.uuid4().hex))
+            try:
+                with open(os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600), 'wb') as spill_file:
+                    spill_file.write(data)
+            except OSError:
+                # keep it in memory if the directory isn't usable
+                metrics.increment('cache_spill_errors')
+            else:
+                self.data = None
+                self.path = path
+                # the file goes with the payload, e.g. when its entity is garbage collected
+                self._finalizer = weakref.finalize(self, _remove, path)
+
+    @property
+    def spilled(self):
+        return self.path is not None
+
+    def load(self):
+        """Returns the payload, None if its spill file is lost"""
+        data = self.data
+        if self.path is not None:
+            try:
+                with open(self.path, 'rb') as spill_file:
+                    data = spill_file.read()
+            except OSError:
+                return None
+            finally:
+                self._finalizer()
+        try:
+            return pickle.loads(zlib.decompress(data))
+        except Exception:
+            return None
+
+class MemoryBudget:
+    """LRU accounting of the cached entity payloads against finbox_bankconnect.cache_memory_budget"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = OrderedDict() # (owner id, name) -> [owner weak reference, name, size, last used], in LRU order
+        self._packed = dict() # (owner id, name) -> PackedPayload
+        self._owners = set() # ids of the owners with a finalizer registered
+        self._live_bytes = 0
+
+    def track(self, owner, name, size):
+        """Accounts the (re)loaded payload of the owner, see enforce for evicting payloads if over budget
+
+        arguments:
+        owner -- object having a _cache_evict(name) method
+        name -- payload name
+        size -- estimated bytes of the payload
+        """
+        key = (id(owner), name)
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self._live_bytes -= previous[2]
+            self._entries[key] = [weakref.ref(owner), name, size, time.monotonic()]
+            self._live_bytes += size
+            if key[0] not in self._owners:
+                self._owners.add(key[0])
+                weakref.finalize(owner, self._forget_owner, key[0])
+
+    def touch(self, owner, name):
+        """Marks the payload of the owner as recently used"""
+        key = (id(owner), name)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                entry[3] = time.monotonic()
+                self._entries.move_to_end(key)
+
+    def evicted(self, owner, name, packed):
+        """Records that the owner replaced its payload by the packed one"""
+        key = (id(owner), name)
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self._live_bytes -= entry[2]
+            self._packed[key] = packed
+        metrics.increment('cache_evictions')
+
+    def restored(self, owner, name):
+        """Records that the owner dropped its packed payload (reloaded, or to be fetched again)"""
+        with self._lock:
+            self._packed.pop((id(owner), name), None)
+
+    def _forget_owner(self, owner_id):
+        with self._lock:
+            for key in [key for key in self._entries if key[0] == owner_id]:
+                self._live_bytes -= self._entries.pop(key)[2]
+            for key in [key for key in self._packed if key[0] == owner_id]:
+                del self._packed[key]
+            self._owners.discard(owner_id)
+
+    def enforce(self, exclude=None):
+        """Evicts the least recently used idle payloads till the live bytes fit the budget
+
+        arguments:
+        exclude (optional) -- owner whose payloads are kept (e.g. the one loading data right now)
+        """
+        budget = finbox_bankconnect.cache_memory_budget
+        if budget is None:
+            return
+        victims = []
+        with self._lock:
+            excess = self._live_bytes - budget
+            now = time.monotonic()
+            for owner_ref, name, size, last_used in self._entries.values():
+                if excess <= 0 or now - last_used < MIN_IDLE_SECONDS:
+                    break
+                if exclude is not None and owner_ref() is exclude:
+                    continue
+                victims.append((owner_ref, name))
+                excess -= size
+        # evicted outside the lock, the owners take their own locks
+        for owner_ref, name in victims:
+            owner = owner_ref()
+            if owner is not None:
+                owner._cache_evict(name)
+
+    def usage(self):
+        """Returns a dictionary with the budget and the current live, compressed (in memory) and spilled bytes"""
+        with self._lock:
+            packed = list(self._packed.values())
+            return {
+                'budget': finbox_bankconnect.cache_memory_budget,
+                'live_bytes': self._live_bytes,
+                'live_entries': len(self._entries),
+                'compressed_bytes': sum(item.size for item in packed if not item.spilled),
+                'spilled_bytes': sum(item.size for item in packed if item.spilled),
+                'evicted_entries': len(packed)
+            }
+
+budget = MemoryBudget()
+
+def usage():
+    """Returns the memory usage of the cached entity data, see MemoryBudget.usage"""
+    return budget.usage()
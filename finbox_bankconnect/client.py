@@ -0,0 +1,73 @@
+import finbox_bankconnect.transport as transport
+from finbox_bankconnect.entity import Entity
+
+class Client:
+    """Isolated configuration for talking to the API with its own key and settings, owning its connection pool,
+        response caches and rate limit, so that many tenants can be served concurrently from one process
+
+    Example:
+    client = finbox_bankconnect.Client(api_key="PARTNER_API_KEY", poll_timeout=30)
+    entity = client.Entity.get(entity_id)
+    transactions = entity.get_transactions()
+
+    The module level configuration (finbox_bankconnect.api_key, etc.) keeps working for the
+    finbox_bankconnect.Entity class and is not used by Client instances.
+    """
+
+    def __init__(self, api_key, base_url='https://portal.finbox.in', api_version='v1', max_retry_limit=2,
+            poll_timeout=10, poll_interval=2, connection_pool_size=32, conditional_cache_size=256, rate_limit=None,
+            max_concurrent_requests=32, reserved_interactive_requests=4, connect_timeout=5, read_timeout=60, http2=False,
+            hedge_percentile=None, hedge_budget=0.05, account_index_path=None, upload_preflight=False, derived_views=False):
+        """Creates a client
+
+        arguments:
+        api_key -- API Key for your organization
+        base_url (optional) -- API base url
+        api_version (optional) (default: v1) -- API version string
+        max_retry_limit (optional) (default: 2) -- attempts for entity creation and upload requests
+        poll_timeout (optional) (default: 10) -- seconds to keep polling an entity being processed
+        poll_interval (optional) (default: 2) -- seconds between polls
+        connection_pool_size (optional) (default: 32) -- connections kept alive to base_url
+        conditional_cache_size (optional) (default: 256) -- entity responses kept for conditional requests, 0 to disable
+        rate_limit (optional) -- maximum requests per second, None for no limit
+        max_concurrent_requests (optional) (default: 32) -- requests in flight at once, the rest wait by priority, None for no limit
+        reserved_interactive_requests (optional) (default: 4) -- slots usable by interactive priority requests only
+        connect_timeout (optional) (default: 5) -- seconds to wait for a connection, None for no limit
+        read_timeout (optional) (default: 60) -- seconds to wait for response data, None for no limit
+        http2 (optional) (default: False) -- True to multiplex requests over HTTP/2 if httpx[http2] is installed, else HTTP/1.1
+        hedge_percentile (optional) -- e.g. 95 to send GET requests again when slower than that percentile, None to disable
+        hedge_budget (optional) (default: 0.05) -- hedges sent at most per GET request
+        account_index_path (optional) -- file indexing the fetched accounts of all entities, None to disable
+        upload_preflight (optional) (default: False) -- True to check statement pdf files locally before uploading them
+        derived_views (optional) (default: False) -- True to derive salary, lender and recurring rows from the tagged transactions
+        """
+        if not api_key or not type(api_key) == str:
+            raise ValueError("api_key must be a non blank string")
+        self.api_key = api_key
+        self.base_url = base_url
+        self.api_version = api_version
+        self.max_retry_limit = max_retry_limit
+        self.poll_timeout = poll_timeout
+        self.poll_interval = poll_interval
+        self.connection_pool_size = connection_pool_size
+        self.conditional_cache_size = conditional_cache_size
+        self.rate_limit = rate_limit
+        self.max_concurrent_requests = max_concurrent_requests
+        self.reserved_interactive_requests = reserved_interactive_requests
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.http2 = http2
+        self.hedge_percentile = hedge_percentile
+        self.hedge_budget = hedge_budget
+        self.account_index_path = account_index_path
+        self.upload_preflight = upload_preflight
+        self.derived_views = derived_views
+
+        self.transport = transport.Transport(self)
+
+        # Entity class bound to this client, use client.Entity.get / client.Entity.create
+        self.Entity = type('Entity', (Entity,), {'_client': self})
+
+    def __repr__(self):
+        # never show the api_key
+        return "<finbox_bankconnect.Client base_url={!r}>".format(self.base_url)
@@ -1,5 +1,11 @@
-import requests
+import json
+try:
+    from urllib.parse import urlencode
+except ImportError:
+    from urllib import urlencode
 import finbox_bankconnect
+import finbox_bankconnect.decoder as decoder
+import finbox_bankconnect.transport as transport
 from finbox_bankconnect.custom_exceptions import ServiceTimeOutError, InvalidBankNameError
 from finbox_bankconnect.custom_exceptions import PasswordIncorrectError, UnparsablePDFError
 from finbox_bankconnect.custom_exceptions import FileProcessFailedError, EntityNotFoundError
@@ -11,20 +17,57 @@ def get_progress_status(progress):
             return statement["status"]
     return "completed"
 
-def create_entity(link_id):
-    url = "{}/bank-connect/{}/entity/".format(finbox_bankconnect.base_url, finbox_bankconnect.api_version)
-    headers = { 'x-api-key': finbox_bankconnect.api_key }
+def progress_signature(progress):
+    # compact comparable snapshot of the statement progress list, changes whenever a statement is added or updated
+    return json.dumps(progress, sort_keys=True)
+
+def _resolve(client):
+    # returns the configuration and transport to use, the package level ones if client is None
+    if client is None:
+        return finbox_bankconnect, transport.get_default()
+    return client, client.transport
+
+def forget_resource(entity_id, resource, client=None):
+    # drops the payloads of the entity resource kept for conditional requests, see Transport.forget
+    config, http = _resolve(client)
+    http.forget(entity_id, resource)
+
+def scope_params(account_id=None, from_date=None, to_date=None):
+    # query parameters asking the API for the rows of one account and / or date window only
+    params = []
+    if account_id is not None:
+        params.append(('account_id', account_id))
+    if from_date is not None:
+        params.append(('from_date', from_date.isoformat()))
+    if to_date is not None:
+        params.append(('to_date', to_date.isoformat()))
+    return params
+
+def _get_entity_resource(entity_id, resource, client=None, params=None):
+    # fetches an entity resource (conditional request if fetched before), returns (status_code, decoded response)
+    config, http = _resolve(client)
+    url = "{}/bank-connect/{}/entity/{}/{}/".format(config.base_url, config.api_version, entity_id, resource)
+    query = urlencode(params) if params else ''
+    if query:
+        url = "{}?{}".format(url, query)
+    headers = { 'x-api-key': config.api_key }
+    return http.get_cached((entity_id, resource, query), url, headers, decoder.loads)
+
+def create_entity(link_id, client=None):
+    config, http = _resolve(client)
+    url = "{}/bank-connect/{}/entity/".format(config.base_url, config.api_version)
+    headers = { 'x-api-key': config.api_key }
     data = { 'link_id': link_id }
 
     entity_id = None
     response = None
 
-    retry_left = finbox_bankconnect.max_retry_limit
+    retry_left = config.max_retry_limit
     while retry_left:
-        response = requests.post(url, headers=headers, data=data)
+        response = http.request('POST', url, headers=headers, data=data)
         if response.status_code == 201:
             try:
-                entity_id = response.json()['entity_id']
+                entity_id = decoder.loads(response.content)['entity_id']
                 break
             except KeyError:
                 pass
@@ -34,20 +77,21 @@ def create_entity(link_id):
         raise ServiceTimeOutError
     return entity_id
 
-def get_link_id(entity_id):
-    url = "{}/bank-connect/{}/entity/{}/".format(finbox_bankconnect.base_url, finbox_bankconnect.api_version, entity_id)
-    headers = { 'x-api-key': finbox_bankconnect.api_key }
+def get_link_id(entity_id, client=None):
+    config, http = _resolve(client)
+    url = "{}/bank-connect/{}/entity/{}/".format(config.base_url, config.api_version, entity_id)
+    headers = { 'x-api-key': config.api_key }
 
     got_link_id = False
     link_id = None
     response = None
 
-    retry_left = finbox_bankconnect.max_retry_limit
+    retry_left = config.max_retry_limit
     while retry_left:
-        response = requests.get(url, headers=headers)
+        response = http.get(url, headers=headers)
         if response.status_code == 200:
             try:
-                link_id = response.json()['link_id']
+                link_id = decoder.loads(response.content)['link_id']
                 got_link_id = True
                 break
             except KeyError:
@@ -60,7 +104,8 @@ def get_link_id(entity_id):
         raise ServiceTimeOutError
     return link_id
 
-def upload_file(entity_id, file_obj, pdf_password, bank_name):
+def upload_file(entity_id, file_obj, pdf_password, bank_name, client=None):
+    config, http = _resolve(client)
     api_name = 'upload'
     data = dict()
     if bank_name is None:
@@ -72,16 +117,16 @@ def upload_file(entity_id, file_obj, pdf_password, bank_name):
     if pdf_password is not None:
         data['pdf_password'] = pdf_password
 
-    url = "{}/bank-connect/{}/statement/{}/?identity=true".format(finbox_bankconnect.base_url, finbox_bankconnect.api_version, api_name)
-    headers = { 'x-api-key': finbox_bankconnect.api_key }
+    url = "{}/bank-connect/{}/statement/{}/?identity=true".format(config.base_url, config.api_version, api_name)
+    headers = { 'x-api-key': config.api_key }
     files = { 'file': file_obj }
     response = None
 
-    retry_left = finbox_bankconnect.max_retry_limit
+    retry_left = config.max_retry_limit
     while retry_left:
-        response = requests.post(url, headers=headers, data=data, files=files)
+        response = http.request('POST', url, headers=headers, data=data, files=files)
         if response.status_code == 200:
-            response = response.json()
+            response = decoder.loads(response.content)
             try:
                 is_authentic = not response['is_fraud']
                 entity_id = response['entity_id']
@@ -90,7 +135,7 @@ def upload_file(entity_id, file_obj, pdf_password, bank_name):
             except KeyError:
                 pass
         elif response.status_code == 400:
-            response = response.json()
+            response = decoder.loads(response.content)
             # check for invalid bank_name
             if response.get('bank_name') is not None:
                 raise InvalidBankNameError
@@ -109,39 +154,44 @@ def upload_file(entity_id, file_obj, pdf_password, bank_name):
     #TODO: log here the response
     raise ServiceTimeOutError
 
-def get_transactions(entity_id):
-    url = "{}/bank-connect/{}/entity/{}/transactions/".format(finbox_bankconnect.base_url, finbox_bankconnect.api_version, entity_id)
-    headers = { 'x-api-key': finbox_bankconnect.api_key }
-    response = requests.get(url, headers=headers)
-    if response.status_code == 404:
-        return "not_found", None, None, None
-    elif not response.status_code == 200:
+def fetch_raw(entity_id, resource, client=None):
+    # fetches the undecoded response body of an entity resource (e.g. transactions), for decoding elsewhere
+    config, http = _resolve(client)
+    url = "{}/bank-connect/{}/entity/{}/{}/".format(config.base_url, config.api_version, entity_id, resource)
+    headers = { 'x-api-key': config.api_key }
+    response = http.get(url, headers=headers)
+    return response.status_code, response.content
+
+def get_transactions(entity_id, client=None, account_id=None, from_date=None, to_date=None):
+    # the scope arguments are passed to the API, which may ignore them so the rows must still be filtered locally
+    status_code, response = _get_entity_resource(entity_id, 'transactions', client, scope_params(account_id, from_date, to_date))
+    if status_code == 404:
+        return "not_found", None, None, None, None
+    elif not status_code == 200:
         #TODO: log here the response
-        return "service_failed", None, None, None
-    response = response.json()
+        return "service_failed", None, None, None, None
     try:
-        status = get_progress_status(response['progress'])
+        progress = response['progress']
+        status = get_progress_status(progress)
         if status == "completed":
             accounts = response['accounts']
             fraud_info = response['fraud']['fraud_type']
             transactions = response['transactions']
-            return status, accounts, fraud_info, transactions
+            # the progress identifies the version of the rows, see progress_signature
+            return status, accounts, fraud_info, transactions, progress
     except KeyError:
         #TODO: log here the response
-        return "format_changed", None, None, None
-    return status, None, None, None
+        return "format_changed", None, None, None, None
+    return status, None, None, None, None
 
 
-def get_identity(entity_id):
-    url = "{}/bank-connect/{}/entity/{}/identity/".format(finbox_bankconnect.base_url, finbox_bankconnect.api_version, entity_id)
-    headers = { 'x-api-key': finbox_bankconnect.api_key }
-    response = requests.get(url, headers=headers)
-    if response.status_code == 404:
+def get_identity(entity_id, client=None):
+    status_code, response = _get_entity_resource(entity_id, 'identity', client)
+    if status_code == 404:
         return "not_found", None, None, None
-    elif not response.status_code == 200:
+    elif not status_code == 200:
         #TODO: log here the response
         return "service_failed", None, None, None
-    response = response.json()
     try:
         status = get_progress_status(response['progress'])
         if status == "completed":
@@ -154,16 +204,13 @@ def get_identity(entity_id):
         return "format_changed", None, None, None
     return status, None, None, None
 
-def get_accounts(entity_id):
-    url = "{}/bank-connect/{}/entity/{}/accounts/".format(finbox_bankconnect.base_url, finbox_bankconnect.api_version, entity_id)
-    headers = { 'x-api-key': finbox_bankconnect.api_key }
-    response = requests.get(url, headers=headers)
-    if response.status_code == 404:
+def get_accounts(entity_id, client=None):
+    status_code, response = _get_entity_resource(entity_id, 'accounts', client)
+    if status_code == 404:
         return "not_found", None, None
-    elif not response.status_code == 200:
+    elif not status_code == 200:
         #TODO: log here the response
         return "service_failed", None, None
-    response = response.json()
     try:
         status = get_progress_status(response['progress'])
         if status == "completed":
@@ -175,38 +222,53 @@ def get_accounts(entity_id):
         return "format_changed", None, None
     return status, None, None
 
-def get_salary(entity_id):
-    url = "{}/bank-connect/{}/entity/{}/salary/".format(finbox_bankconnect.base_url, finbox_bankconnect.api_version, entity_id)
-    headers = { 'x-api-key': finbox_bankconnect.api_key }
-    response = requests.get(url, headers=headers)
-    if response.status_code == 404:
+def get_progress(entity_id, client=None):
+    # uses the (light) accounts endpoint to get the statement progress list of the entity
+    status_code, response = _get_entity_resource(entity_id, 'accounts', client)
+    if status_code == 404:
         return "not_found", None, None, None
-    elif not response.status_code == 200:
+    elif not status_code == 200:
         #TODO: log here the response
         return "service_failed", None, None, None
-    response = response.json()
     try:
-        status = get_progress_status(response['progress'])
+        progress = response['progress']
+        status = get_progress_status(progress)
         if status == "completed":
             accounts = response['accounts']
             fraud_info = response['fraud']['fraud_type']
-            transactions = response['transactions']
-            return status, accounts, fraud_info, transactions
+            return status, accounts, fraud_info, progress
     except KeyError:
         #TODO: log here the response
         return "format_changed", None, None, None
     return status, None, None, None
 
-def get_recurring(entity_id):
-    url = "{}/bank-connect/{}/entity/{}/recurring_transactions/".format(finbox_bankconnect.base_url, finbox_bankconnect.api_version, entity_id)
-    headers = { 'x-api-key': finbox_bankconnect.api_key }
-    response = requests.get(url, headers=headers)
-    if response.status_code == 404:
+def get_salary(entity_id, client=None, account_id=None, from_date=None, to_date=None):
+    status_code, response = _get_entity_resource(entity_id, 'salary', client, scope_params(account_id, from_date, to_date))
+    if status_code == 404:
         return "not_found", None, None, None, None
-    elif not response.status_code == 200:
+    elif not status_code == 200:
+        #TODO: log here the response
+        return "service_failed", None, None, None, None
+    try:
+        progress = response['progress']
+        status = get_progress_status(progress)
+        if status == "completed":
+            accounts = response['accounts']
+            fraud_info = response['fraud']['fraud_type']
+            transactions = response['transactions']
+            return status, accounts, fraud_info, transactions, progress
+    except KeyError:
+        #TODO: log here the response
+        return "format_changed", None, None, None, None
+    return status, None, None, None, None
+
+def get_recurring(entity_id, client=None):
+    status_code, response = _get_entity_resource(entity_id, 'recurring_transactions', client)
+    if status_code == 404:
+        return "not_found", None, None, None, None
+    elif not status_code == 200:
         #TODO: log here the response
         return "service_failed", None, None, None, None
-    response = response.json()
     try:
         status = get_progress_status(response['progress'])
         if status == "completed":
@@ -220,24 +282,22 @@ def get_recurring(entity_id):
         return "format_changed", None, None, None, None
     return status, None, None, None, None
 
-def get_lender_transactions(entity_id):
-    url = "{}/bank-connect/{}/entity/{}/lender_transactions/".format(finbox_bankconnect.base_url, finbox_bankconnect.api_version, entity_id)
-    headers = { 'x-api-key': finbox_bankconnect.api_key }
-    response = requests.get(url, headers=headers)
-    if response.status_code == 404:
-        return "not_found", None, None, None
-    elif not response.status_code == 200:
+def get_lender_transactions(entity_id, client=None, account_id=None, from_date=None, to_date=None):
+    status_code, response = _get_entity_resource(entity_id, 'lender_transactions', client, scope_params(account_id, from_date, to_date))
+    if status_code == 404:
+        return "not_found", None, None, None, None
+    elif not status_code == 200:
         #TODO: log here the response
-        return "service_failed", None, None, None
-    response = response.json()
+        return "service_failed", None, None, None, None
     try:
-        status = get_progress_status(response['progress'])
+        progress = response['progress']
+        status = get_progress_status(progress)
         if status == "completed":
             accounts = response['accounts']
             fraud_info = response['fraud']['fraud_type']
             transactions = response['transactions']
-            return status, accounts, fraud_info, transactions
+            return status, accounts, fraud_info, transactions, progress
     except KeyError:
         #TODO: log here the response
-        return "format_changed", None, None, None
-    return status, None, None, None
+        return "format_changed", None, None, None, None
+    return status, None, None, None, None
@@ -10,6 +10,14 @@ class ServiceTimeOutError(Exception):
     def __init__(self):
         Exception.__init__(self, "Couldn't reach the service")
 
+class DeadlineExceededError(ServiceTimeOutError):
+    def __init__(self):
+        Exception.__init__(self, "Couldn't complete the call before its deadline")
+
+class OperationCancelledError(Exception):
+    def __init__(self):
+        Exception.__init__(self, "The call was cancelled")
+
 class InvalidBankNameError(Exception):
     def __init__(self):
         Exception.__init__(self, "Please enter a valid bank name string")
@@ -29,3 +37,7 @@ class FileProcessFailedError(Exception):
 class CannotIdentityBankError(Exception):
     def __init__(self):
         Exception.__init__(self, "Cannot identify the bank from the document, try specifying the bank_name explicitly")
+
+class InvalidSnapshotError(Exception):
+    def __init__(self):
+        Exception.__init__(self, "Given file is not a valid entity snapshot or has an unsupported version")
@@ -0,0 +1,152 @@
+"""Deadlines and cancellation for calls to the API
+
+A Deadline is an overall time limit for a call (e.g. get_transactions including all its polls), which can
+also be cancelled from another thread. While a deadline is active in a thread (used as a context manager,
+or passed as the deadline argument of the Entity methods), the connect and read timeouts of the requests
+are cut to the time left, the sleeps between polls wake up as soon as it is cancelled, and the call raises
+DeadlineExceededError or OperationCancelledError once it can't be met anymore. Nested deadlines never
+extend the outer one, and cancelling a deadline cancels the deadlines nested in it.
+
+Example:
+deadline = Deadline(30)
+threading.Timer(5, deadline.cancel).start() # e.g. the applicant left
+transactions = entity.get_transactions(deadline=deadline)
+"""
+import threading
+import time
+from contextlib import contextmanager
+from finbox_bankconnect.custom_exceptions import DeadlineExceededError, OperationCancelledError
+
+# longest wait without checking for cancellation when waiting on something else than the cancel event
+_CHECK_INTERVAL = 0.05
+
+_context = threading.local()
+
+class Deadline:
+    """Overall time limit for a call, see the module documentation"""
+
+    def __init__(self, timeout=None):
+        """Creates the deadline
+
+        arguments:
+        timeout (optional) -- seconds from now, None for no time limit (only cancellation)
+        """
+        self.expires_at = None if timeout is None else time.monotonic() + timeout
+        self._cancelled = threading.Event()
+        self._lock = threading.Lock()
+        self._children = []
+
+    def cancel(self):
+        """Cancels the deadline and the deadlines nested in it, waking up their waits"""
+        self._cancelled.set()
+        with self._lock:
+            children = list(self._children)
+        for child in children:
+            child.cancel()
+
+    @property
+    def cancelled(self):
+        return self._cancelled.is_set()
+
+    def remaining(self):
+        """Returns the seconds left (0 if passed), None for no time limit"""
+        if self.expires_at is None:
+            return None
+        return max(0.0, self.expires_at - time.monotonic())
+
+    def check(self):
+        """Raises OperationCancelledError if cancelled or DeadlineExceededError if passed"""
+        if self.cancelled:
+            raise OperationCancelledError
+        if self.expires_at is not None and time.monotonic() >= self.expires_at:
+            raise DeadlineExceededError
+
+    def __enter__(self):
+        stack = _stack()
+        parent = stack[-1][0] if stack else None
+        if parent is not None and parent is not self:
+            # never outlive the enclosing deadline
+            if parent.expires_at is not None and (self.expires_at is None or parent.expires_at < self.expires_at):
+                self.expires_at = parent.expires_at
+            with parent._lock:
+                parent._children.append(self)
+            if parent.cancelled:
+                self.cancel()
+        stack.append((self, parent))
+        return self
+
+    def __exit__(self, *args):
+        deadline, parent = _stack().pop()
+        if parent is not None and parent is not self:
+            with parent._lock:
+                parent._children.remove(self)
+
+def _stack():
+    # the (deadline, enclosing deadline) activations of the current thread
+    stack = getattr(_context, 'stack', None)
+    if stack is None:
+        stack = _context.stack = []
+    return stack
+
+def current():
+    """Returns the innermost Deadline active in the current thread, None if there is none"""
+    stack = _stack()
+    return stack[-1][0] if stack else None
+
+def resolve(value):
+    """Returns the Deadline for a deadline argument, which is None, seconds or a Deadline"""
+    if value is None or isinstance(value, Deadline):
+        return value
+    if type(value) in (int, float) and value >= 0:
+        return Deadline(value)
+    raise ValueError("deadline if provided must be a non negative number of seconds or a Deadline")
+
+@contextmanager
+def within(value):
+    """Context manager activating the deadline argument (None, seconds or a Deadline) in the current thread"""
+    value = resolve(value)
+    if value is None:
+        yield current()
+    else:
+        with value:
+            yield value
+
+def check():
+    """Raises if the current deadline is cancelled or passed"""
+    deadline = current()
+    if deadline is not None:
+        deadline.check()
+
+def clip(timeout):
+    """Returns the timeout (seconds or None) cut to the time left of the current deadline"""
+    deadline = current()
+    remaining = None if deadline is None else deadline.remaining()
+    if remaining is None:
+        return timeout
+    if timeout is None:
+        return remaining
+    return min(timeout, remaining)
+
+def check_interval():
+    """Returns the seconds to wait at most between checks of the current deadline, None if there is none"""
+    if current() is None:
+        return None
+    return clip(_CHECK_INTERVAL)
+
+def sleep(seconds):
+    """Sleeps for the seconds, returning early by raising if the current deadline is cancelled or passes meanwhile"""
+    deadline = current()
+    if deadline is None:
+        time.sleep(seconds)
+        return
+    deadline._cancelled.wait(clip(seconds))
+    deadline.check()
+
+def wait(event):
+    """Waits for the threading.Event, raising if the current deadline is cancelled or passes meanwhile"""
+    deadline = current()
+    if deadline is None:
+        event.wait()
+        return
+    while not event.wait(check_interval()):
+        deadline.check()
@@ -0,0 +1,61 @@
+"""JSON decoder used for all API responses
+
+Uses orjson if installed (pip install orjson), else the standard json module. Response bodies are
+decoded directly from the bytes without building a text copy first. Decode time is recorded in
+the json_decode_seconds timing of finbox_bankconnect.metrics.
+"""
+import json
+import sys
+import time
+import finbox_bankconnect.metrics as metrics
+from finbox_bankconnect.utils import import_optional
+
+# names of the supported backends
+BACKENDS = ("orjson", "json")
+
+# name of the backend to use: None (detect) or one of BACKENDS
+backend = None
+
+# custom decoder function taking bytes and returning the decoded object, overrides the backend if set
+custom_loads = None
+
+def get_backend():
+    """Returns the name of the JSON backend in use, raises ValueError if backend is set to an unsupported name"""
+    if custom_loads is not None:
+        return "custom"
+    if backend is not None:
+        if backend not in BACKENDS:
+            raise ValueError("backend must be one of {} or None, got {!r}".format(", ".join(BACKENDS), backend))
+        return backend
+    return "orjson" if import_optional('orjson') is not None else "json"
+
+def _stdlib_loads(content):
+    if isinstance(content, memoryview):
+        content = content.tobytes()
+    if isinstance(content, (bytes, bytearray)) and sys.version_info < (3, 6):
+        # json.loads accepts bytes only from python 3.6
+        content = content.decode('utf-8')
+    return json.loads(content)
+
+def loads(content):
+    """Decodes and returns the JSON document in the given bytes (or bytearray / memoryview / string)
+
+    arguments:
+    content -- the JSON document
+    """
+    start = time.perf_counter()
+    try:
+        if custom_loads is not None:
+            return custom_loads(content)
+        orjson = import_optional('orjson') if get_backend() == "orjson" else None
+        if orjson is not None:
+            try:
+                return orjson.loads(content)
+            except orjson.JSONDecodeError:
+                # documents orjson is stricter about (NaN, integers over 64 bits, non UTF-8 encodings, etc.)
+                # are decoded by the standard json module to give identical results
+                pass
+        return _stdlib_loads(content)
+    finally:
+        metrics.observe('json_decode_seconds', time.perf_counter() - start)
+        metrics.increment('json_decode_bytes', len(content))
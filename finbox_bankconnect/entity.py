@@ -1,16 +1,106 @@
 from collections import defaultdict
+import threading
 import time
 import datetime
 from finbox_bankconnect.utils import is_valid_uuid4
-from finbox_bankconnect.filters import make_account_id_filter, make_daterange_filter
+from finbox_bankconnect.filters import Filter, build_filter, apply_filter
+from finbox_bankconnect.store import TransactionStore
 import finbox_bankconnect.connector as connector
+import finbox_bankconnect.cache as cache
+import finbox_bankconnect.account_index as account_index
+import finbox_bankconnect.preflight as preflight_checks
+import finbox_bankconnect.views as views
+import finbox_bankconnect.metrics as metrics
+from finbox_bankconnect.connector import progress_signature
+from finbox_bankconnect.singleflight import SingleFlight
+from finbox_bankconnect.scheduler import priority as request_priority, validate_priority
+import finbox_bankconnect.deadline as deadline
+from finbox_bankconnect.deadline import within, resolve as resolve_deadline
 from finbox_bankconnect.custom_exceptions import ExtractionFailedError, EntityNotFoundError, ServiceTimeOutError
 import finbox_bankconnect
 
+# concurrent polls of the same (entity_id, connector function), even from different Entity instances,
+# share one in flight fetch
+_flights = SingleFlight()
+
+# API resource of the cached payloads whose name differs
+_RESOURCES = {'credit_recurring': 'recurring_transactions', 'debit_recurring': 'recurring_transactions'}
+
+def _poll(fetch_function, entity_id, client, scope=()):
+
+    # polls the given connector function till the entity is processed, returns the completed response
+
+    config = finbox_bankconnect if client is None else client
+    # keep polling till timeout happens, poll_timeout bounds the polling only, the requests themselves are cut
+    # to the caller's deadline alone (which raises from the sleeps once passed)
+    poll_until = time.monotonic() + config.poll_timeout
+    while True:
+        response = fetch_function(entity_id, client, *scope)
+        status = response[0]
+        if status == "failed":
+            raise ExtractionFailedError
+        elif status == "not_found":
+            raise EntityNotFoundError
+        elif status == "completed":
+            return response
+        remaining = poll_until - time.monotonic()
+        if remaining <= 0:
+            break
+        _poll_sleep(min(config.poll_interval, remaining)) # delay of poll_interval
+
+    # if even after polling couldn't get
+    raise ServiceTimeOutError
+
+def _poll_sleep(seconds):
+    # the wait between two polls, apart from the other deadline sleeps (e.g. rate limit waits) for the profiling mode
+    deadline.sleep(seconds)
+
+def _run_batch(function, keys, max_workers):
+
+    # runs function(key) once for each distinct key in a thread pool, returns (results, errors) dictionaries keyed
+    # by key, the keys are consumed as the calls finish so at most max_workers calls are submitted at a time
+
+    from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+    results = dict()
+    errors = dict()
+    seen = set()
+    in_flight = dict() # future -> key
+
+    def collect(futures):
+        for future in futures:
+            key = in_flight.pop(future)
+            try:
+                results[key] = future.result()
+            except Exception as e:
+                errors[key] = e
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        for key in keys:
+            if key in seen:
+                continue
+            seen.add(key)
+            if len(in_flight) >= max_workers:
+                collect(wait(in_flight, return_when=FIRST_COMPLETED).done)
+            in_flight[pool.submit(function, key)] = key
+        collect(list(in_flight))
+    return results, errors
+
+def _load_entity(data, priority):
+    # unpickles an Entity, see Entity.__reduce__
+    return Entity.loads(data, priority)
+
 class Entity:
-    def __init__(self, source=None, entity_id=None, link_id=None):
+
+    # the Client the instance talks through, None for the package level configuration (see Client.Entity)
+    _client = None
+
+    def __init__(self, source=None, entity_id=None, link_id=None, priority='default'):
         if source is None or not type(source) == str:
             raise ValueError("must create entity using get or create methods of Entity class")
+        validate_priority(priority)
+
+        # priority of the requests sent for the entity (see finbox_bankconnect.scheduler)
+        self.__priority = priority
 
         # basic identifiers
         self.__entity_id = entity_id
@@ -24,27 +114,47 @@ class Entity:
         self.__identity = dict()
 
         # lists to keep track of different transactions
-        self.__transactions = []
+        self.__transactions = TransactionStore()
         self.__credit_recurring = []
         self.__debit_recurring = []
-        self.__salary = []
-        self.__lender_transactions = []
+        self.__salary = TransactionStore()
+        self.__lender_transactions = TransactionStore()
 
         # lazy loading trackers
         self.__is_loaded = defaultdict(bool)
 
+        # guards the state updates when the instance is shared between threads
+        self.__lock = threading.RLock()
+
+        # held by the call creating the entity (the network requests are never sent holding the state lock)
+        self.__creation_lock = threading.Lock()
+
+        # statement progress signatures of the last incremental refresh of each store
+        self.__snapshots = dict()
+
+        # stores fetched for an (account_id, from_date, to_date) scope only, keyed by (name, scope),
+        # used till the full store of that name is loaded
+        self.__scoped = dict()
+
+        # compressed (or spilled) payloads evicted by the memory budget (see finbox_bankconnect.cache), by name
+        self.__evicted = dict()
+
+        # memory mapped snapshot backing the stores, if created using from_snapshot
+        self.__snapshot = None
+
         # set default lazy loading values based on instance creation source
         if source == 'c' and link_id is not None:
             self.__is_loaded['link_id'] = True
         elif source == 'g':
             self.__is_loaded['entity_id'] = True
 
-    @staticmethod
-    def get(entity_id):
+    @classmethod
+    def get(cls, entity_id, priority='default'):
         """Creates an entity with given entity_id and returns the instance
 
         arguments:
         entity_id -- the entity id string (UUID version 4)
+        priority (optional) (default: default) -- priority of the requests for the entity (interactive, default or backfill)
         """
         if not entity_id:
             raise ValueError("entity_id cannot be blank or None")
@@ -52,44 +162,177 @@ class Entity:
             raise ValueError("entity_id must be a string")
         if not is_valid_uuid4(entity_id):
             raise ValueError("invalid entity_id")
-        return Entity(source='g', entity_id=entity_id)
+        return cls(source='g', entity_id=entity_id, priority=priority)
 
-    @staticmethod
-    def create(link_id=None):
+    @classmethod
+    def create(cls, link_id=None, priority='default'):
         """Creates an entity with the optional link_id and returns the instance
 
         arguments:
         link_id (optional) -- the link_id string
+        priority (optional) (default: default) -- priority of the requests for the entity (interactive, default or backfill)
         """
         if link_id and not type(link_id) == str:
             raise ValueError("link_id must be a string")
-        return Entity(source='c', link_id=link_id)
+        return cls(source='c', link_id=link_id, priority=priority)
+
+    @classmethod
+    def create_many(cls, link_ids, max_workers=8, priority='default'):
+        """Creates entities for many distinct link_ids concurrently (at most max_workers requests at a time) and returns
+            a tuple (entities, errors), entities being a dictionary link_id -> Entity instance with entity_id
+            already created and errors a dictionary link_id -> exception for the link_ids which failed
+
+        arguments:
+        link_ids -- iterable of link_id strings
+        max_workers (optional) (default: 8) -- maximum number of concurrent requests
+        priority (optional) (default: default) -- priority of the requests for the entities
+        """
+        def resolve(link_id):
+            entity = cls.create(link_id, priority)
+            entity.entity_id
+            return entity
+        return _run_batch(resolve, link_ids, max_workers)
+
+    @classmethod
+    def get_many(cls, entity_ids, max_workers=8, priority='default'):
+        """Gets entities for many distinct entity_ids and fetches their link_ids concurrently (at most max_workers requests
+            at a time), returns a tuple (entities, errors), entities being a dictionary entity_id -> Entity instance
+            with link_id already fetched and errors a dictionary entity_id -> exception for the entity_ids which failed
+
+        arguments:
+        entity_ids -- iterable of entity id strings
+        max_workers (optional) (default: 8) -- maximum number of concurrent requests
+        priority (optional) (default: default) -- priority of the requests for the entities
+        """
+        def resolve(entity_id):
+            entity = cls.get(entity_id, priority)
+            entity.link_id
+            return entity
+        return _run_batch(resolve, entity_ids, max_workers)
+
+    @classmethod
+    def from_snapshot(cls, path, priority='default'):
+        """Creates an entity backed by a snapshot file written by write_snapshot and returns the instance,
+            the snapshot is memory mapped read-only so processes opening the same file share one copy of it
+
+        arguments:
+        path -- path of the snapshot file
+        priority (optional) (default: default) -- priority of the requests for the entity (interactive, default or backfill)
+        """
+        from finbox_bankconnect.snapshot import open_snapshot
+        return cls.__from_snapshot(open_snapshot(path), priority)
+
+    @classmethod
+    def loads(cls, data, priority='default'):
+        """Creates an entity from the bytes returned by dumps (in any process) and returns the instance, with the
+            data loaded before the dump served without fetching it again
+
+        arguments:
+        data -- bytes returned by dumps
+        priority (optional) (default: default) -- priority of the requests for the entity (interactive, default or backfill)
+        """
+        from finbox_bankconnect.snapshot import loads
+        return cls.__from_snapshot(loads(data), priority)
+
+    @classmethod
+    def __from_snapshot(cls, snapshot, priority):
+        meta = snapshot.meta
+        entity = cls(source='g', entity_id=meta['entity_id'], link_id=meta.get('link_id'), priority=priority)
+        for name in meta.get('loaded', []):
+            entity.__is_loaded[name] = True
+        entity.__accounts = meta.get('accounts', [])
+        entity.__fraud_info = meta.get('fraud_info', [])
+        entity.__identity = meta.get('identity', dict())
+        entity.__credit_recurring = meta.get('credit_recurring', [])
+        entity.__debit_recurring = meta.get('debit_recurring', [])
+        for name, table in snapshot.tables.items():
+            setattr(entity, '_Entity__' + name, TransactionStore(table, table.dates))
+        # keeps the mapping (or bytes) open for as long as the entity (and the rows handed out) may use it
+        entity.__snapshot = snapshot
+        return entity
+
+    def write_snapshot(self, path):
+        """Writes the data loaded so far for the given entity to a snapshot file (replaced atomically),
+            which can be opened by any process using Entity.from_snapshot
+
+        arguments:
+        path -- path of the snapshot file
+        """
+        from finbox_bankconnect import snapshot
+        snapshot.write(path, self.__snapshot_payloads())
+
+    def dumps(self):
+        """Returns the data loaded so far for the given entity (ids, load flags and fetched data) as compact
+            versioned bytes, e.g. to hand the loaded entity to another process, see Entity.loads
+        """
+        from finbox_bankconnect import snapshot
+        return snapshot.dumps(self.__snapshot_payloads())
+
+    def __reduce__(self):
+        # pickled (e.g. by multiprocessing) through dumps, an entity of a Client can't be as the client stays behind
+        if self._client is not None:
+            raise TypeError("entities of a Client can't be pickled, send entity.dumps() and use client.Entity.loads")
+        return (_load_entity, (self.dumps(), self.__priority))
+
+    def __snapshot_payloads(self):
+        # ids, load flags and loaded payloads, as written to snapshots
+        if not self.__is_loaded['entity_id']:
+            raise ValueError("no statement uploaded yet so use upload_statement method to set the entity_id")
+
+        from finbox_bankconnect import snapshot
+        for name in snapshot.TABLE_KEYS + ['credit_recurring', 'debit_recurring']:
+            self.__restore(name)
+        with self.__lock:
+            loaded = [name for name, is_loaded in self.__is_loaded.items() if is_loaded]
+            payloads = {
+                'entity_id': self.__entity_id,
+                'link_id': self.__link_id,
+                'loaded': loaded
+            }
+            for name in snapshot.META_KEYS + snapshot.TABLE_KEYS:
+                if name in loaded:
+                    payloads[name] = getattr(self, '_Entity__' + name)
+            return payloads
 
     @property
     def entity_id(self):
         """Returns the entity_id for the Entity instance"""
         if not self.__is_loaded['entity_id']:
-            if self.__is_loaded['link_id']:
-                # create an entity with the link_id and set it
-                self.__entity_id = connector.create_entity(self.__link_id)
-                self.__is_loaded['entity_id'] = True
-            else:
-                raise ValueError("no statement uploaded yet so use upload_statement method to set the entity_id")
+            with self.__creation_lock:
+                if self.__is_loaded['entity_id']:
+                    # created by another thread meanwhile
+                    pass
+                elif self.__is_loaded['link_id']:
+                    with request_priority(self.__priority):
+                        self.__create_entity()
+                else:
+                    raise ValueError("no statement uploaded yet so use upload_statement method to set the entity_id")
         return self.__entity_id
 
+    def __create_entity(self):
+        # creates an entity with the link_id and sets it, called holding the creation lock
+        entity_id = connector.create_entity(self.__link_id, client=self._client)
+        with self.__lock:
+            self.__entity_id = entity_id
+            self.__is_loaded['entity_id'] = True
+        return entity_id
+
     @property
     def link_id(self):
         """Returns the link_id for the Entity instance"""
         if not self.__is_loaded['link_id']:
             if self.__is_loaded['entity_id']:
                 # fetch the link id for the entity id and set it
-                self.__link_id = connector.get_link_id(self.__entity_id) # fetch link id for the given entity
-                self.__is_loaded['link_id'] = True
+                with request_priority(self.__priority):
+                    link_id = _flights.do((self._client, self.__entity_id, 'get_link_id'), connector.get_link_id, self.__entity_id, self._client)
+                with self.__lock:
+                    self.__link_id = link_id
+                    self.__is_loaded['link_id'] = True
             else:
                 raise ValueError("no statement uploaded yet so use upload_statement method to set the link_id")
         return self.__link_id
 
-    def upload_statement(self, file_path, pdf_password=None, bank_name=None):
+    def upload_statement(self, file_path, pdf_password=None, bank_name=None, deadline=None, preflight=None):
         """Uploads the statement for the given entity instance, creates entity if required too
             if successfully uploaded, then returns a boolean indicating whether uploaded statement was
             authentic
@@ -98,7 +341,11 @@ class Entity:
         file_path -- path of the pdf file
         pdf_password (optional) -- pdf password string
         bank_name (optional) -- bank name string
+        deadline (optional) -- seconds (or a finbox_bankconnect.deadline.Deadline, which can be cancelled) for the whole call
+        preflight (optional) -- True to check the file locally first (see finbox_bankconnect.preflight), None for the upload_preflight setting
         """
+        deadline = resolve_deadline(deadline)
+
         if not file_path:
             raise ValueError("file_path cannot be blank or None")
         if not type(file_path) == str:
@@ -114,24 +361,36 @@ class Entity:
         if bank_name == "":
             bank_name = None
 
-        with open(file_path, 'rb') as file_obj: #throws IOError if file is unaccessible or doesn't exists
-
-            if self.__is_loaded['link_id'] and not self.__is_loaded['entity_id']:
-                # create an entity with the link_id and set it
-                self.__entity_id = connector.create_entity(self.__link_id)
-                self.__is_loaded['entity_id'] = True
+        if preflight is None:
+            config = finbox_bankconnect if self._client is None else self._client
+            preflight = getattr(config, 'upload_preflight', False)
+        if preflight:
+            # raises the error the API would fail the upload with, without sending the file
+            preflight_checks.validate(file_path, pdf_password)
 
-            is_authentic, entity_id, identity = connector.upload_file(self.__entity_id, file_obj, pdf_password, bank_name)
-            if not self.__is_loaded['entity_id']:
-                self.__entity_id = entity_id
-                self.__is_loaded['entity_id'] = True
+        with open(file_path, 'rb') as file_obj, request_priority(self.__priority), within(deadline): #throws IOError if file is unaccessible or doesn't exists
 
-            self.__is_loaded['identity'] = identity
-            self.__identity = identity
+            if self.__is_loaded['entity_id']:
+                is_authentic, entity_id, identity = connector.upload_file(self.__entity_id, file_obj, pdf_password, bank_name, client=self._client)
+            else:
+                # the upload creating the entity goes first, the concurrent ones then upload to that entity
+                with self.__creation_lock:
+                    if self.__is_loaded['link_id'] and not self.__is_loaded['entity_id']:
+                        # create an entity with the link_id and set it
+                        self.__create_entity()
+                    is_authentic, entity_id, identity = connector.upload_file(self.__entity_id, file_obj, pdf_password, bank_name, client=self._client)
+                    with self.__lock:
+                        if not self.__is_loaded['entity_id']:
+                            self.__entity_id = entity_id
+                            self.__is_loaded['entity_id'] = True
+
+            with self.__lock:
+                self.__is_loaded['identity'] = identity
+                self.__identity = identity
 
         return is_authentic
 
-    def get_transactions(self, reload=False, account_id=None, from_date=None, to_date=None):
+    def get_transactions(self, reload=False, account_id=None, from_date=None, to_date=None, where=None, incremental=False, deadline=None):
         """Fetches and returns the iterator to transactions (list of dictionary) for the given entity
 
         arguments:
@@ -139,7 +398,12 @@ class Entity:
         account_id (optional) -- get transactions for specific account_id
         from_date (optional) -- get transactions greater than or equal to from_date (must be datetime.date)
         to_date (optional) -- get transactions less than or equal to to_date (must be datetime.date)
+        where (optional) -- get transactions matching a filter expression (finbox_bankconnect.filters.Filter)
+        incremental (optional) (default: False) -- on reload, merge only the rows changed since the last fetch into the cached data
+        deadline (optional) -- seconds (or a finbox_bankconnect.deadline.Deadline, which can be cancelled) for the whole call
         """
+        deadline = resolve_deadline(deadline)
+
         if not self.__is_loaded['entity_id']:
             raise ValueError("no statement uploaded yet so use upload_statement method to set the entity_id")
 
@@ -154,217 +418,351 @@ class Entity:
             if not type(to_date) == datetime.date:
                 raise ValueError("to_date if provided must be a python datetime.date object")
 
-        if reload or not self.__is_loaded['transactions']:
-            timer_start = time.time()
-            while time.time() < timer_start + finbox_bankconnect.poll_timeout: # keep polling till timeout happens
-                status, accounts, fraud_info, transactions = connector.get_transactions(self.__entity_id)
-                if status == "failed":
-                    raise ExtractionFailedError
-                elif status == "not_found":
-                    raise EntityNotFoundError
-                elif status == "completed":
-                    # save accounts
-                    self.__accounts = accounts
-                    self.__is_loaded['accounts'] = True
-                    # save fraud info
-                    self.__fraud_info = fraud_info
-                    self.__is_loaded['fraud_info'] = True
-                    # save transaction info
-                    self.__transactions = transactions
-                    self.__is_loaded['transactions'] = True
-                    break
-                time.sleep(finbox_bankconnect.poll_interval) # delay of finbox_bankconnect.poll_interval
-
-            if not self.__is_loaded['transactions']:
-                # if even after polling couldn't get transactions
-                raise ServiceTimeOutError
-
-        if account_id is not None:
-            account_id_filter = make_account_id_filter(account_id)
-            return filter(account_id_filter, self.__transactions)
-
-        if from_date is not None or to_date is not None:
-            daterange_filter = make_daterange_filter(from_date, to_date)
-            return filter(daterange_filter, self.__transactions)
-
-        return iter(self.__transactions)
-
-    def get_identity(self, reload=False):
+        if where is not None and not isinstance(where, Filter):
+            raise ValueError("where if provided must be a filter expression (finbox_bankconnect.filters.Filter)")
+
+        self.__restore('transactions')
+        scope = (account_id, from_date, to_date)
+        if not self.__is_loaded['transactions'] and not scope == (None, None, None):
+            # fetch only the scope instead of all the rows
+            store = self.__scoped_store('transactions', connector.get_transactions, scope, reload, deadline)
+        else:
+            if reload or not self.__is_loaded['transactions']:
+                if incremental and self.__is_loaded['transactions']:
+                    # merge only the changed rows into the cached store
+                    self.__refresh_store(self.__transactions, 'transactions', connector.get_transactions, deadline)
+                else:
+                    self.__load_store('transactions', connector.get_transactions, deadline)
+            store = self.__transactions
+
+        return store.select(build_filter(account_id, from_date, to_date, where))
+
+    def get_identity(self, reload=False, deadline=None):
         """Fetches and returns the identity dictionary (one) for the given entity
 
         arguments:
         reload (optional) (default: False) -- do not use cached data and refetch from API
+        deadline (optional) -- seconds (or a finbox_bankconnect.deadline.Deadline, which can be cancelled) for the whole call
         """
+        deadline = resolve_deadline(deadline)
+
         if not self.__is_loaded['entity_id']:
             raise ValueError("no statement uploaded yet so use upload_statement method to set the entity_id")
 
         if reload or not self.__is_loaded['identity']:
-            timer_start = time.time()
-            while time.time() < timer_start + finbox_bankconnect.poll_timeout: # keep polling till timeout happens
-                status, accounts, fraud_info, identity = connector.get_identity(self.__entity_id)
-                if status == "failed":
-                    raise ExtractionFailedError
-                elif status == "not_found":
-                    raise EntityNotFoundError
-                elif status == "completed":
-                    # save accounts
-                    self.__accounts = accounts
-                    self.__is_loaded['accounts'] = True
-                    # save fraud info
-                    self.__fraud_info = fraud_info
-                    self.__is_loaded['fraud_info'] = True
-                    # save identity info
-                    self.__identity = identity
-                    self.__is_loaded['identity'] = True
-                    break
-                time.sleep(finbox_bankconnect.poll_interval) # delay of finbox_bankconnect.poll_interval
-
-            if not self.__is_loaded['identity']:
-                # if even after polling couldn't get identity
-                raise ServiceTimeOutError
+            identity, = self.__poll(connector.get_identity, deadline=deadline)
+            with self.__lock:
+                self.__identity = identity
+                self.__is_loaded['identity'] = True
+            self.__index_accounts()
 
         return self.__identity
 
-    def get_accounts(self, reload=False):
+    def get_accounts(self, reload=False, where=None, deadline=None):
         """Fetches and returns the iterator to accounts (list of dictionary) for the given entity
 
         arguments:
         reload (optional) (default: False) -- do not use cached data and refetch from API
+        where (optional) -- get accounts matching a filter expression (finbox_bankconnect.filters.Filter)
+        deadline (optional) -- seconds (or a finbox_bankconnect.deadline.Deadline, which can be cancelled) for the whole call
         """
+        deadline = resolve_deadline(deadline)
+
         if not self.__is_loaded['entity_id']:
             raise ValueError("no statement uploaded yet so use upload_statement method to set the entity_id")
 
+        if where is not None and not isinstance(where, Filter):
+            raise ValueError("where if provided must be a filter expression (finbox_bankconnect.filters.Filter)")
+
         if reload or not self.__is_loaded['accounts']:
-            timer_start = time.time()
-            while time.time() < timer_start + finbox_bankconnect.poll_timeout: # keep polling till timeout happens
-                status, accounts, fraud_info = connector.get_accounts(self.__entity_id)
-                if status == "failed":
-                    raise ExtractionFailedError
-                elif status == "not_found":
-                    raise EntityNotFoundError
-                elif status == "completed":
-                    # save accounts
-                    self.__accounts = accounts
-                    self.__is_loaded['accounts'] = True
-                    # save fraud info
-                    self.__fraud_info = fraud_info
-                    self.__is_loaded['fraud_info'] = True
-                    break
-                time.sleep(finbox_bankconnect.poll_interval) # delay of finbox_bankconnect.poll_interval
-
-            if not self.__is_loaded['accounts']:
-                # if even after polling couldn't get accounts
-                raise ServiceTimeOutError
-
-        return iter(self.__accounts)
-
-    def get_fraud_info(self, reload=False):
+            self.__poll(connector.get_accounts, deadline=deadline)
+            self.__index_accounts()
+
+        return apply_filter(where, self.__accounts)
+
+    def get_fraud_info(self, reload=False, where=None, deadline=None):
         """Fetches and returns the iterator to fraud info (list of dictionary) for the given entity
 
         arguments:
         reload (optional) (default: False) -- do not use cached data and refetch from API
+        where (optional) -- get fraud info matching a filter expression (finbox_bankconnect.filters.Filter)
+        deadline (optional) -- seconds (or a finbox_bankconnect.deadline.Deadline, which can be cancelled) for the whole call
         """
+        deadline = resolve_deadline(deadline)
+
         if not self.__is_loaded['entity_id']:
             raise ValueError("no statement uploaded yet so use upload_statement method to set the entity_id")
 
+        if where is not None and not isinstance(where, Filter):
+            raise ValueError("where if provided must be a filter expression (finbox_bankconnect.filters.Filter)")
+
         if reload or not self.__is_loaded['fraud_info']:
-            timer_start = time.time()
-            while time.time() < timer_start + finbox_bankconnect.poll_timeout: # keep polling till timeout happens
-                status, accounts, fraud_info = connector.get_accounts(self.__entity_id)
-                if status == "failed":
-                    raise ExtractionFailedError
-                elif status == "not_found":
-                    raise EntityNotFoundError
-                elif status == "completed":
-                    # save accounts
-                    self.__accounts = accounts
-                    self.__is_loaded['accounts'] = True
-                    # save fraud info
-                    self.__fraud_info = fraud_info
-                    self.__is_loaded['fraud_info'] = True
-                    break
-                time.sleep(finbox_bankconnect.poll_interval) # delay of finbox_bankconnect.poll_interval
-
-            if not self.__is_loaded['fraud_info']:
-                # if even after polling couldn't get fraud info
-                raise ServiceTimeOutError
-
-        return iter(self.__fraud_info)
-
-    def __fetch_recurring(self):
+            self.__poll(connector.get_accounts, deadline=deadline)
+            self.__index_accounts()
+
+        return apply_filter(where, self.__fraud_info)
+
+    def __poll(self, fetch_function, scope=(), deadline=None):
+
+        # internal function to poll the given connector function till the entity is processed (sharing
+        # the fetch with concurrent callers), saves the accounts and fraud info and returns the rest of the response
+
+        with request_priority(self.__priority), within(deadline):
+            response = _flights.do((self._client, self.__entity_id, fetch_function.__name__) + scope, _poll, fetch_function,
+                self.__entity_id, self._client, scope)
+        if scope:
+            # the accounts and fraud info of a scoped response may cover the scope only
+            return response[3:]
+        with self.__lock:
+            # save accounts
+            self.__accounts = response[1]
+            self.__is_loaded['accounts'] = True
+            # save fraud info
+            self.__fraud_info = response[2]
+            self.__is_loaded['fraud_info'] = True
+        return response[3:]
+
+    def __index_accounts(self):
+        # adds the fetched accounts (and identity if fetched) to the account index if enabled (see finbox_bankconnect.account_index)
+        config = finbox_bankconnect if self._client is None else self._client
+        path = getattr(config, 'account_index_path', None)
+        if path is None:
+            return
+        identity = self.__identity if self.__is_loaded['identity'] else None
+        account_index.index_entity(path, self.__entity_id, self.__accounts, identity)
+
+    def __derived(self, name, reload, incremental, deadline):
+
+        # internal function deriving the salary, lender and recurring views from the transactions if the
+        # derived_views setting is on (see finbox_bankconnect.views), returns False if the endpoint of name is to be used
+
+        config = finbox_bankconnect if self._client is None else self._client
+        if not getattr(config, 'derived_views', False):
+            return False
+        if self.__is_loaded[name] and not reload:
+            return True
+
+        self.__restore('transactions')
+        if reload or not self.__is_loaded['transactions']:
+            if incremental and self.__is_loaded['transactions']:
+                self.__refresh_store(self.__transactions, 'transactions', connector.get_transactions, deadline)
+            else:
+                self.__load_store('transactions', connector.get_transactions, deadline)
+        derived = views.derive(self.__transactions)
+        if derived is None:
+            # not tagged with categories
+            metrics.increment('derived_views_fallbacks')
+            return False
+
+        self.__set_store('salary', derived['salary'])
+        self.__set_store('lender_transactions', derived['lender_transactions'])
+        metrics.increment('derived_views')
+        if derived['credit_recurring'] is None:
+            # not tagged with recurring groups, the recurring views keep their endpoint
+            if name in ('credit_recurring', 'debit_recurring'):
+                metrics.increment('derived_views_fallbacks')
+                return False
+            return True
+        with self.__lock:
+            self.__credit_recurring = derived['credit_recurring']
+            self.__is_loaded['credit_recurring'] = True
+            self.__debit_recurring = derived['debit_recurring']
+            self.__is_loaded['debit_recurring'] = True
+            self.__drop_evicted('credit_recurring')
+            self.__drop_evicted('debit_recurring')
+        self.__track('credit_recurring', 'debit_recurring')
+        return True
+
+    def __scoped_store(self, name, fetch_function, scope, reload, deadline):
+
+        # internal function returning the store with only the rows of the scope (account_id, from_date, to_date),
+        # fetched with the scope passed to the API (the caller still filters the rows in case the API ignored it)
+
+        key = (name,) + scope
+        store = self.__scoped.get(key)
+        if reload or store is None:
+            store = TransactionStore(self.__poll(fetch_function, scope, deadline)[0])
+            with self.__lock:
+                self.__scoped[key] = store
+        return store
+
+    def __set_store(self, name, store):
+
+        # internal function to save a fully fetched store, dropping the scoped stores it supersedes
+
+        with self.__lock:
+            setattr(self, '_Entity__' + name, store)
+            self.__is_loaded[name] = True
+            self.__scoped = dict((key, value) for key, value in self.__scoped.items() if not key[0] == name)
+            self.__drop_evicted(name)
+        self.__track(name)
+
+    def __load_store(self, name, fetch_function, deadline):
+
+        # internal function to fetch all the rows of name, recording the statement progress they were fetched at
+        # so that a later incremental refresh doesn't fetch them again if nothing changed
+
+        rows, progress = self.__poll(fetch_function, deadline=deadline)
+        self.__set_store(name, TransactionStore(rows))
+        with self.__lock:
+            self.__snapshots[name] = progress_signature(progress)
+
+    def __refresh_store(self, store, name, fetch_function, deadline):
+
+        # internal function for incremental refresh of a cached store, the API doesn't send deltas so the
+        # (cheap) statement progress is checked first and the rows are re-fetched only if it changed since
+        # the last snapshot, then diffed against the store so only the new rows are parsed and indexed
+
+        progress, = self.__poll(connector.get_progress, deadline=deadline)
+        signature = progress_signature(progress)
+        if self.__snapshots.get(name) == signature:
+            return
+        rows, progress = self.__poll(fetch_function, deadline=deadline)
+        with self.__lock:
+            store.merge(rows)
+            self.__snapshots[name] = progress_signature(progress)
+        self.__track(name)
+
+    def __fetch_recurring(self, deadline):
 
         # internal function to update the credit and debit recurring
 
         if not self.__is_loaded['entity_id']:
             raise ValueError("no statement uploaded yet so use upload_statement method to set the entity_id")
 
-        timer_start = time.time()
-        while time.time() < timer_start + finbox_bankconnect.poll_timeout: # keep polling till timeout happens
-            status, accounts, fraud_info, credit_recurring, debit_recurring = connector.get_recurring(self.__entity_id)
-            if status == "failed":
-                raise ExtractionFailedError
-            elif status == "not_found":
-                raise EntityNotFoundError
-            elif status == "completed":
-                # save accounts
-                self.__accounts = accounts
-                self.__is_loaded['accounts'] = True
-                # save fraud info
-                self.__fraud_info = fraud_info
-                self.__is_loaded['fraud_info'] = True
-                # save info
-                self.__credit_recurring = credit_recurring
-                self.__is_loaded['credit_recurring'] = True
-                self.__debit_recurring = debit_recurring
-                self.__is_loaded['debit_recurring'] = True
-                break
-            time.sleep(finbox_bankconnect.poll_interval) # delay of finbox_bankconnect.poll_interval
-
-        if not self.__is_loaded['credit_recurring']:
-            # if even after polling couldn't get
-            raise ServiceTimeOutError
-
-    def get_credit_recurring(self, reload=False, account_id=None):
+        credit_recurring, debit_recurring = self.__poll(connector.get_recurring, deadline=deadline)
+        with self.__lock:
+            self.__credit_recurring = credit_recurring
+            self.__is_loaded['credit_recurring'] = True
+            self.__debit_recurring = debit_recurring
+            self.__is_loaded['debit_recurring'] = True
+            self.__drop_evicted('credit_recurring')
+            self.__drop_evicted('debit_recurring')
+        self.__track('credit_recurring', 'debit_recurring')
+
+    def __track(self, *names):
+
+        # internal function to account the loaded payloads against the memory budget (finbox_bankconnect.cache),
+        # which may evict idle payloads of the other entities if over it (called without holding the lock)
+
+        for name in names:
+            value = getattr(self, '_Entity__' + name)
+            if isinstance(value, TransactionStore):
+                if not isinstance(value.rows, list):
+                    # snapshot backed, not on the heap
+                    continue
+                size = cache.estimate_size(value.rows) + cache.estimate_size(value.dates)
+            else:
+                size = cache.estimate_size(value)
+            cache.budget.track(self, name, size)
+        cache.budget.enforce(exclude=self)
+
+    def __drop_evicted(self, name):
+
+        # internal function to forget the evicted payload of name, replaced by freshly fetched data (called holding the lock)
+
+        if self.__evicted.pop(name, None) is not None:
+            cache.budget.restored(self, name)
+
+    def __restore(self, name):
+
+        # internal function to reload the payload of name if the memory budget evicted it, or to mark it for
+        # fetching again if it can't be reloaded (e.g. its spill file was removed)
+
+        with self.__lock:
+            packed = self.__evicted.pop(name, None)
+            if packed is None:
+                cache.budget.touch(self, name)
+                return
+            cache.budget.restored(self, name)
+            payload = packed.load()
+            if payload is None:
+                self.__is_loaded[name] = False
+                metrics.increment('cache_refetches')
+                return
+            if name in ('credit_recurring', 'debit_recurring'):
+                setattr(self, '_Entity__' + name, payload)
+            else:
+                rows, dates = payload
+                setattr(self, '_Entity__' + name, TransactionStore(rows, dates))
+            metrics.increment('cache_restores')
+        self.__track(name)
+
+    def _cache_evict(self, name):
+
+        # called by the memory budget (finbox_bankconnect.cache) to compress or spill the idle payload of name,
+        # skipped if the entity is busy in another thread since its data is in use then
+
+        if not self.__lock.acquire(False):
+            return
+        try:
+            if name in self.__evicted or not self.__is_loaded[name]:
+                return
+            value = getattr(self, '_Entity__' + name)
+            if isinstance(value, TransactionStore):
+                payload = (value.rows, value.dates)
+                empty = TransactionStore()
+            else:
+                payload = value
+                empty = []
+            packed = cache.PackedPayload(payload, finbox_bankconnect.cache_spill_directory)
+            setattr(self, '_Entity__' + name, empty)
+            self.__evicted[name] = packed
+            cache.budget.evicted(self, name, packed)
+            # the transport keeps the same rows for conditional requests, which would keep them in memory
+            connector.forget_resource(self.__entity_id, _RESOURCES.get(name, name), client=self._client)
+        finally:
+            self.__lock.release()
+
+    def get_credit_recurring(self, reload=False, account_id=None, where=None, deadline=None):
         """Fetches and returns the iterator to credit recurring transactions (list of dictionary) for the given entity
 
         arguments:
         reload (optional) (default: False) -- do not use cached data and refetch from API
         account_id (optional) -- get credit recurring transactions for specific account_id
+        where (optional) -- get credit recurring transactions matching a filter expression (finbox_bankconnect.filters.Filter)
+        deadline (optional) -- seconds (or a finbox_bankconnect.deadline.Deadline, which can be cancelled) for the whole call
         """
+        deadline = resolve_deadline(deadline)
+
         if account_id is not None:
             if not is_valid_uuid4(account_id):
                 raise ValueError("account_id if provided must be a valid UUID4 string")
 
-        if reload or not self.__is_loaded['credit_recurring']:
-            self.__fetch_recurring()
+        if where is not None and not isinstance(where, Filter):
+            raise ValueError("where if provided must be a filter expression (finbox_bankconnect.filters.Filter)")
 
-        if account_id is not None:
-            account_id_filter = make_account_id_filter(account_id)
-            return filter(account_id_filter, self.__credit_recurring)
+        self.__restore('credit_recurring')
+        if not self.__derived('credit_recurring', reload, False, deadline) and (reload or not self.__is_loaded['credit_recurring']):
+            self.__fetch_recurring(deadline)
 
-        return iter(self.__credit_recurring)
+        return apply_filter(build_filter(account_id, where=where), self.__credit_recurring)
 
-    def get_debit_recurring(self, reload=False, account_id=None):
+    def get_debit_recurring(self, reload=False, account_id=None, where=None, deadline=None):
         """Fetches and returns the iterator to debit recurring transactions (list of dictionary) for the given entity
 
         arguments:
         reload (optional) (default: False) -- do not use cached data and refetch from API
         account_id (optional) -- get debit recurring transactions for specific account_id
+        where (optional) -- get debit recurring transactions matching a filter expression (finbox_bankconnect.filters.Filter)
+        deadline (optional) -- seconds (or a finbox_bankconnect.deadline.Deadline, which can be cancelled) for the whole call
         """
+        deadline = resolve_deadline(deadline)
+
         if account_id is not None:
             if not is_valid_uuid4(account_id):
                 raise ValueError("account_id if provided must be a valid UUID4 string")
 
-        if reload or not self.__is_loaded['debit_recurring']:
-            self.__fetch_recurring()
+        if where is not None and not isinstance(where, Filter):
+            raise ValueError("where if provided must be a filter expression (finbox_bankconnect.filters.Filter)")
 
-        if account_id is not None:
-            account_id_filter = make_account_id_filter(account_id)
-            return filter(account_id_filter, self.__debit_recurring)
+        self.__restore('debit_recurring')
+        if not self.__derived('debit_recurring', reload, False, deadline) and (reload or not self.__is_loaded['debit_recurring']):
+            self.__fetch_recurring(deadline)
 
-        return iter(self.__debit_recurring)
+        return apply_filter(build_filter(account_id, where=where), self.__debit_recurring)
 
-    def get_salary(self, reload=False, account_id=None, from_date=None, to_date=None):
+    def get_salary(self, reload=False, account_id=None, from_date=None, to_date=None, where=None, incremental=False, deadline=None):
         """Fetches and returns the iterator to salary transactions (list of dictionary) for the given entity
 
         arguments:
@@ -372,7 +770,12 @@ class Entity:
         account_id (optional) -- get salary transactions for specific account_id
         from_date (optional) -- get salary transactions greater than or equal to from_date (must be datetime.date)
         to_date (optional) -- get salary transactions less than or equal to to_date (must be datetime.date)
+        where (optional) -- get salary transactions matching a filter expression (finbox_bankconnect.filters.Filter)
+        incremental (optional) (default: False) -- on reload, merge only the rows changed since the last fetch into the cached data
+        deadline (optional) -- seconds (or a finbox_bankconnect.deadline.Deadline, which can be cancelled) for the whole call
         """
+        deadline = resolve_deadline(deadline)
+
         if not self.__is_loaded['entity_id']:
             raise ValueError("no statement uploaded yet so use upload_statement method to set the entity_id")
 
@@ -387,42 +790,28 @@ class Entity:
             if not type(to_date) == datetime.date:
                 raise ValueError("to_date if provided must be a python datetime.date object")
 
-        if reload or not self.__is_loaded['salary']:
-            timer_start = time.time()
-            while time.time() < timer_start + finbox_bankconnect.poll_timeout: # keep polling till timeout happens
-                status, accounts, fraud_info, salary = connector.get_salary(self.__entity_id)
-                if status == "failed":
-                    raise ExtractionFailedError
-                elif status == "not_found":
-                    raise EntityNotFoundError
-                elif status == "completed":
-                    # save accounts
-                    self.__accounts = accounts
-                    self.__is_loaded['accounts'] = True
-                    # save fraud info
-                    self.__fraud_info = fraud_info
-                    self.__is_loaded['fraud_info'] = True
-                    # save info
-                    self.__salary = salary
-                    self.__is_loaded['salary'] = True
-                    break
-                time.sleep(finbox_bankconnect.poll_interval) # delay of finbox_bankconnect.poll_interval
-
-            if not self.__is_loaded['salary']:
-                # if even after polling couldn't get
-                raise ServiceTimeOutError
-
-        if account_id is not None:
-            account_id_filter = make_account_id_filter(account_id)
-            return filter(account_id_filter, self.__salary)
-
-        if from_date is not None or to_date is not None:
-            daterange_filter = make_daterange_filter(from_date, to_date)
-            return filter(daterange_filter, self.__salary)
-
-        return iter(self.__salary)
-
-    def get_lender_transactions(self, reload=False, account_id=None, from_date=None, to_date=None):
+        if where is not None and not isinstance(where, Filter):
+            raise ValueError("where if provided must be a filter expression (finbox_bankconnect.filters.Filter)")
+
+        self.__restore('salary')
+        scope = (account_id, from_date, to_date)
+        if self.__derived('salary', reload, incremental, deadline):
+            store = self.__salary
+        elif not self.__is_loaded['salary'] and not scope == (None, None, None):
+            # fetch only the scope instead of all the rows
+            store = self.__scoped_store('salary', connector.get_salary, scope, reload, deadline)
+        else:
+            if reload or not self.__is_loaded['salary']:
+                if incremental and self.__is_loaded['salary']:
+                    # merge only the changed rows into the cached store
+                    self.__refresh_store(self.__salary, 'salary', connector.get_salary, deadline)
+                else:
+                    self.__load_store('salary', connector.get_salary, deadline)
+            store = self.__salary
+
+        return store.select(build_filter(account_id, from_date, to_date, where))
+
+    def get_lender_transactions(self, reload=False, account_id=None, from_date=None, to_date=None, where=None, incremental=False, deadline=None):
         """Fetches and returns the iterator to lender transactions (list of dictionary) for the given entity
 
         arguments:
@@ -430,7 +819,12 @@ class Entity:
         account_id (optional) -- get lender transactions for specific account_id
         from_date (optional) -- get lender transactions greater than or equal to from_date (must be datetime.date)
         to_date (optional) -- get lender transactions less than or equal to to_date (must be datetime.date)
+        where (optional) -- get lender transactions matching a filter expression (finbox_bankconnect.filters.Filter)
+        incremental (optional) (default: False) -- on reload, merge only the rows changed since the last fetch into the cached data
+        deadline (optional) -- seconds (or a finbox_bankconnect.deadline.Deadline, which can be cancelled) for the whole call
         """
+        deadline = resolve_deadline(deadline)
+
         if not self.__is_loaded['entity_id']:
             raise ValueError("no statement uploaded yet so use upload_statement method to set the entity_id")
 
@@ -445,37 +839,23 @@ class Entity:
             if not type(to_date) == datetime.date:
                 raise ValueError("to_date if provided must be a python datetime.date object")
 
-        if reload or not self.__is_loaded['lender_transactions']:
-            timer_start = time.time()
-            while time.time() < timer_start + finbox_bankconnect.poll_timeout: # keep polling till timeout happens
-                status, accounts, fraud_info, lender_transactions = connector.get_lender_transactions(self.__entity_id)
-                if status == "failed":
-                    raise ExtractionFailedError
-                elif status == "not_found":
-                    raise EntityNotFoundError
-                elif status == "completed":
-                    # save accounts
-                    self.__accounts = accounts
-                    self.__is_loaded['accounts'] = True
-                    # save fraud info
-                    self.__fraud_info = fraud_info
-                    self.__is_loaded['fraud_info'] = True
-                    # save info
-                    self.__lender_transactions = lender_transactions
-                    self.__is_loaded['lender_transactions'] = True
-                    break
-                time.sleep(finbox_bankconnect.poll_interval) # delay of finbox_bankconnect.poll_interval
-
-            if not self.__is_loaded['lender_transactions']:
-                # if even after polling couldn't get
-                raise ServiceTimeOutError
-
-        if account_id is not None:
-            account_id_filter = make_account_id_filter(account_id)
-            return filter(account_id_filter, self.__lender_transactions)
-
-        if from_date is not None or to_date is not None:
-            daterange_filter = make_daterange_filter(from_date, to_date)
-            return filter(daterange_filter, self.__lender_transactions)
-
-        return iter(self.__lender_transactions)
+        if where is not None and not isinstance(where, Filter):
+            raise ValueError("where if provided must be a filter expression (finbox_bankconnect.filters.Filter)")
+
+        self.__restore('lender_transactions')
+        scope = (account_id, from_date, to_date)
+        if self.__derived('lender_transactions', reload, incremental, deadline):
+            store = self.__lender_transactions
+        elif not self.__is_loaded['lender_transactions'] and not scope == (None, None, None):
+            # fetch only the scope instead of all the rows
+            store = self.__scoped_store('lender_transactions', connector.get_lender_transactions, scope, reload, deadline)
+        else:
+            if reload or not self.__is_loaded['lender_transactions']:
+                if incremental and self.__is_loaded['lender_transactions']:
+                    # merge only the changed rows into the cached store
+                    self.__refresh_store(self.__lender_transactions, 'lender_transactions', connector.get_lender_transactions, deadline)
+                else:
+                    self.__load_store('lender_transactions', connector.get_lender_transactions, deadline)
+            store = self.__lender_transactions
+
+        return store.select(build_filter(account_id, from_date, to_date, where))
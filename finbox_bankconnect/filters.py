@@ -1,4 +1,7 @@
+import abc
 import datetime
+import re
+from finbox_bankconnect.utils import parse_date
 
 def make_account_id_filter(account_id):
     def account_id_filter(row):
@@ -20,3 +23,280 @@ def make_daterange_filter(from_date, to_date):
             check_to = curr_date <= to_date
         return check_from and check_to
     return daterange_filter
+
+def make_date_filter(from_date, to_date):
+    # same as make_daterange_filter on the dates pre-parsed by the TransactionStore, None being an invalid date
+    def date_filter(curr_date):
+        if curr_date is None:
+            # invalid date format
+            return False
+        check_from = True
+        check_to = True
+        if from_date is not None:
+            check_from = from_date <= curr_date
+        if to_date is not None:
+            check_to = curr_date <= to_date
+        return check_from and check_to
+    return date_filter
+
+class Filter(abc.ABC):
+    """Base class for filter expressions accepted by the Entity getters (where argument)
+
+    Filters can be combined using & (and), | (or) and ~ (not), for example:
+    AccountId(account_id) & DateRange(from_date=from_date) & ~TransactionType('debit')
+
+    A filter expression is compiled into one fused function before being applied, with the
+    cheapest predicates being checked first.
+    """
+
+    # relative cost of evaluating the predicate for one row, used to order predicates
+    cost = 1
+
+    def __and__(self, other):
+        return And(self, other)
+
+    def __or__(self, other):
+        return Or(self, other)
+
+    def __invert__(self):
+        return Not(self)
+
+    @abc.abstractmethod
+    def compile(self):
+        """Returns a function taking a row and its pre-parsed date and returning a boolean"""
+
+    @abc.abstractmethod
+    def mask(self, store):
+        """Returns a numpy boolean array over the rows of given TransactionStore, using its columns
+
+        arguments:
+        store -- the TransactionStore to build the mask for
+        """
+
+class AccountId(Filter):
+    """Filters rows belonging to the given account_id"""
+
+    def __init__(self, account_id):
+        self.account_id = account_id
+
+    def compile(self):
+        account_id = self.account_id
+        def account_id_filter(row, curr_date):
+            return row.get('account_id') == account_id
+        return account_id_filter
+
+    def mask(self, store):
+        return store.column('account_id') == self.account_id
+
+class DateRange(Filter):
+    """Filters rows with date in the given range (both ends inclusive and optional)"""
+
+    def __init__(self, from_date=None, to_date=None):
+        self.from_date = from_date
+        self.to_date = to_date
+
+    def compile(self):
+        date_filter = make_date_filter(self.from_date, self.to_date)
+        def fused_daterange_filter(row, curr_date):
+            return date_filter(curr_date)
+        return fused_daterange_filter
+
+    def mask(self, store):
+        np = store.numpy
+        dates = store.date_column()
+        result = ~np.isnat(dates)
+        if self.from_date is not None:
+            result &= dates >= np.datetime64(self.from_date, 'D')
+        if self.to_date is not None:
+            result &= dates <= np.datetime64(self.to_date, 'D')
+        return result
+
+class AmountRange(Filter):
+    """Filters rows with amount in the given range (both ends inclusive and optional)"""
+
+    def __init__(self, min_amount=None, max_amount=None):
+        self.min_amount = min_amount
+        self.max_amount = max_amount
+
+    def compile(self):
+        min_amount = self.min_amount
+        max_amount = self.max_amount
+        def amount_filter(row, curr_date):
+            amount = row.get('amount')
+            if amount is None:
+                return False
+            if min_amount is not None and amount < min_amount:
+                return False
+            if max_amount is not None and amount > max_amount:
+                return False
+            return True
+        return amount_filter
+
+    def mask(self, store):
+        amounts = store.number_column('amount')
+        result = ~store.numpy.isnan(amounts)
+        if self.min_amount is not None:
+            result &= amounts >= self.min_amount
+        if self.max_amount is not None:
+            result &= amounts <= self.max_amount
+        return result
+
+class TransactionType(Filter):
+    """Filters rows with the given transaction_type (credit or debit)"""
+
+    def __init__(self, transaction_type):
+        self.transaction_type = transaction_type
+
+    def compile(self):
+        transaction_type = self.transaction_type
+        def transaction_type_filter(row, curr_date):
+            return row.get('transaction_type') == transaction_type
+        return transaction_type_filter
+
+    def mask(self, store):
+        return store.column('transaction_type') == self.transaction_type
+
+class Category(Filter):
+    """Filters rows tagged with the given category"""
+
+    def __init__(self, category):
+        self.category = category
+
+    def compile(self):
+        category = self.category
+        def category_filter(row, curr_date):
+            return row.get('category') == category
+        return category_filter
+
+    def mask(self, store):
+        return store.column('category') == self.category
+
+class DescriptionRegex(Filter):
+    """Filters rows whose description (transaction_note) matches the given regular expression"""
+
+    cost = 10
+
+    def __init__(self, pattern, flags=re.IGNORECASE):
+        self.pattern = re.compile(pattern, flags)
+
+    def compile(self):
+        search = self.pattern.search
+        def description_filter(row, curr_date):
+            note = row.get('transaction_note')
+            return note is not None and search(note) is not None
+        return description_filter
+
+    def mask(self, store):
+        compiled = self.compile()
+        return store.numpy.fromiter((compiled(row, None) for row in store.rows), dtype=bool, count=len(store))
+
+class And(Filter):
+    """Matches rows matching all of the given filters"""
+
+    def __init__(self, *filters):
+        # flatten nested ands, and order the predicates by cost so the cheap ones short circuit first
+        flat = []
+        for each_filter in filters:
+            flat.extend(each_filter.filters if isinstance(each_filter, And) else [each_filter])
+        self.filters = sorted(flat, key=lambda each_filter: each_filter.cost)
+        self.cost = sum(each_filter.cost for each_filter in self.filters)
+
+    def compile(self):
+        return _fuse(self.filters, all_of=True)
+
+    def mask(self, store):
+        result = self.filters[0].mask(store)
+        for each_filter in self.filters[1:]:
+            if not result.any():
+                break
+            result &= each_filter.mask(store)
+        return result
+
+class Or(Filter):
+    """Matches rows matching any of the given filters"""
+
+    def __init__(self, *filters):
+        flat = []
+        for each_filter in filters:
+            flat.extend(each_filter.filters if isinstance(each_filter, Or) else [each_filter])
+        self.filters = sorted(flat, key=lambda each_filter: each_filter.cost)
+        self.cost = sum(each_filter.cost for each_filter in self.filters)
+
+    def compile(self):
+        return _fuse(self.filters, all_of=False)
+
+    def mask(self, store):
+        result = self.filters[0].mask(store)
+        for each_filter in self.filters[1:]:
+            if result.all():
+                break
+            result |= each_filter.mask(store)
+        return result
+
+class Not(Filter):
+    """Matches rows not matching the given filter"""
+
+    def __init__(self, inner_filter):
+        self.inner_filter = inner_filter
+        self.cost = inner_filter.cost
+
+    def compile(self):
+        compiled = self.inner_filter.compile()
+        def not_filter(row, curr_date):
+            return not compiled(row, curr_date)
+        return not_filter
+
+    def mask(self, store):
+        return ~self.inner_filter.mask(store)
+
+def _fuse(filters, all_of):
+    # chains the compiled predicates into a single function, evaluated left to right
+    compiled = [each_filter.compile() for each_filter in filters]
+    fused = compiled[-1]
+    for first in reversed(compiled[:-1]):
+        fused = _chain(first, fused, all_of)
+    return fused
+
+def _chain(first, rest, all_of):
+    if all_of:
+        def and_filter(row, curr_date):
+            return first(row, curr_date) and rest(row, curr_date)
+        return and_filter
+    def or_filter(row, curr_date):
+        return first(row, curr_date) or rest(row, curr_date)
+    return or_filter
+
+def build_filter(account_id=None, from_date=None, to_date=None, where=None):
+    """Combines the getter arguments into one filter expression, returns None if there is nothing to filter
+
+    arguments:
+    account_id (optional) -- account_id string
+    from_date (optional) -- datetime.date
+    to_date (optional) -- datetime.date
+    where (optional) -- a Filter expression
+    """
+    filters = []
+    if account_id is not None:
+        filters.append(AccountId(account_id))
+    if from_date is not None or to_date is not None:
+        filters.append(DateRange(from_date, to_date))
+    if where is not None:
+        filters.append(where)
+    if not filters:
+        return None
+    if len(filters) == 1:
+        return filters[0]
+    return And(*filters)
+
+def apply_filter(expression, rows):
+    """Returns the iterator to rows (list of dictionary) matching the given filter expression,
+        for rows not kept in a TransactionStore
+
+    arguments:
+    expression -- a Filter expression or None
+    rows -- list of dictionary
+    """
+    if expression is None:
+        return iter(rows)
+    compiled = expression.compile()
+    return (row for row in rows if compiled(row, parse_date(row.get('date'))))
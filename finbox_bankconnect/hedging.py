@@ -0,0 +1,197 @@
+"""Hedged requests for the idempotent GET requests of the connector
+
+With hedge_percentile set in the configuration (e.g. 95), a GET request which hasn't got its response
+after that percentile of the recent response times is sent a second time, and the first response to
+arrive is used. The other request is cancelled if it hasn't started yet, else its response is discarded.
+Every GET request adds hedge_budget (e.g. 0.05 for at most 5% extra requests) to a budget, and each hedge
+spends 1 from it, so the extra load stays capped also when the whole API slows down.
+
+The hedge delay is only known after MIN_SAMPLES responses, the requests before are not hedged. A request
+which can't be hedged (no delay known yet, or no budget left) is sent on the calling thread, else it is sent
+on a thread of its own while the calling thread waits for the first response, and the hedges are sent by
+a pool of threads.
+
+metrics counters:
+hedge_eligible -- GET requests which could be hedged
+hedge_sent -- hedges sent, divide by hedge_eligible for the hedge rate
+hedge_won -- hedges which answered first
+hedge_budget_exhausted -- hedges due but not sent for lack of budget
+hedge_cancelled -- responses discarded because the other request answered first
+"""
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor, wait as futures_wait, FIRST_COMPLETED
+import finbox_bankconnect.metrics as metrics
+import finbox_bankconnect.deadline as deadline
+from finbox_bankconnect.scheduler import priority, current_priority
+
+# responses needed before hedging, and number of recent response times the percentile is taken over
+MIN_SAMPLES = 20
+LATENCY_WINDOW = 512
+
+# hedges the budget can save up, so that a burst of slow responses after a quiet period is still capped
+_MAX_TOKENS = 10.0
+
+# new response times recorded before the hedge delay is computed again
+_REFRESH_SAMPLES = 16
+
+class Hedger:
+    """Sends the GET requests of a Transport with hedging, see the module documentation"""
+
+    def __init__(self, config):
+        self.config = config
+        self._lock = threading.Lock()
+        self._latencies = deque(maxlen=LATENCY_WINDOW)
+        self._delay = None
+        self._stale = 0 # response times recorded since the delay was computed
+        self._tokens = 0.0
+        self._executor = None
+
+    def _get_executor(self):
+        if self._executor is None:
+            with self._lock:
+                if self._executor is None:
+                    # runs the hedges only, the original requests never wait behind them
+                    workers = max(self.config.max_concurrent_requests or 0, self.config.connection_pool_size, 4)
+                    self._executor = ThreadPoolExecutor(max_workers=workers)
+        return self._executor
+
+    def delay(self):
+        """Returns the seconds after which a request is hedged, None till MIN_SAMPLES responses are recorded"""
+        with self._lock:
+            if self._stale and (self._delay is None or self._stale >= _REFRESH_SAMPLES):
+                if len(self._latencies) >= MIN_SAMPLES:
+                    latencies = sorted(self._latencies)
+                    index = int(len(latencies) * self.config.hedge_percentile / 100.0)
+                    self._delay = latencies[min(index, len(latencies) - 1)]
+                self._stale = 0
+            return self._delay
+
+    def record(self, seconds):
+        """Records the response time of a request (not of a hedge)"""
+        with self._lock:
+            self._latencies.append(seconds)
+            self._stale += 1
+
+    def _record_primary(self, future, started):
+        # response time of the original request, also when its hedge answered first
+        if not future.cancelled() and future.exception() is None:
+            self.record(time.monotonic() - started)
+
+    def _earn(self):
+        with self._lock:
+            self._tokens = min(_MAX_TOKENS, self._tokens + (self.config.hedge_budget or 0))
+
+    def _spend(self):
+        with self._lock:
+            if self._tokens < 1:
+                return False
+            self._tokens -= 1
+            return True
+
+    def _refund(self):
+        # gives back the hedge reserved for a request which answered in time
+        with self._lock:
+            self._tokens = min(_MAX_TOKENS, self._tokens + 1)
+
+    def send(self, function):
+        """Calls function (sending the request, returns its response) and calls it again concurrently if no
+            response came after the hedge delay and the budget allows, returns the first response
+
+        arguments:
+        function -- function without arguments sending the idempotent request
+        """
+        metrics.increment('hedge_eligible')
+        self._earn()
+        delay = self.delay()
+        # the hedge is reserved before sending, a request which can't be hedged is sent on the calling thread
+        if delay is None or not self._spend():
+            started = time.monotonic()
+            response = function()
+            elapsed = time.monotonic() - started
+            self.record(elapsed)
+            if delay is not None and elapsed > delay:
+                metrics.increment('hedge_budget_exhausted')
+            return response
+
+        # the requests run on other threads with the deadline and priority of the calling thread
+        context = (deadline.current(), current_priority())
+        started = time.monotonic()
+        primary = _start(function, context)
+        primary.add_done_callback(lambda future: self._record_primary(future, started))
+        futures = [primary]
+        try:
+            if _wait(futures, delay):
+                self._refund()
+            else:
+                metrics.increment('hedge_sent')
+                futures.append(self._get_executor().submit(_call, function, context))
+            winner = _first(futures)
+        except BaseException:
+            for future in futures:
+                _discard(future)
+            raise
+        for future in futures:
+            if future is not winner:
+                _discard(future)
+        if winner is not primary:
+            metrics.increment('hedge_won')
+        return winner.result()
+
+def _start(function, context):
+    # sends the original request on a thread of its own, returns its future
+    future = Future()
+    def run():
+        if not future.set_running_or_notify_cancel():
+            return
+        try:
+            future.set_result(_call(function, context))
+        except BaseException as e:
+            future.set_exception(e)
+    thread = threading.Thread(target=run)
+    thread.daemon = True
+    thread.start()
+    return future
+
+def _call(function, context):
+    active_deadline, request_priority = context
+    with priority(request_priority):
+        if active_deadline is None:
+            return function()
+        with active_deadline:
+            return function()
+
+def _wait(futures, timeout=None):
+    # waits for one of the futures to finish, for timeout seconds at most, checking the current deadline meanwhile
+    expires_at = None if timeout is None else time.monotonic() + timeout
+    while True:
+        remaining = None if expires_at is None else max(0.0, expires_at - time.monotonic())
+        interval = deadline.check_interval()
+        if interval is None or (remaining is not None and remaining <= interval):
+            done, pending = futures_wait(futures, remaining, FIRST_COMPLETED)
+            return done
+        done, pending = futures_wait(futures, interval, FIRST_COMPLETED)
+        if done:
+            return done
+        deadline.check()
+
+def _first(futures):
+    # returns the first future to finish without error, else the one of the original request
+    pending = list(futures)
+    while pending:
+        for future in _wait(pending):
+            pending.remove(future)
+            if future.exception() is None:
+                return future
+    return futures[0]
+
+def _discard(future):
+    # cancels the request if not started, else closes its response (releasing its connection) once it arrives
+    if not future.cancel():
+        future.add_done_callback(_close_response)
+
+def _close_response(future):
+    if not future.cancelled() and future.exception() is None:
+        metrics.increment('hedge_cancelled')
+        future.result().close()
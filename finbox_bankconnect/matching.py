@@ -0,0 +1,403 @@
+"""Batch matching of entity identities against applicant records
+
+RecordIndex normalizes the names, addresses and account numbers of the records once (lower case, accents,
+punctuation and honorifics removed, common address abbreviations expanded, account numbers reduced to their
+digits with masked digits kept as X) and indexes them by blocking keys: the phonetic (Soundex) code of each
+name token and the last ACCOUNT_SUFFIX_DIGITS digits of the account number. Each identity is then only
+compared to the records sharing one of its keys, instead of to every record. Keys shared by more than
+max_block_size records (e.g. a very common surname) are skipped, unless all the keys of the identity are.
+
+The name and address scores are the Dice coefficient of their sets of character trigrams (so the order of
+the name words doesn't matter), the account score is 1 if the digits visible on both sides agree, else 0.
+The overall score is the weighted mean (WEIGHTS) of the scores available on both sides. With numpy installed,
+the scores of all the candidates of an identity are computed at once as array operations over the trigram ids
+of the records, concatenated in one array when the first batch is matched.
+
+Example:
+identities = [entity.get_identity() for entity in entities]
+result = match_identities(identities, applicants) # applicants: list of dictionary with name, address, account_number
+for identity_index, (record_index, score) in result.best().items():
+    ...
+"""
+import unicodedata
+from array import array
+from functools import lru_cache
+from finbox_bankconnect.utils import import_optional
+
+# weight of each score in the overall score
+WEIGHTS = {
+    'name': 0.5,
+    'account': 0.3,
+    'address': 0.2
+}
+
+# trailing account number digits used as blocking key
+ACCOUNT_SUFFIX_DIGITS = 4
+
+# minimum number of digits visible on both account numbers for them to match
+ACCOUNT_MIN_DIGITS = 4
+
+_HONORIFICS = frozenset(['mr', 'mrs', 'ms', 'miss', 'dr', 'shri', 'sri', 'smt', 'kumari', 'km', 'late'])
+
+_ADDRESS_WORDS = {
+    'rd': 'road',
+    'st': 'street',
+    'nr': 'near',
+    'opp': 'opposite',
+    'apt': 'apartment',
+    'apts': 'apartments',
+    'bldg': 'building',
+    'flr': 'floor',
+    'sec': 'sector',
+    'dist': 'district',
+    'ngr': 'nagar'
+}
+
+_SOUNDEX_CODES = dict(zip('bfpvcgjkqsxzdtlmnr', '111122222222334556'))
+
+_NAN = float('nan')
+
+# trailing account digits compared as one integer (fitting 64 bits) when scoring with numpy
+_MAX_TAIL_DIGITS = 18
+
+# ascii punctuation and symbols as spaces, for the fast path of _simplify
+_ASCII_SEPARATORS = dict((code, ' ') for code in range(128) if not chr(code).isalnum())
+
+def _simplify(value):
+    # lower case words of the string (accents removed, anything else than letters and digits as space)
+    if not value or not isinstance(value, str):
+        return []
+    value = value.lower()
+    try:
+        value.encode('ascii')
+    except UnicodeEncodeError:
+        value = unicodedata.normalize('NFKD', value)
+        return "".join(character if character.isalnum() else ' ' for character in value if not unicodedata.combining(character)).split()
+    return value.translate(_ASCII_SEPARATORS).split()
+
+def normalize_name(value):
+    """Returns the normalized name string (lower case words without punctuation and honorifics), '' if missing
+
+    arguments:
+    value -- name string
+    """
+    return " ".join(word for word in _simplify(value) if word not in _HONORIFICS)
+
+def normalize_address(value):
+    """Returns the normalized address string (lower case words without punctuation, abbreviations expanded), '' if missing
+
+    arguments:
+    value -- address string
+    """
+    return " ".join(_ADDRESS_WORDS.get(word, word) for word in _simplify(value))
+
+def normalize_account_number(value):
+    """Returns the account number string reduced to its digits, masked digits (X or *) as X, '' if missing
+
+    arguments:
+    value -- account number string
+    """
+    if value is None:
+        return ''
+    return "".join('X' if character in 'xX*' else character for character in str(value) if character.isdigit() or character in 'xX*')
+
+@lru_cache(maxsize=65536)
+def soundex(word):
+    """Returns the Soundex phonetic code of the word (e.g. 'R163' for 'robert'), '' if it has no letters
+
+    arguments:
+    word -- lower case word string
+    """
+    letters = [character for character in word if 'a' <= character <= 'z']
+    if not letters:
+        return ''
+    code = letters[0].upper()
+    previous = _SOUNDEX_CODES.get(letters[0], '')
+    for character in letters[1:]:
+        digit = _SOUNDEX_CODES.get(character, '')
+        if digit and digit != previous:
+            code += digit
+            if len(code) == 4:
+                break
+        if character not in 'hw':
+            previous = digit
+    return code.ljust(4, '0')
+
+def trigrams(value):
+    """Returns the set of character trigrams of the words of the normalized string, each word padded with spaces
+
+    arguments:
+    value -- normalized string
+    """
+    padded = [" {} ".format(word) for word in value.split()]
+    return set(word[index:index + 3] for word in padded for index in range(len(word) - 2))
+
+def _visible_tail(account_number):
+    # trailing digits of the normalized account number, up to its last masked digit
+    index = account_number.rfind('X')
+    return account_number[index + 1:]
+
+def _tail_score(first, second):
+    compared = min(len(first), len(second))
+    if compared < ACCOUNT_MIN_DIGITS:
+        return None
+    return 1.0 if first[-compared:] == second[-compared:] else 0.0
+
+def account_score(first, second):
+    """Returns 1.0 if the trailing digits visible on both normalized account numbers (up to the last masked digit)
+        agree, 0.0 if they don't, None if either is missing or fewer than ACCOUNT_MIN_DIGITS digits are visible on both
+
+    arguments:
+    first -- normalized account number string
+    second -- normalized account number string
+    """
+    return _tail_score(_visible_tail(first), _visible_tail(second))
+
+def _account_key(account_tail):
+    if len(account_tail) < ACCOUNT_SUFFIX_DIGITS:
+        return None
+    return ('account', account_tail[-ACCOUNT_SUFFIX_DIGITS:])
+
+class _Prepared:
+    # normalized fields, trigram id sets and blocking keys of one identity or record
+    __slots__ = ('name', 'address', 'account_tail', 'name_grams', 'address_grams', 'keys')
+
+    def __init__(self, item, intern):
+        self.name = normalize_name(item.get('name'))
+        self.address = normalize_address(item.get('address'))
+        self.account_tail = _visible_tail(normalize_account_number(item.get('account_number')))
+        self.name_grams = frozenset(map(intern, trigrams(self.name)))
+        self.address_grams = frozenset(map(intern, trigrams(self.address)))
+        keys = set(('name', code) for code in map(soundex, self.name.split()) if code)
+        account_key = _account_key(self.account_tail)
+        if account_key is not None:
+            keys.add(account_key)
+        self.keys = keys
+
+def _dice(first, second):
+    if not first or not second:
+        return _NAN
+    return 2.0 * len(first & second) / (len(first) + len(second))
+
+class MatchResult:
+    """Scores of the compared (identity, record) pairs, column wise: identity_index, record_index, name_score,
+        address_score, account_score and score (numpy arrays if numpy is installed, else array.array), a score
+        being NaN if the field is missing on either side
+    """
+
+    COLUMNS = ('identity_index', 'record_index', 'name_score', 'address_score', 'account_score', 'score')
+
+    def __init__(self, identity_index, record_index, name_score, address_score, account_score, score):
+        self.identity_index = identity_index
+        self.record_index = record_index
+        self.name_score = name_score
+        self.address_score = address_score
+        self.account_score = account_score
+        self.score = score
+
+    def __len__(self):
+        return len(self.score)
+
+    def pairs(self):
+        """Returns the iterator to the dictionary (keys as COLUMNS) of each pair"""
+        columns = [getattr(self, name) for name in self.COLUMNS]
+        for values in zip(*columns):
+            yield dict(zip(self.COLUMNS, values))
+
+    def best(self):
+        """Returns the dictionary of identity_index -> (record_index, score) of the best scored record of each
+            compared identity
+        """
+        best = dict()
+        for identity_index, record_index, score in zip(self.identity_index, self.record_index, self.score):
+            identity_index = int(identity_index)
+            previous = best.get(identity_index)
+            if previous is None or score > previous[1]:
+                best[identity_index] = (int(record_index), float(score))
+        return best
+
+class RecordIndex:
+    """Normalized and blocked applicant records, to match many batches of identities against"""
+
+    def __init__(self, records, max_block_size=1000):
+        """Normalizes and indexes the records
+
+        arguments:
+        records -- list of dictionary with name, address and account_number keys (any may be missing)
+        max_block_size (optional) (default: 1000) -- records sharing a blocking key above which the key is skipped
+        """
+        self.max_block_size = max_block_size
+        self._grams = dict() # trigram -> id, so the sets hold small ints
+        self._records = [_Prepared(record, self._intern) for record in records]
+        self._blocks = dict() # blocking key -> list of record indexes
+        self._columns = None
+        for index, record in enumerate(self._records):
+            for key in record.keys:
+                self._blocks.setdefault(key, []).append(index)
+
+    def __len__(self):
+        return len(self._records)
+
+    def _intern(self, gram):
+        return self._grams.setdefault(gram, len(self._grams))
+
+    def _lookup(self, gram):
+        # trigrams no record has are kept as strings, which never equal the ids
+        return self._grams.get(gram, gram)
+
+    def candidates(self, identity):
+        """Returns the sorted list of indexes of the records sharing a blocking key with the identity
+
+        arguments:
+        identity -- identity dictionary
+        """
+        return self._candidates(_Prepared(identity, self._lookup))
+
+    def _candidates(self, prepared):
+        blocks = [self._blocks[key] for key in prepared.keys if key in self._blocks]
+        if not blocks:
+            return []
+        usable = [block for block in blocks if len(block) <= self.max_block_size]
+        if not usable:
+            # only oversized blocks, fall back to the smallest one
+            usable = [min(blocks, key=len)]
+        if len(usable) == 1:
+            return usable[0]
+        candidates = set()
+        for block in usable:
+            candidates.update(block)
+        return sorted(candidates)
+
+    def match(self, identities):
+        """Scores each identity against its candidate records, returns a MatchResult
+
+        arguments:
+        identities -- list of identity dictionary, e.g. as returned by Entity.get_identity
+        """
+        np = import_optional('numpy')
+        prepared = self._prepare(identities)
+        if np is not None:
+            return self._match_numpy(np, prepared)
+        return self._match_python(prepared)
+
+    def _prepare(self, identities):
+        return [_Prepared(identity or dict(), self._lookup) for identity in identities]
+
+    def _match_python(self, prepared):
+        identity_indexes = array('q')
+        record_indexes = array('q')
+        name_scores = array('d')
+        address_scores = array('d')
+        account_scores = array('d')
+        records = self._records
+        for identity_index, identity in enumerate(prepared):
+            candidates = self._candidates(identity)
+            if not candidates:
+                continue
+            identity_indexes.extend([identity_index] * len(candidates))
+            record_indexes.extend(candidates)
+            name_scores.extend([_dice(identity.name_grams, records[index].name_grams) for index in candidates])
+            address_scores.extend([_dice(identity.address_grams, records[index].address_grams) for index in candidates])
+            for index in candidates:
+                score = _tail_score(identity.account_tail, records[index].account_tail)
+                account_scores.append(_NAN if score is None else score)
+        score = array('d')
+        weighted = ((name_scores, WEIGHTS['name']), (address_scores, WEIGHTS['address']), (account_scores, WEIGHTS['account']))
+        for index in range(len(identity_indexes)):
+            total = 0.0
+            weight = 0.0
+            for scores, column_weight in weighted:
+                value = scores[index]
+                if value == value:
+                    total += value * column_weight
+                    weight += column_weight
+            score.append(total / weight if weight else 0.0)
+        return MatchResult(identity_indexes, record_indexes, name_scores, address_scores, account_scores, score)
+
+    def _get_columns(self, np):
+        # the records as arrays: trigram ids of all records concatenated with the offsets of each record (for names
+        # and addresses), and the trailing visible account digits as integer with their count, built on first use
+        if self._columns is None:
+            columns = dict()
+            for field in ('name_grams', 'address_grams'):
+                sizes = np.fromiter((len(getattr(record, field)) for record in self._records), dtype=np.int64, count=len(self._records))
+                indptr = np.zeros(len(self._records) + 1, dtype=np.int64)
+                np.cumsum(sizes, out=indptr[1:])
+                flat = np.fromiter((gram for record in self._records for gram in getattr(record, field)), dtype=np.int64, count=int(indptr[-1]))
+                columns[field] = (indptr, flat, sizes.astype(float))
+            tails = [record.account_tail[-_MAX_TAIL_DIGITS:] for record in self._records]
+            columns['account_value'] = np.array([int(tail) if tail else 0 for tail in tails], dtype=np.int64)
+            columns['account_length'] = np.array([len(tail) for tail in tails], dtype=np.int64)
+            self._columns = columns
+        return self._columns
+
+    def _match_numpy(self, np, prepared):
+        columns = self._get_columns(np)
+        mark = np.zeros(len(self._grams), dtype=bool) # trigrams of the identity being scored
+        parts = []
+        for identity_index, identity in enumerate(prepared):
+            candidates = self._candidates(identity)
+            if not len(candidates):
+                continue
+            candidates = np.array(candidates, dtype=np.int64)
+            parts.append((
+                np.full(len(candidates), identity_index, dtype=np.int64),
+                candidates,
+                _dice_column(np, columns['name_grams'], candidates, identity.name_grams, mark),
+                _dice_column(np, columns['address_grams'], candidates, identity.address_grams, mark),
+                _account_column(np, columns, candidates, identity.account_tail)
+            ))
+        if parts:
+            identity_indexes, record_indexes, name_scores, address_scores, account_scores = [np.concatenate(column) for column in zip(*parts)]
+        else:
+            identity_indexes, record_indexes = np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+            name_scores, address_scores, account_scores = np.zeros(0), np.zeros(0), np.zeros(0)
+
+        total = np.zeros(len(identity_indexes))
+        weight = np.zeros(len(identity_indexes))
+        for scores, column_weight in ((name_scores, WEIGHTS['name']), (address_scores, WEIGHTS['address']), (account_scores, WEIGHTS['account'])):
+            available = ~np.isnan(scores)
+            total += np.where(available, scores, 0.0) * column_weight
+            weight += available * column_weight
+        score = total / np.where(weight > 0, weight, 1.0)
+        return MatchResult(identity_indexes, record_indexes, name_scores, address_scores, account_scores, score)
+
+def _dice_column(np, csr, candidates, grams, mark):
+    # Dice coefficients of the trigram set against the sets of all the candidate records at once
+    indptr, flat, sizes = csr
+    if not grams:
+        return np.full(len(candidates), _NAN)
+    starts = indptr[candidates]
+    lengths = indptr[candidates + 1] - starts
+    offsets = np.cumsum(lengths) - lengths
+    positions = np.arange(int(lengths.sum())) + np.repeat(starts - offsets, lengths)
+    known = [gram for gram in grams if type(gram) is int]
+    mark[known] = True
+    shared = np.concatenate(([0], np.cumsum(mark[flat[positions]])))
+    mark[known] = False
+    shared = shared[offsets + lengths] - shared[offsets]
+    record_sizes = sizes[candidates]
+    dice = 2.0 * shared / (len(grams) + record_sizes)
+    dice[record_sizes == 0] = _NAN
+    return dice
+
+def _account_column(np, columns, candidates, account_tail):
+    # account scores against all the candidate records at once, comparing the common trailing digits as integers
+    account_tail = account_tail[-_MAX_TAIL_DIGITS:]
+    if len(account_tail) < ACCOUNT_MIN_DIGITS:
+        return np.full(len(candidates), _NAN)
+    lengths = np.minimum(columns['account_length'][candidates], len(account_tail))
+    modulus = np.power(10, lengths, dtype=np.int64)
+    equal = columns['account_value'][candidates] % modulus == int(account_tail) % modulus
+    return np.where(lengths >= ACCOUNT_MIN_DIGITS, equal.astype(float), _NAN)
+
+def match_identities(identities, records, max_block_size=1000):
+    """Scores each identity against the records sharing a blocking key with it, returns a MatchResult
+        (use a RecordIndex to match several batches against the same records)
+
+    arguments:
+    identities -- list of identity dictionary, e.g. as returned by Entity.get_identity
+    records -- list of dictionary with name, address and account_number keys (any may be missing)
+    max_block_size (optional) (default: 1000) -- records sharing a blocking key above which the key is skipped
+    """
+    return RecordIndex(records, max_block_size).match(identities)
@@ -0,0 +1,61 @@
+"""Light weight in-process instrumentation, counters and timings recorded by the package can be read
+using snapshot() or forwarded to your own metrics system by setting the hook
+
+Example:
+import finbox_bankconnect.metrics as metrics
+metrics.hook = lambda name, value: statsd.timing(name, value)
+"""
+import threading
+from collections import defaultdict
+
+# optional function(name, value) called on every recorded counter increment / timing
+hook = None
+
+_lock = threading.Lock()
+_counters = defaultdict(int)
+_timings = dict() # name -> [count, total seconds, max seconds]
+
+def increment(name, value=1):
+    """Increments the counter with given name
+
+    arguments:
+    name -- counter name string
+    value (optional) (default: 1) -- value to add
+    """
+    with _lock:
+        _counters[name] += value
+    if hook is not None:
+        hook(name, value)
+
+def observe(name, seconds):
+    """Records a timing with given name
+
+    arguments:
+    name -- timing name string
+    seconds -- duration in seconds
+    """
+    with _lock:
+        timing = _timings.get(name)
+        if timing is None:
+            _timings[name] = [1, seconds, seconds]
+        else:
+            timing[0] += 1
+            timing[1] += seconds
+            if seconds > timing[2]:
+                timing[2] = seconds
+    if hook is not None:
+        hook(name, seconds)
+
+def snapshot():
+    """Returns a dictionary with the current counters and timings (count, total, max)"""
+    with _lock:
+        return {
+            'counters': dict(_counters),
+            'timings': dict((name, {'count': timing[0], 'total': timing[1], 'max': timing[2]}) for name, timing in _timings.items())
+        }
+
+def reset():
+    """Clears all the recorded counters and timings"""
+    with _lock:
+        _counters.clear()
+        _timings.clear()
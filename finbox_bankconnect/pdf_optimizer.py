@@ -0,0 +1,183 @@
+"""Lossless rewriting of statement pdf files before uploading them, to send fewer bytes
+
+PdfOptimizer rewrites the files with pikepdf (qpdf) in a pool of worker processes, so that the rewriting runs
+alongside the uploads instead of before them (see the optimizer argument of UploadSpool). The page contents are
+not changed:
+- the objects are packed in compressed object streams (pdf 1.5+) and the flate streams are compressed again
+- the identical images and forms used by several pages are stored once
+- the page thumbnails are removed, and the metadata (document info and XMP) too if strip_metadata is set
+Encrypted files are rewritten with the same encryption, which needs their password. The rewritten file
+replaces the original only if it is smaller.
+
+The rewritten file isn't the original bytes: its structure changes, and its metadata too with strip_metadata,
+which the authenticity check of the API (is_authentic) may look at. The metadata is kept by default.
+
+pikepdf is optional (pip install finbox_bankconnect[optimize]), without it the files are left as they are.
+
+metrics counters:
+pdf_optimized -- files rewritten smaller
+pdf_optimizer_bytes_saved -- bytes saved by the rewritten files
+pdf_optimizer_errors -- files left as they are because they couldn't be rewritten (e.g. wrong password)
+pdf_optimizer_unavailable -- files left as they are because pikepdf isn't installed
+
+Example:
+optimizer = PdfOptimizer(workers=2)
+result = optimizer.submit("statement.pdf").result() # rewrites the file in place
+result.bytes_saved
+spool = UploadSpool("/var/spool/bankconnect", optimizer=optimizer)
+"""
+import hashlib
+import os
+import shutil
+import threading
+from concurrent.futures import Future, ProcessPoolExecutor
+import finbox_bankconnect.metrics as metrics
+from finbox_bankconnect.utils import import_optional
+
+class OptimizationResult:
+    """Outcome of the rewriting of one file"""
+
+    def __init__(self, path, original_size, optimized_size=None, error=None):
+        self.path = path
+        self.original_size = original_size
+        self.optimized_size = original_size if optimized_size is None else optimized_size # size of the file kept
+        self.error = error # error string if the file couldn't be rewritten, None otherwise
+
+    @property
+    def bytes_saved(self):
+        return self.original_size - self.optimized_size
+
+    def __repr__(self):
+        return "<OptimizationResult path={!r} original_size={} optimized_size={} error={!r}>".format(
+            self.path, self.original_size, self.optimized_size, self.error)
+
+def _deduplicate(pdf):
+    # makes the pages use one object for the identical image and form streams of their resources
+    pikepdf = import_optional('pikepdf')
+    kept = dict() # hash of the stream -> first stream object
+    for page in pdf.pages:
+        resources = page.obj.get('/Resources')
+        xobjects = resources.get('/XObject') if resources is not None else None
+        if xobjects is None:
+            continue
+        for name in list(xobjects.keys()):
+            stream = xobjects[name]
+            if not isinstance(stream, pikepdf.Stream) or not stream.is_indirect:
+                continue
+            # the dictionary is compared with the references it holds, so streams sharing a mask differ
+            digest = hashlib.sha256(stream.read_raw_bytes())
+            digest.update(repr(sorted((key, repr(value)) for key, value in stream.stream_dict.items() if key != '/Length')).encode('utf-8'))
+            first = kept.setdefault(digest.digest(), stream)
+            if first.objgen != stream.objgen:
+                xobjects[name] = first
+
+def optimize_file(file_path, destination=None, pdf_password=None, strip_metadata=False):
+    """Rewrites the pdf file losslessly, returns its OptimizationResult (raises the pikepdf errors)
+
+    arguments:
+    file_path -- path of the pdf file
+    destination (optional) -- path to write the smaller file to (default: replaces file_path)
+    pdf_password (optional) -- pdf password string
+    strip_metadata (optional) (default: False) -- remove the document info and XMP metadata too
+    """
+    pikepdf = import_optional('pikepdf')
+    destination = file_path if destination is None else destination
+    original_size = os.path.getsize(file_path)
+    temp_path = "{}.optimizing".format(destination)
+    try:
+        with pikepdf.open(file_path, password=pdf_password or '') as pdf:
+            encrypted = pdf.is_encrypted
+            for page in pdf.pages:
+                if '/Thumb' in page.obj:
+                    del page.obj['/Thumb']
+            if strip_metadata:
+                if '/Metadata' in pdf.Root:
+                    del pdf.Root['/Metadata']
+                if '/Info' in pdf.trailer:
+                    del pdf.trailer['/Info']
+            _deduplicate(pdf)
+            pdf.remove_unreferenced_resources()
+            pdf.save(temp_path, object_stream_mode=pikepdf.ObjectStreamMode.generate, compress_streams=True,
+                recompress_flate=True, encryption=encrypted, fix_metadata_version=False)
+        optimized_size = os.path.getsize(temp_path)
+        if optimized_size < original_size:
+            # keeps the permissions of the original (e.g. the spooled copies readable by their owner only)
+            shutil.copymode(file_path, temp_path)
+            os.replace(temp_path, destination)
+            return OptimizationResult(destination, original_size, optimized_size)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+    return OptimizationResult(file_path, original_size)
+
+def _optimize(file_path, pdf_password, strip_metadata):
+    # runs in the worker processes, the errors are returned as the result (the exceptions may not pickle)
+    try:
+        return optimize_file(file_path, pdf_password=pdf_password, strip_metadata=strip_metadata)
+    except Exception as e:
+        return OptimizationResult(file_path, os.path.getsize(file_path), error="{}: {}".format(type(e).__name__, e))
+
+class PdfOptimizer:
+    """Pool of worker processes rewriting pdf files losslessly, see the module documentation"""
+
+    def __init__(self, workers=2, strip_metadata=False):
+        """Creates the optimizer, the worker processes start with the first file submitted
+
+        arguments:
+        workers (optional) (default: 2) -- number of worker processes
+        strip_metadata (optional) (default: False) -- remove the document info and XMP metadata too
+        """
+        self.workers = workers
+        self.strip_metadata = strip_metadata
+        self.bytes_saved = 0 # bytes saved by all the files rewritten
+        self._lock = threading.Lock()
+        self._executor = None
+
+    def submit(self, file_path, pdf_password=None):
+        """Schedules the rewriting of the pdf file in place, returns the concurrent.futures.Future of its
+            OptimizationResult (never failing, the file is left as it is if it couldn't be rewritten)
+
+        arguments:
+        file_path -- path of the pdf file
+        pdf_password (optional) -- pdf password string
+        """
+        if import_optional('pikepdf') is None:
+            metrics.increment('pdf_optimizer_unavailable')
+            future = Future()
+            future.set_result(OptimizationResult(file_path, os.path.getsize(file_path), error="pikepdf is not installed"))
+            return future
+        future = Future()
+        with self._lock:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(max_workers=self.workers)
+            rewriting = self._executor.submit(_optimize, file_path, pdf_password, self.strip_metadata)
+        rewriting.add_done_callback(lambda rewriting: self._record(file_path, rewriting, future))
+        return future
+
+    def _record(self, file_path, rewriting, future):
+        # counts the outcome in this process (the metrics of the worker processes are lost) before handing it out
+        if rewriting.cancelled() or rewriting.exception() is not None:
+            error = "cancelled" if rewriting.cancelled() else repr(rewriting.exception())
+            result = OptimizationResult(file_path, os.path.getsize(file_path), error=error)
+        else:
+            result = rewriting.result()
+        if result.error is not None:
+            metrics.increment('pdf_optimizer_errors')
+        elif result.bytes_saved > 0:
+            with self._lock:
+                self.bytes_saved += result.bytes_saved
+            metrics.increment('pdf_optimized')
+            metrics.increment('pdf_optimizer_bytes_saved', result.bytes_saved)
+        future.set_result(result)
+
+    def close(self, wait=True):
+        """Stops the worker processes
+
+        arguments:
+        wait (optional) (default: True) -- wait for the files submitted to be rewritten
+        """
+        with self._lock:
+            executor = self._executor
+            self._executor = None
+        if executor is not None:
+            executor.shutdown(wait=wait)
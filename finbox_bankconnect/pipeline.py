@@ -0,0 +1,186 @@
+import heapq
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, FIRST_COMPLETED, wait
+import finbox_bankconnect
+import finbox_bankconnect.connector as connector
+import finbox_bankconnect.decoder as decoder
+from finbox_bankconnect.connector import get_progress_status
+from finbox_bankconnect.store import TransactionStore
+from finbox_bankconnect.custom_exceptions import ExtractionFailedError, EntityNotFoundError, ServiceTimeOutError
+
+# payloads of at least this many bytes are handed to the worker processes through shared memory instead of pickling
+SHARED_MEMORY_MIN_BYTES = 1024 * 1024
+
+def process_entities(entity_ids, extract=None, where=None, resource='transactions', processes=None, io_threads=8,
+        client=None):
+    """Fetches the transactions of many entities using I/O threads and hands the raw payloads to a pool of
+        processes for JSON decoding, date parsing, filtering and feature extraction, so that the post processing
+        is not limited by the GIL. Returns an iterator yielding a tuple (entity_id, result, error) for each entity
+        as soon as it is done (once per entity_id, repeated ids are skipped), error being the exception instance
+        if the entity failed (result is None then)
+
+    arguments:
+    entity_ids -- iterable of entity id strings
+    extract (optional) -- module level (picklable) function called in the worker process with the list of
+                          filtered rows, its return value is yielded as result (default: the list of rows)
+    where (optional) -- filter expression (finbox_bankconnect.filters.Filter) applied on the rows
+    resource (optional) (default: transactions) -- entity resource having rows under "transactions"
+                                                   (transactions, salary or lender_transactions)
+    processes (optional) -- number of worker processes (default: number of CPUs)
+    io_threads (optional) (default: 8) -- number of threads fetching the payloads
+    client (optional) -- the finbox_bankconnect.Client to fetch with (default: package level configuration)
+    """
+    config = finbox_bankconnect if client is None else client
+    processes = processes or os.cpu_count() or 1
+    # bound the entities in flight so that raw payloads don't pile up in memory if decoding falls behind
+    max_in_flight = io_threads + 2 * processes
+
+    entity_ids = iter(entity_ids)
+    io_pool = ThreadPoolExecutor(max_workers=io_threads)
+    _start_resource_tracker()
+    process_pool = ProcessPoolExecutor(max_workers=processes)
+    futures = dict() # future -> (kind, entity_id, shared memory block or None)
+    scheduled = [] # heap of (due time, entity_id) for entities to be polled again
+    started_at = dict() # entity_id -> polling start time
+    seen = set() # entity ids started, to skip the repeated ones
+
+    def start_next():
+        for entity_id in entity_ids:
+            if entity_id in seen:
+                continue
+            seen.add(entity_id)
+            started_at[entity_id] = time.time()
+            futures[io_pool.submit(connector.fetch_raw, entity_id, resource, client)] = ('fetch', entity_id, None)
+            return True
+        return False
+
+    def poll_again(entity_id):
+        # returns False if polling for the entity has timed out
+        if time.time() + config.poll_interval >= started_at[entity_id] + config.poll_timeout:
+            return False
+        heapq.heappush(scheduled, (time.time() + config.poll_interval, entity_id))
+        return True
+
+    try:
+        while len(started_at) < max_in_flight and start_next():
+            pass
+
+        while futures or scheduled:
+            # submit the polls which are due now
+            while scheduled and scheduled[0][0] <= time.time():
+                entity_id = heapq.heappop(scheduled)[1]
+                futures[io_pool.submit(connector.fetch_raw, entity_id, resource, client)] = ('fetch', entity_id, None)
+
+            timeout = max(0, scheduled[0][0] - time.time()) if scheduled else None
+            done, _ = wait(list(futures), timeout=timeout, return_when=FIRST_COMPLETED)
+
+            for future in done:
+                kind, entity_id, block = futures.pop(future)
+                result = None
+                error = None
+                finished = True
+                try:
+                    if kind == 'fetch':
+                        status_code, content = future.result()
+                        if status_code == 404:
+                            raise EntityNotFoundError
+                        elif status_code == 200:
+                            block, payload = _share(content)
+                            process_future = process_pool.submit(_process_payload, payload, extract, where)
+                            futures[process_future] = ('process', entity_id, block)
+                            finished = False
+                        else:
+                            # the API answers 200 while processing, other statuses are errors (as in connector.upload_file)
+                            raise ServiceTimeOutError
+                    else:
+                        _release(block)
+                        status, result = future.result()
+                        if status == "failed":
+                            raise ExtractionFailedError
+                        elif not status == "completed":
+                            if poll_again(entity_id):
+                                finished = False
+                            else:
+                                raise ServiceTimeOutError
+                except Exception as e:
+                    result = None
+                    error = e
+
+                if finished:
+                    del started_at[entity_id]
+                    start_next()
+                    yield entity_id, result, error
+    finally:
+        for kind, entity_id, block in futures.values():
+            _release(block)
+        io_pool.shutdown(wait=False)
+        process_pool.shutdown(wait=True)
+
+def _share(content):
+    # returns (shared memory block, payload reference) for large payloads, (None, content) otherwise
+    # (multiprocessing.shared_memory needs python 3.8+)
+    if len(content) < SHARED_MEMORY_MIN_BYTES:
+        return None, content
+    try:
+        from multiprocessing import shared_memory
+    except ImportError:
+        return None, content
+    block = shared_memory.SharedMemory(create=True, size=len(content))
+    block.buf[:len(content)] = content
+    return block, (block.name, len(content))
+
+def _start_resource_tracker():
+    # before python 3.13 the workers attaching to a shared block register it with the resource tracker they inherit,
+    # so it is started before them: their registrations are then duplicates of the parent's, cleared when it unlinks
+    # the block, rather than the entries of a tracker of their own unlinking the blocks (and warning of leaks) on exit
+    if sys.version_info >= (3, 13) or os.name != 'posix':
+        return
+    try:
+        from multiprocessing import resource_tracker
+    except ImportError:
+        # python before 3.8, without shared memory
+        return
+    resource_tracker.ensure_running()
+
+def _release(block):
+    if block is not None:
+        block.close()
+        block.unlink()
+
+def _decode_payload(payload):
+    # runs in the worker process, decodes the payload reference created by _share
+    if isinstance(payload, bytes):
+        return decoder.loads(payload)
+    from multiprocessing import shared_memory
+    name, size = payload
+    try:
+        block = shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        # track argument is only available from python 3.13, the block is registered with the resource tracker of
+        # the parent then (see _start_resource_tracker), which only the parent's unlink clears
+        block = shared_memory.SharedMemory(name=name)
+    try:
+        # decoded straight from the shared buffer (without a copy if the decoder backend supports it)
+        view = block.buf[:size]
+        try:
+            return decoder.loads(view)
+        finally:
+            view.release()
+    finally:
+        block.close()
+
+def _process_payload(payload, extract, where):
+    # runs in the worker process, returns a tuple (status, result)
+    response = _decode_payload(payload)
+    try:
+        status = get_progress_status(response['progress'])
+        if not status == "completed":
+            return status, None
+        rows = list(TransactionStore(response['transactions']).select(where))
+    except KeyError:
+        return "format_changed", None
+    if extract is not None:
+        return status, extract(rows)
+    return status, rows
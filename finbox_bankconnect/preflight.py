@@ -0,0 +1,745 @@
+"""Local checks of a statement pdf file before uploading it, to reject the uploads the API would fail anyway
+
+With finbox_bankconnect.upload_preflight set to True (or the upload_preflight argument of a Client, or the preflight
+argument of Entity.upload_statement), upload_statement first calls validate on the file and raises the error the
+API would have answered with, without sending the file:
+- UnparsablePDFError if the file isn't a pdf (no header, no cross reference section or end of file marker)
+- PasswordIncorrectError if the file is encrypted and the password (or the lack of one) can't open it
+
+Files whose pages are images only are not rejected (the API reads scanned statements too), their report has
+text_layer set to False.
+The parts of a malformed file the checks can't read (e.g. a trailer or an encryption dictionary with values of the
+wrong type) are left unknown in the report rather than failing the check.
+
+The file is memory mapped and only the needed parts are read: the header, the trailer at the end, the encryption
+dictionary, the metadata and the dictionaries of the page tree, found through the cross reference sections. The
+fonts are looked for in the resources of the pages (and of the forms they draw), the only streams inflated being
+the cross reference and object streams (small, holding the dictionaries of pdf 1.5+ files), never the page
+contents or the images. The object streams of encrypted files can't be inflated, so their text layer may be left
+unknown.
+
+The passwords of the standard security handler are checked in pure python for the revisions 2 to 5 (RC4 and
+AES-256 of Acrobat 9), the revision 6 (AES-256 of pdf 2.0) needs the cryptography package, else the password is
+left for the API to check. Other security handlers are not checked either.
+
+The bank names found in the metadata (title, author, producer, ...) are reported in bank_markers, but a file
+without markers is not rejected, as the API identifies the bank from the text of the pages.
+
+metrics counters:
+preflight_rejected -- uploads rejected by the local checks
+
+Example:
+report = preflight.check("statement.pdf", pdf_password="1234")
+report.error # None if the file looks uploadable, else the exception class the API would answer with
+"""
+import hashlib
+import mmap
+import re
+import struct
+import zlib
+import finbox_bankconnect.metrics as metrics
+from finbox_bankconnect.utils import import_optional
+from finbox_bankconnect.custom_exceptions import PasswordIncorrectError, UnparsablePDFError
+
+HEADER_WINDOW = 1024 # bytes at the start holding the %PDF- header
+TRAILER_WINDOW = 4096 # bytes at the end holding startxref and %%EOF
+METADATA_WINDOW = 65536 # bytes at the start and end searched for bank markers
+OBJECT_WINDOW = 65536 # bytes read to parse one indirect object dictionary
+
+# lowercase marker found in the metadata -> bank name reported
+BANK_MARKERS = [
+    ('state bank of india', 'sbi'), ('hdfc', 'hdfc'), ('icici', 'icici'), ('axis bank', 'axis'),
+    ('kotak', 'kotak'), ('yes bank', 'yes'), ('indusind', 'indusind'), ('idfc', 'idfc'),
+    ('bank of baroda', 'baroda'), ('punjab national', 'pnb'), ('canara', 'canara'), ('union bank', 'union'),
+    ('federal bank', 'federal'), ('rbl bank', 'rbl'), ('idbi', 'idbi'), ('bank of india', 'boi'),
+    ('standard chartered', 'standard_chartered'), ('citibank', 'citi'), ('hsbc', 'hsbc'),
+    ('au small finance', 'au'),
+]
+
+# padding of the passwords of the standard security handler
+_PADDING = (b'\x28\xbf\x4e\x5e\x4e\x75\x8a\x41\x64\x00\x4e\x56\xff\xfa\x01\x08'
+            b'\x2e\x2e\x00\xb6\xd0\x68\x3e\x80\x2f\x0c\xa9\xfe\x64\x53\x69\x7a')
+
+_WHITESPACE = b' \t\r\n\x0c\x00'
+_DELIMITERS = b'()<>[]{}/%'
+_ESCAPES = {b'n': b'\n', b'r': b'\r', b't': b'\t', b'b': b'\b', b'f': b'\x0c'}
+_INFO_KEYS = ('Title', 'Author', 'Subject', 'Keywords', 'Creator', 'Producer')
+
+_STARTXREF = re.compile(br'startxref\s+(\d+)')
+_OBJECT_HEADER = re.compile(br'\s*\d+\s+\d+\s+obj\s*')
+_SUBSECTION = re.compile(br'\s*(\d+)\s+(\d+)\s*')
+_OBJECT = re.compile(br'(?<![0-9])(\d+)\s+(\d+)\s+obj\b')
+
+# errors of parsing a malformed file, the parts failing are reported as unknown
+_PARSE_ERRORS = (ValueError, IndexError, KeyError, TypeError, AttributeError, OverflowError)
+
+class PreflightReport:
+    """Result of the local checks of a statement pdf file, see check"""
+
+    def __init__(self):
+        self.version = None # pdf version string of the header, e.g. '1.7'
+        self.encrypted = False
+        self.password_verified = None # whether the password (or no password) opens the file, None if not checked
+        self.text_layer = None # True if the pages have fonts, False if images only, None if not known
+        self.bank_markers = [] # bank names found in the metadata
+        self.error = None # exception class the API would fail the upload with, None if the file looks uploadable
+
+    def __repr__(self):
+        return "<PreflightReport version={!r} encrypted={!r} password_verified={!r} text_layer={!r} error={}>".format(
+            self.version, self.encrypted, self.password_verified, self.text_layer,
+            None if self.error is None else self.error.__name__)
+
+class _Name(str):
+    # pdf name object, e.g. /Standard is _Name('Standard')
+    pass
+
+class _Reference:
+    # indirect reference, e.g. 12 0 R
+    def __init__(self, number, generation):
+        self.number = number
+        self.generation = generation
+
+class _Parser:
+    # minimal parser of the pdf objects of a dictionary (no streams), strings are returned as bytes
+
+    def __init__(self, data, position=0):
+        self.data = data
+        self.position = position
+
+    def _skip(self):
+        data = self.data
+        while self.position < len(data):
+            character = data[self.position:self.position + 1]
+            if character in _WHITESPACE:
+                self.position += 1
+            elif character == b'%':
+                while self.position < len(data) and data[self.position:self.position + 1] not in b'\r\n':
+                    self.position += 1
+            else:
+                break
+
+    def _token(self):
+        # returns the next regular token (number, keyword)
+        start = self.position
+        data = self.data
+        while self.position < len(data) and data[self.position:self.position + 1] not in _WHITESPACE + _DELIMITERS:
+            self.position += 1
+        return data[start:self.position]
+
+    def parse(self):
+        self._skip()
+        data = self.data
+        if self.position >= len(data):
+            raise ValueError("unexpected end of data")
+        character = data[self.position:self.position + 1]
+        if data.startswith(b'<<', self.position):
+            return self._dictionary()
+        if character == b'<':
+            return self._hex_string()
+        if character == b'(':
+            return self._literal_string()
+        if character == b'[':
+            return self._array()
+        if character == b'/':
+            return self._name()
+        token = self._token()
+        if not token:
+            raise ValueError("unexpected delimiter")
+        if token == b'true':
+            return True
+        if token == b'false':
+            return False
+        if token == b'null':
+            return None
+        try:
+            number = int(token)
+        except ValueError:
+            try:
+                return float(token)
+            except ValueError:
+                raise ValueError("unexpected keyword")
+        # number generation R is an indirect reference
+        position = self.position
+        self._skip()
+        generation = self._token()
+        self._skip()
+        if generation.isdigit() and self._token() == b'R':
+            return _Reference(number, int(generation))
+        self.position = position
+        return number
+
+    def _dictionary(self):
+        self.position += 2
+        result = dict()
+        while True:
+            self._skip()
+            if self.data.startswith(b'>>', self.position):
+                self.position += 2
+                return result
+            key = self.parse()
+            if not isinstance(key, _Name):
+                raise ValueError("dictionary key must be a name")
+            result[str(key)] = self.parse()
+
+    def _array(self):
+        self.position += 1
+        result = []
+        while True:
+            self._skip()
+            if self.data[self.position:self.position + 1] == b']':
+                self.position += 1
+                return result
+            result.append(self.parse())
+
+    def _name(self):
+        self.position += 1
+        token = self._token()
+        return _Name(re.sub(br'#([0-9A-Fa-f]{2})', lambda match: bytes([int(match.group(1), 16)]), token).decode('latin-1'))
+
+    def _hex_string(self):
+        end = self.data.index(b'>', self.position)
+        digits = re.sub(br'[^0-9A-Fa-f]', b'', self.data[self.position + 1:end])
+        self.position = end + 1
+        if len(digits) % 2:
+            digits += b'0'
+        return bytes(bytearray(int(digits[index:index + 2], 16) for index in range(0, len(digits), 2)))
+
+    def _literal_string(self):
+        data = self.data
+        self.position += 1
+        depth = 1
+        result = bytearray()
+        while True:
+            if self.position >= len(data):
+                raise ValueError("unterminated string")
+            character = data[self.position:self.position + 1]
+            self.position += 1
+            if character == b'\\':
+                escaped = data[self.position:self.position + 1]
+                self.position += 1
+                if escaped in _ESCAPES:
+                    result += _ESCAPES[escaped]
+                elif escaped in b'01234567' and escaped:
+                    digits = escaped
+                    while len(digits) < 3 and data[self.position:self.position + 1] in b'01234567' \
+                            and data[self.position:self.position + 1]:
+                        digits += data[self.position:self.position + 1]
+                        self.position += 1
+                    result.append(int(digits, 8) & 255)
+                elif escaped == b'\r':
+                    # line continuation
+                    if data[self.position:self.position + 1] == b'\n':
+                        self.position += 1
+                elif escaped != b'\n':
+                    result += escaped
+                continue
+            if character == b'(':
+                depth += 1
+            elif character == b')':
+                depth -= 1
+                if depth == 0:
+                    return bytes(result)
+            result += character
+
+def _parse_at(data, position):
+    # parses the object at the position, skipping a "number generation obj" header
+    match = _OBJECT_HEADER.match(data, position)
+    if match:
+        position = match.end()
+    return _Parser(data, position).parse()
+
+def _unpredict(content, columns, pixel=1):
+    # reverses the png predictors of the rows (a filter type byte then the columns bytes of each row)
+    row_size = columns + 1
+    previous = bytearray(columns)
+    result = bytearray()
+    for start in range(0, len(content) - row_size + 1, row_size):
+        kind = bytearray(content[start:start + 1])[0]
+        row = bytearray(content[start + 1:start + row_size])
+        for index in range(columns):
+            left = row[index - pixel] if index >= pixel else 0
+            up = previous[index]
+            if kind == 1:
+                row[index] = (row[index] + left) & 255
+            elif kind == 2:
+                row[index] = (row[index] + up) & 255
+            elif kind == 3:
+                row[index] = (row[index] + (left + up) // 2) & 255
+            elif kind == 4:
+                upper_left = previous[index - pixel] if index >= pixel else 0
+                estimate = left + up - upper_left
+                distances = (abs(estimate - left), abs(estimate - up), abs(estimate - upper_left))
+                nearest = (left, up, upper_left)[distances.index(min(distances))]
+                row[index] = (row[index] + nearest) & 255
+        result += row
+        previous = row
+    return bytes(result)
+
+def _decode(dictionary, raw):
+    # returns the content of a stream without filter or flate encoded, None if it has another filter or is broken
+    filters = dictionary.get('Filter')
+    parameters = dictionary.get('DecodeParms')
+    if isinstance(filters, list):
+        if len(filters) > 1:
+            return None
+        filters = filters[0] if filters else None
+        parameters = parameters[0] if isinstance(parameters, list) and parameters else parameters
+    if filters is None:
+        return raw
+    if filters != 'FlateDecode':
+        return None
+    try:
+        # decompressobj tolerates the end of line before endstream
+        content = zlib.decompressobj().decompress(raw)
+    except zlib.error:
+        return None
+    parameters = parameters if isinstance(parameters, dict) else dict()
+    predictor, colors, bits, columns = [parameters.get(key, default)
+        for key, default in (('Predictor', 1), ('Colors', 1), ('BitsPerComponent', 8), ('Columns', 1))]
+    if not all(isinstance(value, int) for value in (predictor, colors, bits, columns)):
+        return None
+    if predictor >= 10:
+        pixel = max(1, colors * bits // 8)
+        content = _unpredict(content, columns * pixel, pixel)
+    return content
+
+class _Document:
+    # the parts of the memory mapped file needed by the checks
+
+    def __init__(self, data):
+        self.data = data
+        self.size = len(data)
+        self.encrypted = False
+        self._streams = dict() # offset -> (dictionary, content) of the cross reference and object streams read
+        self._offsets = None # (number, generation) -> offset of the objects found by scanning the file
+
+    def object_at(self, offset):
+        return _parse_at(self.data[offset:offset + OBJECT_WINDOW], 0)
+
+    def stream_at(self, offset):
+        # returns the dictionary of the stream object at offset and its decoded content (None if it can't be decoded)
+        if offset in self._streams:
+            return self._streams[offset]
+        window = self.data[offset:offset + OBJECT_WINDOW]
+        match = _OBJECT_HEADER.match(window)
+        parser = _Parser(window, match.end() if match else 0)
+        dictionary = parser.parse()
+        content = None
+        if isinstance(dictionary, dict):
+            parser._skip()
+            if window.startswith(b'stream', parser.position):
+                start = offset + parser.position + 6
+                if self.data[start:start + 2] == b'\r\n':
+                    start += 2
+                elif self.data[start:start + 1] in (b'\r', b'\n'):
+                    start += 1
+                length = dictionary.get('Length')
+                end = start + length if isinstance(length, int) else self.data.find(b'endstream', start)
+                if end >= start:
+                    content = _decode(dictionary, self.data[start:end])
+        self._streams[offset] = (dictionary, content)
+        return dictionary, content
+
+    def trailer(self):
+        # returns the trailer dictionary of the last cross reference section, and its offset
+        tail = self.data[max(0, self.size - TRAILER_WINDOW):]
+        matches = list(_STARTXREF.finditer(tail))
+        if not matches or b'%%EOF' not in tail:
+            return None, None
+        offset = int(matches[-1].group(1))
+        if offset >= self.size:
+            return None, None
+        if self.data[offset:offset + 4] == b'xref':
+            position = self.data.find(b'trailer', offset)
+            if position == -1:
+                return None, None
+            trailer = _Parser(self.data[position + 7:position + 7 + OBJECT_WINDOW]).parse()
+            return trailer if isinstance(trailer, dict) else None, offset
+        # cross reference stream (pdf 1.5+), its dictionary is the trailer
+        trailer = self.object_at(offset)
+        return trailer if isinstance(trailer, dict) else None, offset
+
+    def _table_entry(self, number, generation, offset):
+        # returns the entry of the object in the cross reference table at offset (None if not in it) and its trailer
+        position = offset + 4
+        entry = None
+        while True:
+            match = _SUBSECTION.match(self.data, position)
+            if not match:
+                break
+            first, count = int(match.group(1)), int(match.group(2))
+            position = match.end()
+            if first <= number < first + count:
+                fields = self.data[position + (number - first) * 20:position + (number - first + 1) * 20].split()
+                if len(fields) == 3 and fields[2] == b'n' and int(fields[1]) == generation:
+                    entry = (int(fields[0]),)
+                break
+            position += count * 20
+        position = self.data.find(b'trailer', offset)
+        if position == -1:
+            return entry, None
+        return entry, _Parser(self.data[position + 7:position + 7 + OBJECT_WINDOW]).parse()
+
+    def _stream_entry(self, number, generation, offset):
+        # returns the entry of the object in the cross reference stream at offset (None if not in it) and its dictionary
+        dictionary, content = self.stream_at(offset)
+        if not isinstance(dictionary, dict) or dictionary.get('Type') != 'XRef' or content is None:
+            return None, None
+        widths = dictionary.get('W')
+        if not isinstance(widths, list) or len(widths) != 3 or not all(isinstance(width, int) for width in widths):
+            return None, dictionary
+        index = dictionary.get('Index', [0, dictionary.get('Size', 0)])
+        if not isinstance(index, list) or not all(isinstance(value, int) for value in index):
+            return None, dictionary
+        row_size = sum(widths)
+        position = 0
+        for first, count in zip(index[0::2], index[1::2]):
+            if first <= number < first + count:
+                start = position + (number - first) * row_size
+                fields = []
+                for width in widths:
+                    fields.append(int.from_bytes(content[start:start + width], 'big'))
+                    start += width
+                kind = fields[0] if widths[0] else 1
+                if kind == 1 and fields[2] == generation:
+                    return (fields[1],), dictionary
+                if kind == 2 and generation == 0:
+                    # compressed object: (object stream number, index in the stream)
+                    return (fields[1], fields[2]), dictionary
+                return None, dictionary
+            position += count * row_size
+        return None, dictionary
+
+    def _locate(self, number, generation, offset):
+        # returns the cross reference entry of the object from the sections starting at offset, (offset,) for an
+        # object of the file or (object stream number, index) for a compressed one, None if not found
+        seen = set()
+        while isinstance(offset, int) and offset not in seen and offset < self.size:
+            seen.add(offset)
+            if self.data[offset:offset + 4] == b'xref':
+                entry, trailer = self._table_entry(number, generation, offset)
+                if entry is None and isinstance(trailer, dict) and isinstance(trailer.get('XRefStm'), int):
+                    # hybrid file, the compressed objects are listed in its cross reference stream only
+                    entry = self._stream_entry(number, generation, trailer['XRefStm'])[0]
+            else:
+                entry, trailer = self._stream_entry(number, generation, offset)
+            if entry is not None:
+                return entry
+            offset = trailer.get('Prev') if isinstance(trailer, dict) else None
+        return None
+
+    def _compressed(self, stream_number, index, xref_offset):
+        # returns the object at the index of the object stream, None if it can't be read
+        if self.encrypted:
+            # the object streams are encrypted
+            return None
+        entry = self._locate(stream_number, 0, xref_offset)
+        if entry is None or len(entry) != 1:
+            return None
+        dictionary, content = self.stream_at(entry[0])
+        if not isinstance(dictionary, dict) or content is None:
+            return None
+        count, first = dictionary.get('N'), dictionary.get('First')
+        if not isinstance(count, int) or not isinstance(first, int) or not 0 <= index < count:
+            return None
+        # the stream starts with the pairs of object number and offset from First
+        parser = _Parser(content)
+        for _ in range(2 * index + 1):
+            parser.parse()
+        offset = parser.parse()
+        if not isinstance(offset, int):
+            return None
+        return _Parser(content, first + offset).parse()
+
+    def _scanned_offset(self, number, generation):
+        # returns the offset of the object found by scanning the file once (broken cross reference sections)
+        if self._offsets is None:
+            self._offsets = dict()
+            for match in _OBJECT.finditer(self.data):
+                # the last definition wins (incremental updates)
+                self._offsets[(int(match.group(1)), int(match.group(2)))] = match.start()
+        return self._offsets.get((number, generation))
+
+    def resolve(self, value, xref_offset):
+        # returns the object of an indirect reference (other values are returned as is), None if not found
+        if not isinstance(value, _Reference):
+            return value
+        entry = self._locate(value.number, value.generation, xref_offset)
+        if entry is not None and len(entry) == 2:
+            return self._compressed(entry[0], entry[1], xref_offset)
+        offset = entry[0] if entry is not None else None
+        if offset is None or not self.data[offset:offset + 32].lstrip().startswith(
+                "{} {} obj".format(value.number, value.generation).encode('ascii')):
+            offset = self._scanned_offset(value.number, value.generation)
+            if offset is None:
+                return None
+        return self.object_at(offset)
+
+    def text_layer(self, trailer, xref_offset):
+        # returns True if a page (or a form it draws) has fonts, False if none has but images are drawn, None if
+        # not known (no images either, or the page tree couldn't be read)
+        seen = set()
+        images = []
+
+        def resolve(value):
+            if isinstance(value, _Reference):
+                if (value.number, value.generation) in seen:
+                    return None
+                seen.add((value.number, value.generation))
+            return self.resolve(value, xref_offset)
+
+        def has_font(resources):
+            resources = resolve(resources)
+            if not isinstance(resources, dict):
+                return False
+            fonts = resolve(resources.get('Font'))
+            if isinstance(fonts, dict) and fonts:
+                return True
+            xobjects = resolve(resources.get('XObject'))
+            for xobject in (xobjects.values() if isinstance(xobjects, dict) else ()):
+                xobject = resolve(xobject)
+                if not isinstance(xobject, dict):
+                    continue
+                if xobject.get('Subtype') == 'Image':
+                    images.append(True)
+                elif xobject.get('Subtype') == 'Form' and has_font(xobject.get('Resources')):
+                    return True
+            return False
+
+        root = self.resolve(trailer.get('Root'), xref_offset)
+        if not isinstance(root, dict):
+            return None
+        # (page tree node, resources inherited from its parents)
+        pending = [(root.get('Pages'), None)]
+        while pending:
+            node, resources = pending.pop()
+            if isinstance(node, _Reference) and (node.number, node.generation) in seen:
+                continue
+            node = resolve(node)
+            if not isinstance(node, dict):
+                return None
+            resources = node.get('Resources', resources)
+            kids = node.get('Kids')
+            if kids is not None:
+                kids = self.resolve(kids, xref_offset)
+                if not isinstance(kids, list):
+                    return None
+                pending.extend((kid, resources) for kid in reversed(kids))
+            elif has_font(resources):
+                return True
+        return False if images else None
+
+def _rc4(key, data):
+    state = list(range(256))
+    j = 0
+    for i in range(256):
+        j = (j + state[i] + key[i % len(key)]) & 255
+        state[i], state[j] = state[j], state[i]
+    i = j = 0
+    result = bytearray()
+    for byte in bytearray(data):
+        i = (i + 1) & 255
+        j = (j + state[i]) & 255
+        state[i], state[j] = state[j], state[i]
+        result.append(byte ^ state[(state[i] + state[j]) & 255])
+    return bytes(result)
+
+def _rc4_key(password, encryption, file_id):
+    # algorithm 2 of the pdf specification, the file key of the revisions 2 to 4
+    revision = encryption['R']
+    length = encryption.get('Length', 40) // 8 if revision >= 3 else 5
+    permissions = encryption.get('P', 0)
+    if permissions > 0x7fffffff:
+        permissions -= 1 << 32
+    digest = hashlib.md5((password + _PADDING)[:32] + encryption['O'][:32] + struct.pack('<i', permissions) + file_id)
+    if revision >= 4 and encryption.get('EncryptMetadata', True) is False:
+        digest.update(b'\xff\xff\xff\xff')
+    key = digest.digest()
+    if revision >= 3:
+        for _ in range(50):
+            key = hashlib.md5(key[:length]).digest()
+    return key[:length]
+
+def _rc4_user_password(password, encryption, file_id):
+    # algorithms 4 and 5, whether the password is the user password
+    key = _rc4_key(password, encryption, file_id)
+    if encryption['R'] == 2:
+        return _rc4(key, _PADDING) == encryption['U'][:32]
+    value = _rc4(key, hashlib.md5(_PADDING + file_id).digest())
+    for index in range(1, 20):
+        value = _rc4(bytes(bytearray(byte ^ index for byte in bytearray(key))), value)
+    return value == encryption['U'][:16]
+
+def _rc4_owner_password(password, encryption, file_id):
+    # algorithm 7, whether the password is the owner password (it decrypts the user password)
+    revision = encryption['R']
+    length = encryption.get('Length', 40) // 8 if revision >= 3 else 5
+    key = hashlib.md5((password + _PADDING)[:32]).digest()
+    if revision >= 3:
+        for _ in range(50):
+            key = hashlib.md5(key).digest()
+    key = key[:length]
+    value = encryption['O'][:32]
+    if revision == 2:
+        value = _rc4(key, value)
+    else:
+        for index in range(19, -1, -1):
+            value = _rc4(bytes(bytearray(byte ^ index for byte in bytearray(key))), value)
+    return _rc4_user_password(value, encryption, file_id)
+
+def _aes_cbc(key, iv, data):
+    # AES-128-CBC encryption without padding, None if the cryptography package isn't installed
+    if import_optional('cryptography') is None:
+        return None
+    from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+    encryptor = Cipher(algorithms.AES(key), modes.CBC(iv)).encryptor()
+    return encryptor.update(data) + encryptor.finalize()
+
+def _hash(password, salt, user_key, revision):
+    # algorithm 2.B of the revision 6 (a plain SHA-256 for the revision 5), None if it can't be computed
+    digest = hashlib.sha256(password + salt + user_key).digest()
+    if revision == 5:
+        return digest
+    round_number = 0
+    while True:
+        encrypted = _aes_cbc(digest[:16], digest[16:32], (password + digest + user_key) * 64)
+        if encrypted is None:
+            return None
+        function = (hashlib.sha256, hashlib.sha384, hashlib.sha512)[sum(bytearray(encrypted[:16])) % 3]
+        digest = function(encrypted).digest()
+        round_number += 1
+        if round_number >= 64 and bytearray(encrypted)[-1] <= round_number - 32:
+            return digest[:32]
+
+def _aes_password(password, encryption):
+    # algorithms 11 and 12, whether the password is the user or owner password, None if it can't be checked
+    revision = encryption['R']
+    user, owner = encryption['U'], encryption['O']
+    password = password[:127]
+    user_hash = _hash(password, user[32:40], b'', revision)
+    if user_hash is None:
+        return None
+    if user_hash == user[:32]:
+        return True
+    return _hash(password, owner[32:40], user[:48], revision) == owner[:32]
+
+def _verify(encryption, file_id, password):
+    # whether the password string is the user or owner password, None if it can't be checked
+    revision = encryption.get('R')
+    if revision in (5, 6):
+        return _aes_password(password.encode('utf-8'), encryption)
+    if revision not in (2, 3, 4) or not isinstance(file_id, bytes):
+        return None
+    try:
+        password = password.encode('latin-1')
+    except UnicodeEncodeError:
+        password = password.encode('utf-8')
+    return _rc4_user_password(password, encryption, file_id) or _rc4_owner_password(password, encryption, file_id)
+
+def _password_verified(encryption, file_id, password):
+    # whether the password (None for no password) opens the file, None if it can't be checked
+    if not isinstance(encryption, dict) or encryption.get('Filter') != 'Standard':
+        return None
+    if not isinstance(encryption.get('O'), bytes) or not isinstance(encryption.get('U'), bytes):
+        return None
+    if not isinstance(encryption.get('R'), int) or not all(isinstance(encryption.get(key, 0), int) for key in ('V', 'Length', 'P')):
+        return None
+    verified = _verify(encryption, file_id, password or '')
+    if verified is False and password:
+        # files with an empty user password open whatever the password given
+        verified = _verify(encryption, file_id, '')
+    return verified
+
+def _bank_markers(texts):
+    # returns the bank names whose markers are in the texts
+    found = []
+    for text in texts:
+        text = text.lower()
+        for marker, bank in BANK_MARKERS:
+            if marker.encode('ascii') in text and bank not in found:
+                found.append(bank)
+    return found
+
+def _inspect(data, pdf_password):
+    report = PreflightReport()
+    document = _Document(data)
+    header = data[:HEADER_WINDOW]
+    position = header.find(b'%PDF-')
+    if position == -1:
+        report.error = UnparsablePDFError
+        return report
+    report.version = header[position + 5:position + 8].decode('latin-1')
+    try:
+        trailer, xref_offset = document.trailer()
+    except _PARSE_ERRORS:
+        trailer = None
+    if trailer is None:
+        report.error = UnparsablePDFError
+        return report
+
+    # the xmp metadata stream is usually near the start or the end, and not compressed
+    texts = [data[:METADATA_WINDOW], data[max(0, document.size - METADATA_WINDOW):]]
+    encryption = trailer.get('Encrypt')
+    if encryption is not None:
+        report.encrypted = document.encrypted = True
+        try:
+            encryption = document.resolve(encryption, xref_offset)
+        except _PARSE_ERRORS:
+            encryption = None
+        file_id = trailer.get('ID')
+        file_id = file_id[0] if isinstance(file_id, list) and file_id and isinstance(file_id[0], bytes) else None
+        report.password_verified = _password_verified(encryption, file_id, pdf_password)
+        if report.password_verified is False:
+            report.error = PasswordIncorrectError
+    else:
+        # the strings of the info dictionary are encrypted too
+        try:
+            info = document.resolve(trailer.get('Info'), xref_offset)
+        except _PARSE_ERRORS:
+            info = None
+        if isinstance(info, dict):
+            texts.extend(value for key, value in info.items() if key in _INFO_KEYS and isinstance(value, bytes))
+    report.bank_markers = _bank_markers(texts)
+
+    # the dictionaries are not encrypted (only their strings), but the object streams holding them are
+    try:
+        report.text_layer = document.text_layer(trailer, xref_offset)
+    except _PARSE_ERRORS:
+        report.text_layer = None
+    return report
+
+def check(file_path, pdf_password=None):
+    """Returns the PreflightReport of the statement pdf file, reading only the needed parts of it
+
+    arguments:
+    file_path -- path of the pdf file
+    pdf_password (optional) -- pdf password string
+    """
+    with open(file_path, 'rb') as file_obj: #throws IOError if file is unaccessible or doesn't exists
+        try:
+            data = mmap.mmap(file_obj.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # empty file
+            report = PreflightReport()
+            report.error = UnparsablePDFError
+            return report
+        try:
+            return _inspect(data, pdf_password)
+        except _PARSE_ERRORS:
+            # a malformed part the checks don't expect, everything is left unknown for the API to judge
+            return PreflightReport()
+        finally:
+            data.close()
+
+def validate(file_path, pdf_password=None):
+    """Returns the PreflightReport of the statement pdf file, raises the error the API would fail the upload with
+
+    arguments:
+    file_path -- path of the pdf file
+    pdf_password (optional) -- pdf password string
+    """
+    report = check(file_path, pdf_password)
+    if report.error is not None:
+        metrics.increment('preflight_rejected')
+        raise report.error()
+    return report
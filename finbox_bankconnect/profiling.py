@@ -0,0 +1,206 @@
+"""Switchable profiling of the Entity methods and connector functions
+
+While enabled, every call of a public Entity method, connector function, rate limit wait (Transport.throttle)
+and of the sleeps between polls is timed (wall time, CPU time of the calling thread, time spent sleeping in poll loops and, optionally,
+net bytes allocated according to tracemalloc), and aggregated per function and per call stack. The
+functions are wrapped only while profiling is enabled, so there is no cost at all when it is disabled,
+and a few microseconds per call when enabled (allocation tracking is much more expensive).
+
+dump(directory) writes the aggregate as:
+stacks.folded -- collapsed stacks ("Entity.get_transactions;connector.get_transactions <microseconds>",
+                 self wall time) for flame graph tools, e.g. flamegraph.pl or speedscope
+summary.txt -- table of calls, total / mean / max wall time, CPU time, sleep time and allocations
+
+Example:
+import finbox_bankconnect.profiling as profiling
+profiling.enable()
+...
+profiling.dump("/tmp/bankconnect-profile")
+"""
+import os
+import threading
+import time
+import finbox_bankconnect.connector as connector
+import finbox_bankconnect.entity as entity
+from finbox_bankconnect.entity import Entity
+from finbox_bankconnect.transport import Transport
+
+# CPU time of the calling thread (python 3.7+), else of the process
+_cpu_time = getattr(time, 'thread_time', time.process_time)
+
+_lock = threading.Lock()
+_context = threading.local()
+_originals = [] # (owner, attribute name, original value) of the wrapped functions
+_stats = dict() # function name -> [calls, wall, cpu, sleep, allocated bytes, max wall]
+_stacks = dict() # tuple of function names -> self wall time
+_allocations = False
+_started_tracing = False # whether enable started tracemalloc, only then disable stops it
+
+class _Frame:
+    __slots__ = ('name', 'children_wall', 'sleep')
+
+    def __init__(self, name):
+        self.name = name
+        self.children_wall = 0.0
+        self.sleep = 0.0
+
+def _stack():
+    stack = getattr(_context, 'stack', None)
+    if stack is None:
+        stack = _context.stack = []
+    return stack
+
+def _wrap(name, function, sleeping=False):
+    def profiled(*args, **kwargs):
+        stack = _stack()
+        frame = _Frame(name)
+        stack.append(frame)
+        allocated = _traced_memory() if _allocations else 0
+        cpu_start = _cpu_time()
+        wall_start = time.perf_counter()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            wall = time.perf_counter() - wall_start
+            cpu = _cpu_time() - cpu_start
+            if _allocations:
+                allocated = _traced_memory() - allocated
+            stack.pop()
+            if sleeping:
+                frame.sleep = wall
+            if stack:
+                stack[-1].children_wall += wall
+                stack[-1].sleep += frame.sleep
+            _record(tuple(item.name for item in stack) + (name,), wall, cpu, frame, allocated)
+    profiled.__name__ = getattr(function, '__name__', name)
+    profiled.__doc__ = getattr(function, '__doc__', None)
+    profiled.__wrapped__ = function
+    return profiled
+
+def _traced_memory():
+    import tracemalloc
+    return tracemalloc.get_traced_memory()[0]
+
+def _record(path, wall, cpu, frame, allocated):
+    with _lock:
+        stats = _stats.get(frame.name)
+        if stats is None:
+            stats = _stats[frame.name] = [0, 0.0, 0.0, 0.0, 0, 0.0]
+        stats[0] += 1
+        stats[1] += wall
+        stats[2] += cpu
+        stats[3] += frame.sleep
+        stats[4] += allocated
+        if wall > stats[5]:
+            stats[5] = wall
+        _stacks[path] = _stacks.get(path, 0.0) + max(0.0, wall - frame.children_wall)
+
+def _patch(owner, attribute, name, sleeping=False):
+    original = owner.__dict__[attribute]
+    if isinstance(original, classmethod):
+        wrapped = classmethod(_wrap(name, original.__func__))
+    else:
+        wrapped = _wrap(name, original, sleeping)
+    _originals.append((owner, attribute, original))
+    setattr(owner, attribute, wrapped)
+
+def enable(allocations=False):
+    """Starts profiling (no effect if already enabled)
+
+    arguments:
+    allocations (optional) (default: False) -- also record the net bytes allocated by each call, using tracemalloc
+    """
+    global _allocations, _started_tracing
+    with _lock:
+        if _originals:
+            return
+        if allocations:
+            import tracemalloc
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+                _started_tracing = True
+        _allocations = allocations
+
+        for attribute, value in sorted(Entity.__dict__.items()):
+            if attribute.startswith('_') or isinstance(value, property):
+                continue
+            if callable(value) or isinstance(value, classmethod):
+                _patch(Entity, attribute, "Entity.{}".format(attribute))
+        for attribute, value in sorted(vars(connector).items()):
+            if not attribute.startswith('_') and callable(value) and getattr(value, '__module__', None) == connector.__name__:
+                _patch(connector, attribute, "connector.{}".format(attribute))
+        # only the sleeps of the poll loop count as sleep, the rate limit waits are reported on their own
+        _patch(entity, '_poll_sleep', "sleep", sleeping=True)
+        _patch(Transport, 'throttle', "Transport.throttle")
+
+def disable():
+    """Stops profiling, restoring the original functions (the recorded data is kept till reset)"""
+    global _allocations, _started_tracing
+    with _lock:
+        while _originals:
+            owner, attribute, original = _originals.pop()
+            setattr(owner, attribute, original)
+        if _started_tracing:
+            import tracemalloc
+            tracemalloc.stop()
+        _allocations = False
+        _started_tracing = False
+
+def is_enabled():
+    """Returns whether profiling is enabled"""
+    return bool(_originals)
+
+def reset():
+    """Clears the recorded data"""
+    with _lock:
+        _stats.clear()
+        _stacks.clear()
+
+def summary():
+    """Returns the list of dictionary (name, calls, wall, cpu, sleep, allocated, mean_wall, max_wall) of each
+        profiled function, in decreasing total wall time
+    """
+    with _lock:
+        rows = [{
+            'name': name,
+            'calls': stats[0],
+            'wall': stats[1],
+            'cpu': stats[2],
+            'sleep': stats[3],
+            'allocated': stats[4],
+            'mean_wall': stats[1] / stats[0],
+            'max_wall': stats[5]
+        } for name, stats in _stats.items()]
+    return sorted(rows, key=lambda row: row['wall'], reverse=True)
+
+def collapsed_stacks():
+    """Returns the list of collapsed stack lines ("a;b;c <self wall microseconds>") for flame graph tools"""
+    with _lock:
+        items = sorted(_stacks.items())
+    return ["{} {}".format(";".join(path), int(round(wall * 1000000))) for path, wall in items]
+
+def format_summary():
+    """Returns the summary as a text table"""
+    lines = ["{:<40} {:>8} {:>11} {:>11} {:>11} {:>11} {:>11} {:>14}".format(
+        "function", "calls", "wall s", "mean ms", "max ms", "cpu s", "sleep s", "allocated B")]
+    for row in summary():
+        lines.append("{:<40} {:>8} {:>11.3f} {:>11.3f} {:>11.3f} {:>11.3f} {:>11.3f} {:>14}".format(
+            row['name'], row['calls'], row['wall'], row['mean_wall'] * 1000, row['max_wall'] * 1000,
+            row['cpu'], row['sleep'], row['allocated']))
+    return "\n".join(lines) + "\n"
+
+def dump(directory):
+    """Writes stacks.folded and summary.txt (see the module documentation) in the directory, returns their paths
+
+    arguments:
+    directory -- path of the directory, created if missing
+    """
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    stacks_path = os.path.join(directory, 'stacks.folded')
+    summary_path = os.path.join(directory, 'summary.txt')
+    with open(stacks_path, 'w') as stacks_file:
+        stacks_file.write("\n".join(collapsed_stacks()) + "\n")
+    with open(summary_path, 'w') as summary_file:
+        summary_file.write(format_summary())
+    return stacks_path, summary_path
@@ -0,0 +1,124 @@
+"""Priority scheduling of the requests sent by a Transport
+
+Every request runs at a priority (interactive, default or backfill). At most max_concurrent_requests of
+the configuration are in flight at once. When more are waiting, the free slots are given by weighted fair
+queuing across the priorities, so a high volume backfill gets its share without starving the others. The
+last reserved_interactive_requests slots are only used by interactive requests, so a user facing flow never
+waits behind a full pipe of background traffic.
+
+The priority of the requests sent by a thread is set using the priority context manager, the Entity
+methods set it to the priority the entity was created with.
+
+Example:
+import finbox_bankconnect.scheduler as scheduler
+
+with scheduler.priority('backfill'):
+    for entity_id in entity_ids:
+        finbox_bankconnect.Entity.get(entity_id).get_transactions()
+"""
+import threading
+import time
+from contextlib import contextmanager
+import finbox_bankconnect.metrics as metrics
+import finbox_bankconnect.deadline as deadline
+
+# share of the slots given to each priority when requests are waiting
+PRIORITY_WEIGHTS = {
+    'interactive': 16,
+    'default': 4,
+    'backfill': 1
+}
+DEFAULT_PRIORITY = 'default'
+
+_context = threading.local()
+
+def validate_priority(value):
+    if value not in PRIORITY_WEIGHTS:
+        raise ValueError("priority must be one of {}".format(", ".join(sorted(PRIORITY_WEIGHTS))))
+
+@contextmanager
+def priority(value):
+    """Context manager setting the priority of the requests sent by the current thread
+
+    arguments:
+    value -- priority string (interactive, default or backfill)
+    """
+    validate_priority(value)
+    previous = getattr(_context, 'priority', None)
+    _context.priority = value
+    try:
+        yield
+    finally:
+        _context.priority = previous
+
+def current_priority():
+    """Returns the priority of the requests sent by the current thread"""
+    return getattr(_context, 'priority', None) or DEFAULT_PRIORITY
+
+class _Waiter:
+    def __init__(self, priority, tag):
+        self.priority = priority
+        self.tag = tag
+
+class Scheduler:
+    """Admits the requests of a Transport by priority, see the module documentation"""
+
+    def __init__(self, config):
+        self.config = config
+        self._condition = threading.Condition()
+        self._in_flight = 0
+        self._waiting = []
+        self._virtual_time = 0.0
+        self._last_tag = dict() # priority -> virtual finish tag of its last queued request
+
+    def _can_start(self, priority):
+        limit = self.config.max_concurrent_requests
+        if not limit:
+            return True
+        if priority == 'interactive':
+            return self._in_flight < limit
+        return self._in_flight < limit - min(self.config.reserved_interactive_requests or 0, limit - 1)
+
+    def _next(self):
+        # the waiter with the smallest finish tag among the ones which can start now
+        eligible = [waiter for waiter in self._waiting if self._can_start(waiter.priority)]
+        return min(eligible, key=lambda waiter: waiter.tag) if eligible else None
+
+    def acquire(self, priority):
+        """Waits for a request slot for the priority"""
+        with self._condition:
+            if not self._waiting and self._can_start(priority):
+                self._in_flight += 1
+                return
+            # virtual finish time of the request, lower weights advance it faster
+            tag = max(self._virtual_time, self._last_tag.get(priority, 0.0)) + 1.0 / PRIORITY_WEIGHTS[priority]
+            self._last_tag[priority] = tag
+            waiter = _Waiter(priority, tag)
+            self._waiting.append(waiter)
+            started = time.monotonic()
+            try:
+                while not self._next() is waiter:
+                    deadline.check()
+                    self._condition.wait(deadline.check_interval())
+            finally:
+                self._waiting.remove(waiter)
+                # another waiter may be able to start too (e.g. on a reserved slot, or as this one gave up)
+                self._condition.notify_all()
+            self._virtual_time = tag
+            self._in_flight += 1
+        metrics.observe('request_queue_seconds_{}'.format(priority), time.monotonic() - started)
+
+    def release(self):
+        """Frees the request slot taken by acquire"""
+        with self._condition:
+            self._in_flight -= 1
+            self._condition.notify_all()
+
+    @contextmanager
+    def slot(self, priority=None):
+        """Context manager holding a request slot for the priority (default: the current thread's priority)"""
+        self.acquire(priority or current_priority())
+        try:
+            yield
+        finally:
+            self.release()
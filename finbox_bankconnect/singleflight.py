@@ -0,0 +1,70 @@
+import threading
+import finbox_bankconnect.deadline as deadline
+from finbox_bankconnect.scheduler import PRIORITY_WEIGHTS, current_priority
+from finbox_bankconnect.custom_exceptions import DeadlineExceededError, OperationCancelledError
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+class SingleFlight:
+    """Coalesces concurrent calls having the same key, so that only the first caller runs the function
+        and the callers arriving while it is in flight wait for it and share its result (or exception)
+
+    Waiting callers give up at their own deadline (see finbox_bankconnect.deadline), and run the call
+    again themselves if the first caller gave up at its deadline or was cancelled. A caller never waits for
+    a call in flight at a lower priority than its own (see finbox_bankconnect.scheduler), which would hold
+    it back behind the background traffic, it runs the call at its priority instead.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = dict() # key -> dictionary of priority weight -> call in flight
+
+    def do(self, key, function, *args):
+        """Runs function(*args) unless a call with the same key is already in flight, returns its result
+
+        arguments:
+        key -- hashable key identifying the call
+        function -- function to call
+        args -- arguments for the function
+        """
+        while True:
+            call, leader = self._join(key, function, args)
+            if leader or call.error is None or not isinstance(call.error, (DeadlineExceededError, OperationCancelledError)):
+                break
+            # the first caller's deadline, not necessarily ours
+            deadline.check()
+
+        if call.error is not None:
+            raise call.error
+        return call.result
+
+    def _join(self, key, function, args):
+        # runs or waits for the call, returns (call, whether it was run by this caller)
+        weight = PRIORITY_WEIGHTS[current_priority()]
+        with self._lock:
+            calls = self._calls.setdefault(key, dict())
+            joinable = [other for other in calls if other >= weight]
+            leader = not joinable
+            if leader:
+                call = calls[weight] = _Call()
+            else:
+                call = calls[max(joinable)]
+
+        if leader:
+            try:
+                call.result = function(*args)
+            except Exception as e:
+                call.error = e
+            finally:
+                with self._lock:
+                    del calls[weight]
+                    if not calls:
+                        del self._calls[key]
+                call.done.set()
+        else:
+            deadline.wait(call.done)
+        return call, leader
@@ -0,0 +1,317 @@
+"""Compact binary snapshot of completed entity data, opened through mmap
+
+The row lists (transactions, salary and lender transactions) are stored column wise as fixed width arrays,
+with all the strings kept once in a shared string table, and the pre-parsed dates as day ordinals. The
+small payloads (accounts, fraud info, identity, recurring transactions) are kept as JSON in the directory.
+
+A snapshot is written once (atomically) and opened read-only through mmap, so every process on the host
+opening the same file shares one copy of it in the page cache, and the columns are read without copying.
+Rows are built as dictionaries only when accessed. The same format is used as bytes by dumps and loads
+(e.g. to send an entity to another process), the version in the header telling which readers can use it.
+
+File layout (little endian):
+magic (8 bytes) | version (uint32) | directory length (uint32) | directory (JSON) | arrays (8 byte aligned)
+"""
+import datetime
+import json
+import mmap
+import os
+import struct
+import sys
+import tempfile
+from finbox_bankconnect.utils import parse_date
+from finbox_bankconnect.custom_exceptions import InvalidSnapshotError
+
+MAGIC = b'FBCSNAP\x00'
+VERSION = 1
+_HEADER = struct.Struct('<8sII')
+
+# column types
+_FLOAT = 'd' # float64, NaN for None
+_INT = 'q' # int64, _INT_NONE for None
+_STRING = 's' # uint32 index in the string table
+_JSON = 'j' # uint32 index in the string table of the JSON encoded value
+
+_INT_NONE = -2 ** 63
+_INDEX_NONE = 0xFFFFFFFF # value is None
+_INDEX_ABSENT = 0xFFFFFFFE # key is not present in the row
+
+# small payloads saved in the directory and row tables saved column wise
+META_KEYS = ['entity_id', 'link_id', 'loaded', 'accounts', 'fraud_info', 'identity', 'credit_recurring', 'debit_recurring']
+TABLE_KEYS = ['transactions', 'salary', 'lender_transactions']
+
+class _Writer:
+
+    def __init__(self):
+        self.arrays = [] # bytes, in file order
+        self.size = 0
+        self.strings = dict() # string -> index
+
+    def add_array(self, data):
+        # returns the offset of the array relative to the data section, keeping 8 byte alignment
+        offset = self.size
+        self.arrays.append(data)
+        padding = -len(data) % 8
+        if padding:
+            self.arrays.append(b'\x00' * padding)
+        self.size += len(data) + padding
+        return offset
+
+    def string_index(self, value):
+        index = self.strings.get(value)
+        if index is None:
+            index = len(self.strings)
+            self.strings[value] = index
+        return index
+
+def _column_type(values, present_in_all):
+    non_null = [value for value in values if value is not None]
+    if present_in_all and non_null:
+        if all(type(value) is float for value in non_null):
+            return _FLOAT
+        if all(type(value) is int for value in non_null) and all(_INT_NONE < value < 2 ** 63 for value in non_null):
+            return _INT
+    if all(value is None or type(value) is str for value in values):
+        return _STRING
+    return _JSON
+
+def _write_table(writer, rows, dates):
+    keys = []
+    seen = set()
+    for row in rows:
+        for key in row:
+            if key not in seen:
+                seen.add(key)
+                keys.append(key)
+
+    columns = []
+    for key in keys:
+        present_in_all = all(key in row for row in rows)
+        values = [row.get(key) for row in rows]
+        column_type = _column_type(values, present_in_all)
+        if column_type == _FLOAT:
+            data = struct.pack('<{}d'.format(len(values)), *[float('nan') if value is None else value for value in values])
+        elif column_type == _INT:
+            data = struct.pack('<{}q'.format(len(values)), *[_INT_NONE if value is None else value for value in values])
+        else:
+            indexes = []
+            for row in rows:
+                if key not in row:
+                    indexes.append(_INDEX_ABSENT)
+                elif row[key] is None:
+                    indexes.append(_INDEX_NONE)
+                elif column_type == _STRING:
+                    indexes.append(writer.string_index(row[key]))
+                else:
+                    indexes.append(writer.string_index(json.dumps(row[key], sort_keys=True)))
+            data = struct.pack('<{}I'.format(len(indexes)), *indexes)
+        columns.append([key, column_type, writer.add_array(data)])
+
+    ordinals = [0 if curr_date is None else curr_date.toordinal() for curr_date in dates]
+    return {'rows': len(rows), 'columns': columns, 'dates': writer.add_array(struct.pack('<{}i'.format(len(ordinals)), *ordinals))}
+
+def _encode(payloads):
+    # returns the list of bytes chunks making the snapshot of the payloads
+    writer = _Writer()
+    directory = {'meta': dict((key, payloads[key]) for key in META_KEYS if key in payloads), 'tables': dict()}
+    for key in TABLE_KEYS:
+        if key not in payloads:
+            continue
+        table = payloads[key]
+        rows = list(table)
+        dates = getattr(table, 'dates', None)
+        if dates is None:
+            dates = [parse_date(row.get('date')) for row in rows]
+        directory['tables'][key] = _write_table(writer, rows, list(dates))
+
+    # string table: offsets (uint64, count + 1) and the utf-8 blob
+    encoded = [value.encode('utf-8') for value in sorted(writer.strings, key=writer.strings.get)]
+    offsets = [0]
+    for value in encoded:
+        offsets.append(offsets[-1] + len(value))
+    directory['strings'] = {
+        'count': len(encoded),
+        'offsets': writer.add_array(struct.pack('<{}Q'.format(len(offsets)), *offsets)),
+        'blob': writer.add_array(b''.join(encoded))
+    }
+
+    directory_bytes = json.dumps(directory).encode('utf-8')
+    directory_bytes += b' ' * (-(_HEADER.size + len(directory_bytes)) % 8)
+    return [_HEADER.pack(MAGIC, VERSION, len(directory_bytes)), directory_bytes] + writer.arrays
+
+def write(path, payloads):
+    """Writes the snapshot file atomically (written to a temporary file and renamed)
+
+    arguments:
+    path -- the snapshot file path
+    payloads -- dictionary with any of META_KEYS and TABLE_KEYS, tables being list of dictionary or TransactionStore
+    """
+    # a temporary file of its own in the target directory, so concurrent writers (threads or processes) never share it
+    fd, temp_path = tempfile.mkstemp(suffix='.tmp', prefix=os.path.basename(path) + '.', dir=os.path.dirname(os.path.abspath(path)))
+    try:
+        with os.fdopen(fd, 'wb') as file_obj:
+            for data in _encode(payloads):
+                file_obj.write(data)
+            file_obj.flush()
+            os.fsync(file_obj.fileno())
+        os.replace(temp_path, path)
+    except BaseException:
+        os.unlink(temp_path)
+        raise
+
+def dumps(payloads):
+    """Returns the snapshot of the payloads as bytes, e.g. to send it to another process, see loads
+
+    arguments:
+    payloads -- dictionary with any of META_KEYS and TABLE_KEYS, tables being list of dictionary or TransactionStore
+    """
+    return b''.join(_encode(payloads))
+
+class Snapshot:
+    """Read-only snapshot over a memory mapped file or bytes, see open_snapshot and loads"""
+
+    def __init__(self, data, mapping=None):
+        if not sys.byteorder == 'little':
+            # the arrays are read in place, so the host must match the little endian file layout
+            raise InvalidSnapshotError
+        self._mmap = mapping
+        self._buffer = memoryview(data)
+        if len(self._buffer) < _HEADER.size:
+            raise InvalidSnapshotError
+        magic, version, directory_length = _HEADER.unpack_from(self._buffer, 0)
+        if not magic == MAGIC or not version == VERSION:
+            raise InvalidSnapshotError
+        directory = json.loads(self._buffer[_HEADER.size:_HEADER.size + directory_length].tobytes().decode('utf-8'))
+        self._data_offset = _HEADER.size + directory_length
+        self.meta = directory['meta']
+
+        strings = directory['strings']
+        self._string_offsets = self._array(strings['offsets'], 'Q', strings['count'] + 1)
+        self._string_blob = self._data_offset + strings['blob']
+        self.tables = dict((key, SnapshotTable(self, table)) for key, table in directory['tables'].items())
+
+    def _array(self, offset, format_character, count):
+        # zero copy typed view over the mapped file
+        start = self._data_offset + offset
+        return self._buffer[start:start + count * struct.calcsize(format_character)].cast(format_character)
+
+    def string(self, index):
+        """Returns the string at index of the string table"""
+        start = self._string_blob + self._string_offsets[index]
+        end = self._string_blob + self._string_offsets[index + 1]
+        return self._buffer[start:end].tobytes().decode('utf-8')
+
+    def close(self):
+        """Releases the views and unmaps the file if any (rows already built stay usable)"""
+        for table in self.tables.values():
+            table.release()
+        self._string_offsets.release()
+        self._buffer.release()
+        if self._mmap is not None:
+            self._mmap.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+class SnapshotTable:
+    """Column wise row table of a snapshot, behaves as a read-only sequence of row dictionaries"""
+
+    def __init__(self, snapshot, table):
+        self._snapshot = snapshot
+        self._count = table['rows']
+        self._columns = []
+        for key, column_type, offset in table['columns']:
+            format_character = 'I' if column_type in (_STRING, _JSON) else column_type
+            self._columns.append((key, column_type, snapshot._array(offset, format_character, self._count)))
+        self._ordinals = snapshot._array(table['dates'], 'i', self._count)
+        self.dates = _SnapshotDates(self._ordinals)
+
+    def __len__(self):
+        return self._count
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(self._count))]
+        if index < 0:
+            index += self._count
+        if not 0 <= index < self._count:
+            raise IndexError("snapshot row index out of range")
+        row = dict()
+        for key, column_type, values in self._columns:
+            value = values[index]
+            if column_type == _FLOAT:
+                row[key] = None if value != value else value
+            elif column_type == _INT:
+                row[key] = None if value == _INT_NONE else value
+            elif value == _INDEX_ABSENT:
+                continue
+            elif value == _INDEX_NONE:
+                row[key] = None
+            elif column_type == _STRING:
+                row[key] = self._snapshot.string(value)
+            else:
+                row[key] = json.loads(self._snapshot.string(value))
+        return row
+
+    def __iter__(self):
+        for index in range(self._count):
+            yield self[index]
+
+    def number_values(self, key):
+        """Returns the zero copy float64 / int64 view of a numeric column, or None if the column isn't numeric"""
+        for column_key, column_type, values in self._columns:
+            if column_key == key and column_type in (_FLOAT, _INT):
+                return values
+        return None
+
+    @property
+    def date_ordinals(self):
+        """Returns the zero copy int32 view of the date ordinals (0 for invalid dates)"""
+        return self._ordinals
+
+    def release(self):
+        for key, column_type, values in self._columns:
+            values.release()
+        self._ordinals.release()
+
+class _SnapshotDates:
+    # read-only sequence of datetime.date (None for invalid dates) over the ordinals view
+
+    def __init__(self, ordinals):
+        self._ordinals = ordinals
+
+    def __len__(self):
+        return len(self._ordinals)
+
+    def __getitem__(self, index):
+        ordinal = self._ordinals[index]
+        return None if ordinal == 0 else datetime.date.fromordinal(ordinal)
+
+    def __iter__(self):
+        fromordinal = datetime.date.fromordinal
+        for ordinal in self._ordinals:
+            yield None if ordinal == 0 else fromordinal(ordinal)
+
+    def count(self, value):
+        return sum(1 for curr_date in self if curr_date == value)
+
+def open_snapshot(path):
+    """Opens the snapshot file read-only through mmap and returns the Snapshot
+
+    arguments:
+    path -- the snapshot file path
+    """
+    with open(path, 'rb') as file_obj:
+        mapping = mmap.mmap(file_obj.fileno(), 0, access=mmap.ACCESS_READ)
+    return Snapshot(mapping, mapping)
+
+def loads(data):
+    """Returns the Snapshot over the bytes returned by dumps, read in place without copying
+
+    arguments:
+    data -- bytes (or bytearray / memoryview) of the snapshot
+    """
+    return Snapshot(data)
@@ -0,0 +1,355 @@
+"""Durable spool of statement uploads
+
+UploadSpool keeps the statements to upload in a local directory: a copy of each pdf file and a write-ahead
+journal (one JSON record per line, flushed to disk before submit returns) with the state of every upload
+(pending, uploading, done or failed) and the returned entity_id. Background threads drain the spool
+concurrently (at backfill priority by default, see finbox_bankconnect.scheduler), and a spool opened
+again on the same directory after a crash or restart resumes the uploads which were not done, without
+uploading the done ones again. An upload interrupted while in flight is sent again, so uploads are at
+least once.
+
+The journal is compacted to the latest record of each upload when it has grown to twice their number (and
+on open), and only the latest history uploads done or failed are kept (status returns None for the older ones).
+
+The journal keeps the pdf passwords given, so the spool directory and the spooled copies are created readable
+by their owner only.
+
+With an optimizer (finbox_bankconnect.pdf_optimizer.PdfOptimizer), the spooled copies are rewritten smaller by
+its worker processes as soon as they are submitted, while the uploads before them are in flight, and the bytes
+saved are journaled with the upload.
+
+Example:
+spool = UploadSpool("/var/spool/bankconnect")
+spool.start()
+upload_id = spool.submit("statement.pdf", link_id="LINK_ID")
+...
+spool.status(upload_id) # {'state': 'done', 'entity_id': ..., 'is_authentic': True, ...}
+"""
+import json
+import os
+import shutil
+import threading
+import time
+import uuid
+from collections import deque
+import finbox_bankconnect
+import finbox_bankconnect.metrics as metrics
+from finbox_bankconnect.scheduler import priority as request_priority, validate_priority
+from finbox_bankconnect.custom_exceptions import ServiceTimeOutError
+
+JOURNAL_NAME = 'journal.log'
+COMPACT_MIN_LINES = 1000 # journal lines appended before it may be compacted
+
+PENDING = 'pending'
+UPLOADING = 'uploading'
+DONE = 'done'
+FAILED = 'failed'
+
+class UploadSpool:
+    """Durable spool of statement uploads drained by background threads, see the module documentation"""
+
+    def __init__(self, directory, client=None, workers=4, priority='backfill', max_attempts=5, retry_interval=5, optimizer=None,
+            history=1000):
+        """Opens (or creates) the spool in the directory, replaying its journal
+
+        arguments:
+        directory -- path of the spool directory
+        client (optional) -- the finbox_bankconnect.Client to upload with (default: package level configuration)
+        workers (optional) (default: 4) -- number of background upload threads
+        priority (optional) (default: backfill) -- priority of the upload requests
+        max_attempts (optional) (default: 5) -- attempts for an upload failing with a service error
+        retry_interval (optional) (default: 5) -- seconds to wait before retrying such an upload
+        optimizer (optional) -- finbox_bankconnect.pdf_optimizer.PdfOptimizer rewriting the spooled files before their upload
+        history (optional) (default: 1000) -- number of uploads done or failed whose records are kept
+        """
+        validate_priority(priority)
+        self.directory = directory
+        self.client = client
+        self.workers = workers
+        self.priority = priority
+        self.max_attempts = max_attempts
+        self.retry_interval = retry_interval
+        self.optimizer = optimizer
+        self.history = history
+
+        self._lock = threading.Condition()
+        self._records = dict() # upload_id -> latest record
+        self._queue = deque() # upload_ids to upload, in submission order
+        self._finished = deque() # upload_ids done or failed, oldest first
+        self._appended = 0 # lines appended to the journal since it was compacted
+        self._optimizations = dict() # upload_id -> future of the rewriting of its spooled file
+        self._active = 0 # uploads in progress
+        self._threads = []
+        self._stopping = False
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory, mode=0o700)
+        self._journal_path = os.path.join(directory, JOURNAL_NAME)
+        self._recover()
+
+    def _recover(self):
+        # replays the journal, re-queues the uploads not finished and compacts the journal to the latest records
+        self._journal = None
+        if os.path.exists(self._journal_path):
+            with open(self._journal_path, 'r') as journal:
+                for line in journal:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # torn last line of a crash in the middle of a write
+                        continue
+                    self._records[record['id']] = record
+        for name in os.listdir(self.directory):
+            if name.endswith('.optimizing'):
+                # partial rewrite of a crash, the spooled file is still the original
+                os.remove(os.path.join(self.directory, name))
+        for record in sorted(self._records.values(), key=lambda record: record.get('finished_at') or record['submitted_at']):
+            if record['state'] in (PENDING, UPLOADING):
+                record['state'] = PENDING
+                if record.get('bytes_saved') is None:
+                    self._optimize(record)
+                self._queue.append(record['id'])
+            else:
+                self._finished.append(record['id'])
+        self._trim()
+        self._compact()
+
+    def _trim(self):
+        # forgets the oldest uploads done or failed beyond the history kept (called holding the lock or on open)
+        while len(self._finished) > self.history:
+            del self._records[self._finished.popleft()]
+
+    def _compact(self):
+        # rewrites the journal with the latest record of each upload kept (called holding the lock or on open)
+        temp_path = "{}.tmp".format(self._journal_path)
+        with open(os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'w') as journal:
+            for record in self._records.values():
+                journal.write(json.dumps(record) + '\n')
+            journal.flush()
+            os.fsync(journal.fileno())
+        if self._journal is not None:
+            self._journal.close()
+        os.replace(temp_path, self._journal_path)
+        self._journal = open(os.open(self._journal_path, os.O_WRONLY | os.O_APPEND, 0o600), 'a')
+        self._appended = 0
+
+    def _write(self, record):
+        # appends the record to the journal, durable once this returns (called holding the lock)
+        self._records[record['id']] = record
+        self._journal.write(json.dumps(record) + '\n')
+        self._journal.flush()
+        os.fsync(self._journal.fileno())
+        if record['state'] in (DONE, FAILED):
+            self._finished.append(record['id'])
+            self._trim()
+        self._appended += 1
+        if self._appended >= max(COMPACT_MIN_LINES, len(self._records)):
+            self._compact()
+
+    def submit(self, file_path, link_id=None, entity_id=None, pdf_password=None, bank_name=None):
+        """Copies the statement into the spool and journals it, returns the upload_id string once it is durable
+
+        arguments:
+        file_path -- path of the pdf file
+        link_id (optional) -- link_id string to create the entity with
+        entity_id (optional) -- entity id string to upload the statement to an existing entity
+        pdf_password (optional) -- pdf password string
+        bank_name (optional) -- bank name string
+        """
+        if not file_path or not type(file_path) == str:
+            raise ValueError("file_path must be a non blank string")
+        if not file_path.lower().endswith('.pdf'):
+            raise ValueError("file_path must be of a pdf file")
+        if link_id is not None and entity_id is not None:
+            raise ValueError("only one of link_id and entity_id can be provided")
+
+        upload_id = str(uuid.uuid4())
+        spooled_path = os.path.join(self.directory, "{}.pdf".format(upload_id))
+        with open(file_path, 'rb') as source, open(os.open(spooled_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600), 'wb') as spooled:
+            shutil.copyfileobj(source, spooled)
+            spooled.flush()
+            os.fsync(spooled.fileno())
+
+        record = {
+            'id': upload_id,
+            'state': PENDING,
+            'file_path': spooled_path,
+            'link_id': link_id,
+            'entity_id': entity_id,
+            'pdf_password': pdf_password,
+            'bank_name': bank_name,
+            'submitted_at': time.time(),
+            'finished_at': None,
+            'attempts': 0,
+            'bytes_saved': None,
+            'is_authentic': None,
+            'error': None
+        }
+        with self._lock:
+            self._write(record)
+            # scheduled before it is queued, so that the upload waits for it
+            self._optimize(record)
+            self._queue.append(upload_id)
+            self._lock.notify_all()
+        metrics.increment('spool_submitted')
+        return upload_id
+
+    def status(self, upload_id):
+        """Returns the record dictionary (state, entity_id, is_authentic, error, ...) of the upload, None if unknown
+            (or done or failed before the history kept)
+
+        arguments:
+        upload_id -- the upload_id string returned by submit
+        """
+        with self._lock:
+            record = self._records.get(upload_id)
+            if record is None:
+                return None
+            record = dict(record)
+        # never hand out the password
+        record.pop('pdf_password', None)
+        return record
+
+    def pending_count(self):
+        """Returns the number of uploads not done or failed yet"""
+        with self._lock:
+            return len(self._queue) + self._active
+
+    def start(self):
+        """Starts the background upload threads"""
+        with self._lock:
+            if self._threads:
+                return
+            self._stopping = False
+            for i in range(self.workers):
+                thread = threading.Thread(target=self._run, name="finbox-spool-{}".format(i))
+                thread.daemon = True
+                thread.start()
+                self._threads.append(thread)
+
+    def stop(self, wait=True):
+        """Stops the background upload threads after their current upload, the rest stays spooled
+
+        arguments:
+        wait (optional) (default: True) -- wait for the threads to finish
+        """
+        with self._lock:
+            self._stopping = True
+            self._lock.notify_all()
+            threads = self._threads
+            self._threads = []
+        if wait:
+            for thread in threads:
+                thread.join()
+
+    def wait(self, timeout=None):
+        """Waits till the spool is drained, returns False if timed out
+
+        arguments:
+        timeout (optional) -- seconds to wait at most
+        """
+        expires_at = None if timeout is None else time.monotonic() + timeout
+        with self._lock:
+            while self._queue or self._active:
+                remaining = None if expires_at is None else expires_at - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._lock.wait(remaining)
+        return True
+
+    def close(self):
+        """Stops the background threads and closes the journal"""
+        self.stop()
+        with self._lock:
+            self._journal.close()
+
+    def _run(self):
+        while True:
+            with self._lock:
+                while not self._queue and not self._stopping:
+                    self._lock.wait()
+                if self._stopping:
+                    return
+                record = dict(self._records[self._queue.popleft()])
+                record['state'] = UPLOADING
+                record['attempts'] += 1
+                self._write(record)
+                self._active += 1
+            try:
+                self._upload(record)
+            finally:
+                with self._lock:
+                    self._active -= 1
+                    self._lock.notify_all()
+
+    def _optimize(self, record):
+        # schedules the rewriting of the spooled file if there is an optimizer (called holding the lock or on open)
+        if self.optimizer is not None:
+            self._optimizations[record['id']] = self.optimizer.submit(record['file_path'], record['pdf_password'])
+
+    def _wait_optimization(self, record):
+        # waits for the rewriting of the spooled file if scheduled (if it failed the file is uploaded as it is)
+        with self._lock:
+            future = self._optimizations.pop(record['id'], None)
+        if future is not None:
+            record['bytes_saved'] = future.result().bytes_saved
+
+    def _upload(self, record):
+        self._wait_optimization(record)
+        entity_class = finbox_bankconnect.Entity if self.client is None else self.client.Entity
+        try:
+            if record['entity_id'] is not None:
+                entity = entity_class.get(record['entity_id'], priority=self.priority)
+            else:
+                entity = entity_class.create(record['link_id'], priority=self.priority)
+                if record['link_id'] is not None:
+                    # the entity is created and journaled before the upload, so the retries (and the restarts
+                    # replaying the journal) upload to it instead of creating another one for the link_id
+                    record['entity_id'] = entity.entity_id
+                    with self._lock:
+                        self._write(record)
+            with request_priority(self.priority):
+                is_authentic = entity.upload_statement(record['file_path'], record['pdf_password'], record['bank_name'])
+            record['entity_id'] = entity.entity_id
+            record['is_authentic'] = is_authentic
+            record['state'] = DONE
+        except Exception as e:
+            record['error'] = "{}: {}".format(type(e).__name__, e)
+            if self._is_retryable(e) and record['attempts'] < self.max_attempts:
+                # back in the queue after the retry interval, the journal keeps it pending meanwhile
+                record['state'] = PENDING
+                with self._lock:
+                    self._write(record)
+                    self._active += 1
+                timer = threading.Timer(self.retry_interval, self._requeue, args=(record['id'],))
+                timer.daemon = True
+                timer.start()
+                metrics.increment('spool_retried')
+                return
+            record['state'] = FAILED
+
+        record['finished_at'] = time.time()
+        with self._lock:
+            self._write(record)
+        if record['state'] == DONE:
+            metrics.increment('spool_uploaded')
+        else:
+            metrics.increment('spool_failed')
+        # the journal keeps the outcome, the spooled copy isn't needed anymore
+        try:
+            os.remove(record['file_path'])
+        except OSError:
+            pass
+
+    def _requeue(self, upload_id):
+        with self._lock:
+            self._active -= 1
+            self._queue.append(upload_id)
+            self._lock.notify_all()
+
+    @staticmethod
+    def _is_retryable(error):
+        # service errors and network failures are retried, errors about the statement itself are final
+        if isinstance(error, ServiceTimeOutError):
+            return True
+        return type(error).__module__.split('.')[0] in ('requests', 'urllib3', 'httpx', 'httpcore', 'h2')
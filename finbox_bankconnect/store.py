@@ -0,0 +1,142 @@
+import datetime
+from itertools import compress
+from finbox_bankconnect.utils import parse_date, import_optional
+
+# minimum number of rows for which filters are evaluated as vectorized masks over columns (if numpy is installed)
+VECTORIZE_MIN_ROWS = 2048
+
+def transaction_key(row):
+    # identifies a row across fetches, by the hash sent by the API if present, else by its contents
+    key = row.get('hash')
+    if key is not None:
+        return key
+    return (row.get('account_id'), row.get('date'), row.get('transaction_type'), row.get('amount'),
+            row.get('balance'), row.get('transaction_note'))
+
+class TransactionStore:
+    """Keeps a list of transaction rows (list of dictionary) along with their dates parsed once at fetch time
+
+    Rows with missing or invalid dates are flagged by a None date, so that they are skipped by
+    date filters without being parsed again on every call.
+    """
+
+    def __init__(self, rows=None, dates=None):
+        """Creates the store, parsing the dates of the rows unless already parsed dates are given
+
+        arguments:
+        rows (optional) -- list (or read-only sequence, e.g. a snapshot table) of dictionary
+        dates (optional) -- list of datetime.date (None for invalid) parsed before for the rows
+        """
+        self.rows = rows if rows is not None else []
+        self.dates = dates if dates is not None else [parse_date(row.get('date')) for row in self.rows]
+        self._columns = dict()
+
+    def merge(self, rows):
+        """Replaces the rows with the freshly fetched rows, reusing the parsed dates of the rows already present
+            so that only new or changed rows are parsed, returns a tuple (added, removed) with the row counts
+
+        arguments:
+        rows -- the fetched list of dictionary
+        """
+        previous = dict()
+        for row, curr_date in zip(self.rows, self.dates):
+            previous.setdefault(transaction_key(row), []).append((row.get('date'), curr_date))
+
+        dates = []
+        added = 0
+        for row in rows:
+            matches = previous.get(transaction_key(row))
+            if matches and matches[-1][0] == row.get('date'):
+                dates.append(matches.pop()[1])
+            else:
+                dates.append(parse_date(row.get('date')))
+                added += 1
+        removed = len(self.rows) + added - len(rows)
+
+        # swap in new lists so iterators handed out before the merge keep working on the old rows
+        self.rows = rows
+        self.dates = dates
+        self._columns = dict()
+        return added, removed
+
+    def __iter__(self):
+        return iter(self.rows)
+
+    def __len__(self):
+        return len(self.rows)
+
+    @property
+    def invalid_date_count(self):
+        """Returns the number of rows having a missing or invalid date"""
+        return self.dates.count(None)
+
+    @property
+    def numpy(self):
+        """Returns the numpy module if installed, else None"""
+        return import_optional('numpy')
+
+    def filter_dates(self, date_filter):
+        """Returns the iterator to rows whose pre-parsed date passes the date_filter
+
+        arguments:
+        date_filter -- function taking a datetime.date (or None for invalid dates) and returning a boolean
+        """
+        return compress(self.rows, map(date_filter, self.dates))
+
+    def select(self, expression):
+        """Returns the iterator to rows matching the given filter expression (all rows if it is None)
+
+        arguments:
+        expression -- a filters.Filter expression or None
+        """
+        if expression is None:
+            return iter(self.rows)
+        if len(self.rows) >= VECTORIZE_MIN_ROWS and self.numpy is not None:
+            mask = expression.mask(self)
+            return compress(self.rows, mask.tolist())
+        return compress(self.rows, map(expression.compile(), self.rows, self.dates))
+
+    def column(self, key):
+        """Returns the numpy object array of the given key over all rows (cached)
+
+        arguments:
+        key -- the row key
+        """
+        if key not in self._columns:
+            np = self.numpy
+            values = np.empty(len(self.rows), dtype=object)
+            values[:] = [row.get(key) for row in self.rows]
+            self._columns[key] = values
+        return self._columns[key]
+
+    def number_column(self, key):
+        """Returns the numpy float array of the given key over all rows (cached), NaN for missing values
+
+        arguments:
+        key -- the row key
+        """
+        column_key = ('number', key)
+        if column_key not in self._columns and hasattr(self.rows, 'number_values'):
+            # snapshot backed rows, use the mapped column without building the rows
+            values = self.rows.number_values(key)
+            if values is not None and values.format == 'd':
+                self._columns[column_key] = self.numpy.frombuffer(values, dtype=float)
+        if column_key not in self._columns:
+            nan = float('nan')
+            values = [row.get(key) for row in self.rows]
+            self._columns[column_key] = self.numpy.array([nan if value is None else value for value in values], dtype=float)
+        return self._columns[column_key]
+
+    def date_column(self):
+        """Returns the numpy datetime64 array of the pre-parsed dates (cached), NaT for invalid dates"""
+        if 'date' not in self._columns:
+            if hasattr(self.rows, 'date_ordinals'):
+                # snapshot backed rows, convert the mapped day ordinals (0 for invalid) to days since 1970-01-01
+                np = self.numpy
+                ordinals = np.frombuffer(self.rows.date_ordinals, dtype=np.int32)
+                dates = (ordinals.astype(np.int64) - datetime.date(1970, 1, 1).toordinal()).astype('datetime64[D]')
+                dates[ordinals == 0] = np.datetime64('NaT')
+                self._columns['date'] = dates
+            else:
+                self._columns['date'] = self.numpy.array(self.dates, dtype='datetime64[D]')
+        return self._columns['date']
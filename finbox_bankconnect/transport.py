@@ -0,0 +1,265 @@
+"""HTTP transport used by the connector functions
+
+A Transport keeps a pooled (keep-alive) session to the API, admits the requests by priority (see
+finbox_bankconnect.scheduler), applies the rate limit and the connect / read timeouts of its configuration
+(cut to the current deadline, see finbox_bankconnect.deadline), hedges the GET requests if enabled (see
+finbox_bankconnect.hedging), negotiates compressed responses (gzip / deflate, and brotli / zstd if their
+decoders are installed) and keeps the validators (ETag / Last-Modified) of entity responses, so that
+re-fetches are sent as conditional requests and a 304 Not Modified is served from the already decoded payload.
+
+With the http2 setting of the configuration, the requests are multiplexed over HTTP/2 connections using
+httpx (pip install httpx[http2]), so that many concurrent polls share a few connections. The HTTP/1.1
+requests session is used instead if httpx isn't installed, if the server doesn't negotiate HTTP/2, or
+(with prior knowledge on cleartext connections) if the server turns out not to speak it.
+
+Each finbox_bankconnect.Client owns a Transport, the package level configuration uses the default one.
+"""
+import sys
+import threading
+import time
+from collections import OrderedDict
+import finbox_bankconnect
+import finbox_bankconnect.metrics as metrics
+import finbox_bankconnect.deadline as deadline
+from finbox_bankconnect.scheduler import Scheduler
+from finbox_bankconnect.hedging import Hedger
+from finbox_bankconnect.custom_exceptions import ServiceTimeOutError, DeadlineExceededError
+
+class Transport:
+    """Pooled HTTP transport for one configuration (a Client or the finbox_bankconnect module)"""
+
+    def __init__(self, config):
+        self.config = config
+        self._session = None
+        self._session_lock = threading.Lock()
+        self._validators = OrderedDict() # (entity_id, resource) -> (etag, last modified, decoded payload), in LRU order
+        self._validators_lock = threading.Lock()
+        self._rate_lock = threading.Lock()
+        self._next_slot = 0
+        self.scheduler = Scheduler(config)
+        self.hedger = Hedger(config)
+
+    def get_session(self):
+        """Returns the pooled session (HTTP/2 session if enabled and available, else requests session), created on first use"""
+        if self._session is None:
+            with self._session_lock:
+                if self._session is None:
+                    session = None
+                    if getattr(self.config, 'http2', False):
+                        session = self._create_http2_session()
+                    self._session = session or self._create_requests_session()
+        return self._session
+
+    def _create_requests_session(self):
+        import requests
+        from urllib3.util import make_headers
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=self.config.connection_pool_size)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        # accept every encoding urllib3 can decode in this environment
+        session.headers.update(make_headers(accept_encoding=True))
+        return session
+
+    def _create_http2_session(self):
+        # returns None if httpx (with its h2 dependency) isn't installed
+        try:
+            import httpx
+            import h2
+        except ImportError:
+            metrics.increment('http2_unavailable')
+            return None
+        return HTTP2Session(httpx, self.config, self._create_requests_session)
+
+    def throttle(self):
+        """Waits for the next request slot allowed by the rate_limit (requests per second) of the configuration"""
+        rate_limit = self.config.rate_limit
+        if not rate_limit:
+            return
+        with self._rate_lock:
+            now = time.monotonic()
+            self._next_slot = max(self._next_slot, now)
+            wait = self._next_slot - now
+            self._next_slot += 1.0 / rate_limit
+        if wait > 0:
+            metrics.increment('rate_limited')
+            deadline.sleep(wait)
+
+    def request(self, method, url, **kwargs):
+        """Sends the request using the pooled session once the scheduler admits it at the current thread's
+            priority, and returns the response
+
+        arguments:
+        method -- HTTP method string
+        url -- the url string
+        kwargs -- passed to requests.Session.request
+        """
+        deadline.check()
+        with self.scheduler.slot():
+            self.throttle()
+            session = self.get_session()
+            kwargs.setdefault('timeout', (deadline.clip(self.config.connect_timeout), deadline.clip(self.config.read_timeout)))
+            try:
+                return session.request(method, url, **kwargs)
+            except Exception as e:
+                if not _is_timeout(e):
+                    raise
+                metrics.increment('request_timeouts')
+                deadline.check()
+                raise ServiceTimeOutError
+
+    def get(self, url, **kwargs):
+        """Sends a GET request, hedged if hedge_percentile is set in the configuration (see
+            finbox_bankconnect.hedging), and returns the response
+
+        arguments:
+        url -- the url string
+        kwargs -- passed to request
+        """
+        if not getattr(self.config, 'hedge_percentile', None):
+            return self.request('GET', url, **kwargs)
+        return self.hedger.send(lambda: self.request('GET', url, **kwargs))
+
+    def get_cached(self, key, url, headers, decode):
+        """Sends a conditional GET request if a validator is kept for the key and returns the tuple
+            (status_code, decoded payload or None), a 304 Not Modified is returned as status 200 with the
+            previously decoded payload (the payload is decoded only for 200 responses)
+
+        arguments:
+        key -- cache key tuple, e.g. (entity_id, resource)
+        url -- the url string
+        headers -- request headers dictionary
+        decode -- function decoding the response bytes
+        """
+        with self._validators_lock:
+            cached = self._validators.get(key)
+        request_headers = dict(headers)
+        if cached is not None:
+            etag, last_modified, payload = cached
+            if etag is not None:
+                request_headers['If-None-Match'] = etag
+            if last_modified is not None:
+                request_headers['If-Modified-Since'] = last_modified
+
+        response = self.get(url, headers=request_headers)
+        if response.status_code == 304 and cached is not None:
+            metrics.increment('conditional_not_modified')
+            with self._validators_lock:
+                if key in self._validators:
+                    self._validators.move_to_end(key)
+            return 200, cached[2]
+        if not response.status_code == 200:
+            return response.status_code, None
+
+        payload = decode(response.content)
+        etag = response.headers.get('ETag')
+        last_modified = response.headers.get('Last-Modified')
+        cache_size = self.config.conditional_cache_size
+        with self._validators_lock:
+            if cache_size and (etag is not None or last_modified is not None):
+                self._validators[key] = (etag, last_modified, payload)
+                self._validators.move_to_end(key)
+                while len(self._validators) > cache_size:
+                    self._validators.popitem(last=False)
+            else:
+                self._validators.pop(key, None)
+        return 200, payload
+
+    def forget(self, entity_id, resource):
+        """Drops the kept validators and payloads of an entity resource (of all its scopes), so that the decoded
+            payload isn't referenced anymore, e.g. once evicted by the memory budget
+
+        arguments:
+        entity_id -- entity id string
+        resource -- resource name, e.g. transactions
+        """
+        with self._validators_lock:
+            for key in [key for key in self._validators if key[0] == entity_id and key[1] == resource]:
+                del self._validators[key]
+
+    def clear_cache(self):
+        """Clears the kept validators and payloads of the conditional requests"""
+        with self._validators_lock:
+            self._validators.clear()
+
+def _is_timeout(error):
+    # timeout exceptions of requests, or of httpx if the HTTP/2 session is used
+    import requests
+    if isinstance(error, requests.exceptions.Timeout):
+        return True
+    httpx = sys.modules.get('httpx')
+    return httpx is not None and isinstance(error, httpx.TimeoutException)
+
+class HTTP2Session:
+    """Session sending the requests over multiplexed HTTP/2 connections using httpx, with the request arguments
+        and responses used by the connector (same as the requests session it falls back to)
+    """
+
+    def __init__(self, httpx, config, create_fallback):
+        self._httpx = httpx
+        # the http2 setting 'prior_knowledge' speaks HTTP/2 on cleartext (http://) connections without negotiation
+        prior_knowledge = config.http2 == 'prior_knowledge'
+        limits = httpx.Limits(max_connections=config.connection_pool_size, max_keepalive_connections=config.connection_pool_size)
+        self._client = httpx.Client(http1=not prior_knowledge, http2=True, limits=limits, timeout=None)
+        self._create_fallback = create_fallback
+        self._fallback = None
+        self._lock = threading.Lock()
+        self._confirmed = False
+
+    def request(self, method, url, headers=None, data=None, files=None, timeout=None):
+        """Sends the request and returns the httpx response (or requests response once fallen back to HTTP/1.1)"""
+        if self._fallback is not None:
+            return self._fallback.request(method, url, headers=headers, data=data, files=files, timeout=timeout)
+        http2_timeout = timeout
+        if isinstance(timeout, tuple):
+            connect_timeout, read_timeout = timeout
+            http2_timeout = self._httpx.Timeout(connect=connect_timeout, read=read_timeout, write=read_timeout, pool=connect_timeout)
+        try:
+            response = self._client.request(method, url, headers=headers, data=data, files=files, timeout=http2_timeout)
+        except self._httpx.RemoteProtocolError:
+            if self._confirmed:
+                raise
+            # the server doesn't speak HTTP/2, use HTTP/1.1 from now on
+            with self._lock:
+                if self._fallback is None:
+                    metrics.increment('http2_fallbacks')
+                    self._fallback = self._create_fallback()
+            return self.request(method, url, headers=headers, data=data, files=files, timeout=timeout)
+        if response.http_version == 'HTTP/2':
+            self._confirmed = True
+        else:
+            metrics.increment('http2_not_negotiated')
+        return response
+
+    def close(self):
+        self._client.close()
+        if self._fallback is not None:
+            self._fallback.close()
+
+_default = None
+_default_lock = threading.Lock()
+
+def get_default():
+    """Returns the transport of the package level configuration (finbox_bankconnect module attributes)"""
+    global _default
+    if _default is None:
+        with _default_lock:
+            if _default is None:
+                _default = Transport(finbox_bankconnect)
+    return _default
+
+def get_session():
+    """Returns the pooled requests session of the default transport"""
+    return get_default().get_session()
+
+def request(method, url, **kwargs):
+    """Sends the request using the default transport and returns the response"""
+    return get_default().request(method, url, **kwargs)
+
+def get_cached(key, url, headers, decode):
+    """Conditional GET using the default transport, see Transport.get_cached"""
+    return get_default().get_cached(key, url, headers, decode)
+
+def clear_cache():
+    """Clears the kept validators and payloads of the default transport"""
+    get_default().clear_cache()
@@ -1,3 +1,7 @@
+import datetime
+
+DATE_FORMAT = "%Y-%m-%d %H:%M:%S"
+
 def is_valid_uuid4(value):
     from uuid import UUID
     try:
@@ -6,3 +10,43 @@ def is_valid_uuid4(value):
         return False
     # also check whether valid number of hyphens are present
     return value.count('-') == 4
+
+def parse_date(value):
+    """Parses a date string of format "%Y-%m-%d %H:%M:%S" and returns the datetime.date,
+        or None if the value is not a valid date string
+
+    arguments:
+    value -- the date string
+    """
+    try:
+        # fast path for the fixed width format sent by the API, slicing is much cheaper than strptime
+        if (len(value) == 19 and value[4] == '-' and value[7] == '-' and value[10] == ' '
+                and value[13] == ':' and value[16] == ':'
+                and (value[0:4] + value[5:7] + value[8:10] + value[11:13] + value[14:16] + value[17:19]).isdigit()):
+            if int(value[11:13]) < 24 and int(value[14:16]) < 60 and int(value[17:19]) < 60:
+                return datetime.date(int(value[0:4]), int(value[5:7]), int(value[8:10]))
+            return None
+    except (TypeError, ValueError):
+        return None
+    # slow path for anything else strptime would still accept (e.g. single digit month)
+    try:
+        return datetime.datetime.strptime(value, DATE_FORMAT).date()
+    except (TypeError, ValueError):
+        return None
+
+_optional_modules = dict()
+
+def import_optional(module_name):
+    """Imports and returns an optional dependency module, or None if it is not installed
+        (the result is cached so a missing module is looked up only once)
+
+    arguments:
+    module_name -- name of the module to import
+    """
+    if module_name not in _optional_modules:
+        import importlib
+        try:
+            _optional_modules[module_name] = importlib.import_module(module_name)
+        except ImportError:
+            _optional_modules[module_name] = None
+    return _optional_modules[module_name]
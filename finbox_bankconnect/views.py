@@ -0,0 +1,119 @@
+"""Salary, lender and recurring transactions derived locally from the transactions of an entity
+
+With finbox_bankconnect.derived_views set to True (or the derived_views argument of a Client), get_salary,
+get_lender_transactions, get_credit_recurring and get_debit_recurring build their rows from the transactions
+(cached, or fetched once for all of them) instead of polling one endpoint each, saving up to three requests
+per entity. The salary and lender views are derived only if the API tagged the transactions with their
+category, and the recurring views only if it tagged them with their recurring group, else the dedicated
+endpoints are called as without the setting (recurring transactions aren't guessed locally).
+
+The rows are indexed in one pass over the transactions, reusing their parsed dates:
+- salary: the rows of a category of SALARY_CATEGORIES
+- lender transactions: the rows of a category of LENDER_CATEGORIES
+- credit / debit recurring: the groups of rows of the same account, type and recurring group tag, like the
+  groups of the endpoint (account_id, transactions, start_date, end_date, median, ...)
+
+The categories are compared lowercase with underscores for spaces, and the sets can be changed to match the
+categories of your account.
+
+metrics counters:
+derived_views -- entities whose views were derived from their transactions
+derived_views_fallbacks -- views fetched from their endpoint as the transactions weren't tagged for them
+"""
+import re
+from finbox_bankconnect.store import TransactionStore
+
+CATEGORY_KEY = 'category' # row key of the category tag
+RECURRING_KEY = 'recurring_group' # row key of the recurring group tag (None for the rows not recurring)
+SALARY_CATEGORIES = set(['salary'])
+LENDER_CATEGORIES = set(['loan', 'loan_disbursement', 'emi', 'lender_transaction'])
+
+_NOISE = re.compile(r'[^a-z]+')
+
+def normalize_category(category):
+    """Returns the lowercase category string with underscores for spaces, None if missing
+
+    arguments:
+    category -- category string
+    """
+    if not category or not isinstance(category, str):
+        return None
+    return '_'.join(category.lower().split())
+
+def is_tagged(store, key=CATEGORY_KEY):
+    """Returns whether the rows of the store carry the tag (an empty store counts as tagged)
+
+    arguments:
+    store -- TransactionStore of the transactions
+    key (optional) (default: category) -- row key of the tag
+    """
+    if len(store) == 0:
+        return True
+    for row in store:
+        if row.get(key) is not None:
+            return True
+    return False
+
+def _median(amounts):
+    amounts = sorted(amounts)
+    middle = len(amounts) // 2
+    if len(amounts) % 2:
+        return amounts[middle]
+    return (amounts[middle - 1] + amounts[middle]) / 2.0
+
+def _recurring_group(key, members):
+    # returns the endpoint like dictionary of a recurring group, members being (row, date) sorted by date
+    account_id, transaction_type, group = key
+    first = members[0][0]
+    amounts = [row.get('amount') for row, curr_date in members if isinstance(row.get('amount'), (int, float))]
+    return {
+        'account_id': account_id,
+        'transaction_type': transaction_type,
+        'category': normalize_category(first.get(CATEGORY_KEY)),
+        'clean_transaction_note': ' '.join(_NOISE.sub(' ', (first.get('transaction_note') or '').lower()).split()),
+        'start_date': members[0][0].get('date'),
+        'end_date': members[-1][0].get('date'),
+        'median': _median(amounts) if amounts else None,
+        'transactions': [row for row, curr_date in members]
+    }
+
+def derive(store):
+    """Returns the dictionary of view name (salary, lender_transactions, credit_recurring, debit_recurring) ->
+        TransactionStore (list of group dictionary for the recurring views, None if the rows have no recurring
+        group tag), None if the rows have no category tag
+
+    arguments:
+    store -- TransactionStore of the transactions
+    """
+    if not is_tagged(store):
+        return None
+    salary_rows, salary_dates = [], []
+    lender_rows, lender_dates = [], []
+    recurring_tagged = is_tagged(store, RECURRING_KEY)
+    groups = dict() # (account_id, transaction_type, recurring group) -> list of (row, date)
+    for row, curr_date in zip(store.rows, store.dates):
+        category = normalize_category(row.get(CATEGORY_KEY))
+        if category in SALARY_CATEGORIES:
+            salary_rows.append(row)
+            salary_dates.append(curr_date)
+        if category in LENDER_CATEGORIES:
+            lender_rows.append(row)
+            lender_dates.append(curr_date)
+        transaction_type = row.get('transaction_type')
+        group = row.get(RECURRING_KEY)
+        if recurring_tagged and group is not None and curr_date is not None and transaction_type in ('credit', 'debit'):
+            groups.setdefault((row.get('account_id'), transaction_type, group), []).append((row, curr_date))
+
+    recurring = {'credit': [], 'debit': []}
+    for key, members in groups.items():
+        members.sort(key=lambda member: member[1])
+        recurring[key[1]].append(_recurring_group(key, members))
+    for type_groups in recurring.values():
+        type_groups.sort(key=lambda group: (str(group['account_id']), str(group['start_date'])))
+
+    return {
+        'salary': TransactionStore(salary_rows, salary_dates),
+        'lender_transactions': TransactionStore(lender_rows, lender_dates),
+        'credit_recurring': recurring['credit'] if recurring_tagged else None,
+        'debit_recurring': recurring['debit'] if recurring_tagged else None
+    }
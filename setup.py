@@ -21,5 +21,11 @@ setuptools.setup(
         "Operating System :: OS Independent",
     ],
     install_requires=['requests'],
+    extras_require={
+        'fast': ['orjson'],
+        'http2': ['httpx[http2]'],
+        'preflight': ['cryptography'],
+        'optimize': ['pikepdf'],
+    },
     python_requires='>=3.4',
 )
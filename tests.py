@@ -14,12 +14,185 @@ Make sure the statement used for testing has at least one salary, lender, credit
 import unittest
 import os
 import datetime
+import gc
+import gzip
+import hashlib
+import uuid
+from urllib.parse import parse_qs
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import types
+import zlib
+from concurrent.futures import Future
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
 import finbox_bankconnect as fbc
 from finbox_bankconnect.custom_exceptions import EntityNotFoundError, PasswordIncorrectError
 from finbox_bankconnect.custom_exceptions import UnparsablePDFError, CannotIdentityBankError
-from finbox_bankconnect.utils import is_valid_uuid4
+from finbox_bankconnect.custom_exceptions import DeadlineExceededError, OperationCancelledError
+from finbox_bankconnect.custom_exceptions import InvalidSnapshotError, ServiceTimeOutError
+from finbox_bankconnect.utils import is_valid_uuid4, parse_date, import_optional
+from finbox_bankconnect.filters import make_daterange_filter, make_date_filter, AccountId, DateRange, AmountRange
+from finbox_bankconnect.filters import TransactionType, DescriptionRegex, Category, And, Filter, build_filter, apply_filter
+from finbox_bankconnect.store import TransactionStore, VECTORIZE_MIN_ROWS
+from finbox_bankconnect.snapshot import open_snapshot
+import finbox_bankconnect.decoder as decoder
+import finbox_bankconnect.transport as transport
+from finbox_bankconnect.spool import UploadSpool
+from finbox_bankconnect.pdf_optimizer import PdfOptimizer, OptimizationResult, optimize_file
+import finbox_bankconnect.cache as cache
+import finbox_bankconnect.profiling as profiling
+import finbox_bankconnect.hedging as hedging
+import finbox_bankconnect.matching as matching
+import finbox_bankconnect.account_index as account_index
+import finbox_bankconnect.preflight as preflight
+import finbox_bankconnect.metrics as metrics
+import finbox_bankconnect.connector as connector
+from finbox_bankconnect.pipeline import process_entities
+from finbox_bankconnect.scheduler import Scheduler, priority as request_priority
+from finbox_bankconnect.singleflight import SingleFlight
+from finbox_bankconnect.deadline import Deadline
+import json
+import pickle
 
 NOT_EXISTS_ENTITY_ID = "c036e96d-ccae-443c-8f64-b98ceeaa1578"
+STAND_IN_ENTITY_ID = "5b0f1a1e-3c1e-4c55-9a0e-2b7f6d1c9e21"
+
+class StandInServer(ThreadingMixIn, HTTPServer):
+    """
+    Local stand-in for the entity endpoints of the API, serving entities from the entities dictionary
+    (entity_id -> response dictionary) with ETag validation and gzip encoding, used to test the connector offline
+    """
+    daemon_threads = True
+
+    def __init__(self):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), StandInHandler)
+        self.entities = dict()
+        self.requests = [] # (path, response status code)
+        self.delay = 0 # seconds to wait before responding
+        self.delays = [] # seconds to wait before responding to the next requests, before delay applies
+        self.api_keys = [] # x-api-key header of each request
+        self.scoped = True # whether the account_id, from_date and to_date query parameters are honored
+        self.posted = threading.Event() # set when a POST request is received
+        self.upload_failures = 0 # statement uploads to answer with an error before succeeding
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+
+    @property
+    def base_url(self):
+        return "http://127.0.0.1:{}".format(self.server_address[1])
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.shutdown()
+        self.server_close()
+
+class StandInHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        time.sleep(self.server.delays.pop(0) if self.server.delays else self.server.delay)
+        parts = self.path.split('?')[0].strip('/').split('/')
+        # bank-connect/v1/entity/<entity_id>/<resource>
+        entity = self.server.entities.get(parts[3]) if len(parts) >= 4 else None
+        if entity is None:
+            return self.respond(404, b'{"detail": "not found"}')
+        if len(parts) == 4:
+            # entity detail
+            return self.respond(200, json.dumps({"entity_id": parts[3], "link_id": entity.get("link_id")}).encode('utf-8'))
+        body = dict(entity)
+        body['identity'] = [entity.get('identity', {})]
+        if len(parts) > 4 and parts[4] in entity:
+            # payload of another resource than the transactions
+            body['transactions'] = entity[parts[4]]
+        query = parse_qs(self.path.split('?')[1]) if '?' in self.path else dict()
+        if self.server.scoped and query:
+            account_id = query.get('account_id', [None])[0]
+            from_date = query.get('from_date', [''])[0]
+            to_date = query.get('to_date', ['9999'])[0]
+            body['transactions'] = [row for row in entity['transactions']
+                if (account_id is None or row.get('account_id') == account_id) and from_date <= row['date'][:10] <= to_date]
+            body['accounts'] = [account for account in entity['accounts'] if account_id is None or account.get('account_id') == account_id]
+        body = json.dumps(body).encode('utf-8')
+        etag = '"{}"'.format(hashlib.md5(body).hexdigest())
+        if self.headers.get('If-None-Match') == etag:
+            return self.respond(304, b'', etag)
+        self.respond(200, body, etag)
+
+    def do_POST(self):
+        self.server.posted.set()
+        time.sleep(self.server.delay)
+        length = int(self.headers.get('Content-Length', 0))
+        body = self.rfile.read(length)
+        if '/statement/' in self.path and self.server.upload_failures:
+            self.server.upload_failures -= 1
+            return self.respond(500, b'{"detail": "server error"}')
+        if '/statement/' in self.path:
+            # statement upload (multipart form, not parsed), creates a new entity
+            entity_id = str(uuid.uuid4())
+            self.server.entities[entity_id] = stand_in_entity([])
+            return self.respond(200, json.dumps({"is_fraud": False, "entity_id": entity_id, "identity": {}}).encode('utf-8'))
+        # entity creation with link_id
+        form = parse_qs(body.decode('utf-8'))
+        entity_id = str(uuid.uuid4())
+        self.server.entities[entity_id] = stand_in_entity([])
+        self.server.entities[entity_id]["link_id"] = form.get("link_id", [None])[0]
+        self.respond(201, json.dumps({"entity_id": entity_id}).encode('utf-8'))
+
+    def respond(self, status_code, body, etag=None):
+        self.server.requests.append((self.path, status_code))
+        self.server.api_keys.append(self.headers.get('x-api-key'))
+        self.send_response(status_code)
+        if etag is not None:
+            self.send_header('ETag', etag)
+        if body and 'gzip' in self.headers.get('Accept-Encoding', ''):
+            body = gzip.compress(body)
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+def stand_in_entity(transactions):
+    return {
+        "progress": [{"statement_id": "s1", "status": "completed"}],
+        "accounts": [{"account_id": "a"}],
+        "fraud": {"fraud_type": []},
+        "transactions": transactions
+    }
+
+class StandInOptimizer:
+    """
+    Optimizer rewriting the submitted files smaller after a delay, recording whether a statement was uploaded meanwhile
+    """
+
+    def __init__(self, server, delay):
+        self.server = server
+        self.delay = delay
+        self.uploaded_early = False
+
+    def submit(self, file_path, pdf_password=None):
+        future = Future()
+        def rewrite():
+            original_size = os.path.getsize(file_path)
+            with open(file_path, 'wb') as file_obj:
+                file_obj.write(b"%PDF")
+            self.uploaded_early = self.uploaded_early or any('/statement/' in path for path, status in self.server.requests)
+            future.set_result(OptimizationResult(file_path, original_size, os.path.getsize(file_path)))
+        threading.Timer(self.delay, rewrite).start()
+        return future
+
+def count_rows(rows):
+    # extract function of the pipeline tests, module level to be picklable
+    return len(rows)
 
 class TestUtilFunctions(unittest.TestCase):
     """
@@ -44,6 +217,1314 @@ class TestUtilFunctions(unittest.TestCase):
     def test_none(self):
         self.assertEqual(is_valid_uuid4(None), False, "list detected as valid uui4")
 
+class TestLazyImports(unittest.TestCase):
+    """
+    Test that importing the package doesn't import the HTTP stack or optional accelerators
+    (see benchmarks/import_time.py for the timings)
+    """
+
+    def loaded_modules(self, statement, modules):
+        code = "import sys\n{}\nprint(' '.join(m for m in {!r} if m in sys.modules))".format(statement, modules)
+        output = subprocess.check_output([sys.executable, "-c", code], cwd=os.path.dirname(os.path.abspath(__file__)))
+        return output.decode('utf-8').split()
+
+    def test_package_import(self):
+        loaded = self.loaded_modules("import finbox_bankconnect", ["requests", "finbox_bankconnect.entity", "orjson", "numpy"])
+        self.assertEqual(loaded, [], "modules imported eagerly by the package")
+
+    def test_entity_access(self):
+        loaded = self.loaded_modules("import finbox_bankconnect\nfinbox_bankconnect.Entity", ["requests", "orjson", "numpy"])
+        self.assertEqual(loaded, [], "modules imported before first network use")
+
+class TestParseDate(unittest.TestCase):
+    """
+    Test cases for the fixed format date parser
+    """
+
+    def test_valid_date(self):
+        self.assertEqual(parse_date("2019-10-04 13:45:00"), datetime.date(2019, 10, 4), "valid date parsed incorrectly")
+
+    def test_invalid_day(self):
+        self.assertEqual(parse_date("2019-02-30 00:00:00"), None, "invalid day detected as valid")
+
+    def test_invalid_time(self):
+        self.assertEqual(parse_date("2019-10-04 24:00:00"), None, "invalid time detected as valid")
+
+    def test_non_padded_date(self):
+        self.assertEqual(parse_date("2019-1-05 10:00:00"), datetime.date(2019, 1, 5), "non padded date not parsed like strptime")
+
+    def test_not_a_date(self):
+        self.assertEqual(parse_date("abc"), None, "invalid string detected as valid date")
+        self.assertEqual(parse_date(None), None, "None detected as valid date")
+
+class TestDateRangeFilter(unittest.TestCase):
+    """
+    Test cases for date range filtering on pre-parsed dates
+    """
+
+    def setUp(self):
+        self.store = TransactionStore([
+            {"date": "2019-09-30 00:00:00"},
+            {"date": "2019-10-04 00:00:00"},
+            {"date": "invalid"},
+            {"date": "2019-11-01 00:00:00"}
+        ])
+
+    def test_invalid_dates_flagged(self):
+        self.assertEqual(self.store.invalid_date_count, 1, "invalid date not flagged at fetch time")
+
+    def test_daterange(self):
+        date_filter = make_date_filter(datetime.date(2019, 10, 1), datetime.date(2019, 10, 31))
+        rows = list(self.store.filter_dates(date_filter))
+        self.assertEqual(rows, [{"date": "2019-10-04 00:00:00"}], "date range filter returned incorrect rows")
+
+    def test_open_daterange(self):
+        date_filter = make_date_filter(datetime.date(2019, 10, 1), None)
+        self.assertEqual(len(list(self.store.filter_dates(date_filter))), 2, "open ended date range filter failed")
+
+    def test_row_daterange(self):
+        daterange_filter = make_daterange_filter(datetime.date(2019, 10, 1), datetime.date(2019, 10, 31))
+        rows = list(filter(daterange_filter, self.store.rows))
+        self.assertEqual(rows, [{"date": "2019-10-04 00:00:00"}], "row date range filter returned incorrect rows")
+
+class TestStoreMerge(unittest.TestCase):
+    """
+    Test cases for incremental merge of fetched rows into a TransactionStore
+    """
+
+    def test_merge(self):
+        store = TransactionStore([
+            {"hash": "1", "date": "2019-10-01 00:00:00"},
+            {"hash": "2", "date": "2019-10-02 00:00:00"}
+        ])
+        added, removed = store.merge([
+            {"hash": "1", "date": "2019-10-01 00:00:00"},
+            {"hash": "2", "date": "2019-10-02 00:00:00"},
+            {"hash": "3", "date": "2019-11-05 00:00:00"}
+        ])
+        self.assertEqual((added, removed), (1, 0), "merge counted incorrect changes")
+        self.assertEqual(store.dates[-1], datetime.date(2019, 11, 5), "new row date not parsed on merge")
+
+    def test_merge_changed_row(self):
+        store = TransactionStore([{"amount": 1.0, "date": "2019-10-01 00:00:00"}])
+        added, removed = store.merge([{"amount": 2.0, "date": "2019-10-01 00:00:00"}])
+        self.assertEqual((added, removed), (1, 1), "changed row not detected on merge")
+
+class TestFilterExpressions(unittest.TestCase):
+    """
+    Test cases for composable filter expressions
+    """
+
+    def setUp(self):
+        self.store = TransactionStore([
+            {"account_id": "a", "date": "2019-10-01 00:00:00", "amount": 500.0, "transaction_type": "credit",
+                "transaction_note": "SALARY OCT", "category": "salary"},
+            {"account_id": "a", "date": "2019-10-03 00:00:00", "amount": 40.0, "transaction_type": "debit",
+                "transaction_note": "UPI grocery", "category": "shopping"},
+            {"account_id": "b", "date": "2019-11-01 00:00:00", "amount": 500.0, "transaction_type": "credit",
+                "transaction_note": "SALARY NOV", "category": "salary"},
+            {"account_id": "a", "date": "invalid", "amount": 10.0, "transaction_type": "debit",
+                "transaction_note": "ATM", "category": None}
+        ])
+
+    def select(self, expression):
+        return [row["transaction_note"] for row in self.store.select(expression)]
+
+    def test_account_and_daterange_combined(self):
+        expression = build_filter("a", datetime.date(2019, 10, 2), None)
+        self.assertEqual(self.select(expression), ["UPI grocery"], "account_id and date range not applied together")
+
+    def test_or_not(self):
+        expression = TransactionType("credit") | ~AmountRange(min_amount=20)
+        self.assertEqual(self.select(expression), ["SALARY OCT", "SALARY NOV", "ATM"], "or / not combination failed")
+
+    def test_description_and_category(self):
+        expression = DescriptionRegex("^salary") & Category("salary") & AccountId("b")
+        self.assertEqual(self.select(expression), ["SALARY NOV"], "description regex and category filter failed")
+
+    def test_cheapest_first(self):
+        expression = DescriptionRegex("x") & DateRange(to_date=datetime.date(2019, 10, 1))
+        self.assertIsInstance(expression, And)
+        self.assertIsInstance(expression.filters[0], DateRange, "cheaper predicate not ordered first")
+
+    def test_abstract(self):
+        class Incomplete(Filter):
+            def compile(self):
+                return lambda row, curr_date: True
+        with self.assertRaises(TypeError):
+            Incomplete()
+
+    @unittest.skipUnless(import_optional('numpy'), "numpy is not installed")
+    def test_mask_parity(self):
+        # past VECTORIZE_MIN_ROWS the filters are evaluated as numpy masks, the rows must match the python path
+        rows = []
+        for i in range(VECTORIZE_MIN_ROWS + 1):
+            row = dict(self.store.rows[i % len(self.store.rows)])
+            row["amount"] = None if i % 7 == 0 else float(i % 600)
+            rows.append(row)
+        store = TransactionStore(rows)
+        expressions = [
+            build_filter("a", datetime.date(2019, 10, 2), None),
+            TransactionType("credit") | ~AmountRange(min_amount=20, max_amount=500),
+            DescriptionRegex("^salary") & Category("salary") & ~AccountId("b"),
+            DateRange(to_date=datetime.date(2019, 10, 31)) | Category(None)
+        ]
+        for expression in expressions:
+            self.assertEqual(list(store.select(expression)), list(apply_filter(expression, rows)), "numpy mask differs from the python path")
+
+class TestDecoder(unittest.TestCase):
+    """
+    Test cases for the JSON decoder layer giving identical results as the json module
+    """
+
+    def assertSameAsJson(self, content):
+        self.assertEqual(repr(decoder.loads(content)), repr(json.loads(content)), "decoded differently than json module")
+
+    def test_document(self):
+        self.assertSameAsJson(b'{"transactions": [{"amount": 1.1, "balance": 1e-7, "note": "caf\\u00e9"}], "n": null}')
+
+    def test_non_finite_and_big_numbers(self):
+        self.assertSameAsJson(b'[NaN, Infinity, 123456789012345678901234567890]')
+
+    def test_utf16(self):
+        self.assertSameAsJson('{"name": "caf\u00e9"}'.encode('utf-16'))
+
+    def test_memoryview(self):
+        self.assertEqual(decoder.loads(memoryview(b'{"a": [1, 2]}')), {"a": [1, 2]}, "memoryview not decoded")
+
+    def test_invalid(self):
+        with self.assertRaises(ValueError):
+            decoder.loads(b'{"a": ')
+
+    def test_unknown_backend(self):
+        decoder.backend = "ujson"
+        try:
+            with self.assertRaises(ValueError):
+                decoder.loads(b'{"a": 1}')
+            decoder.backend = "json"
+            self.assertEqual(decoder.loads(b'{"a": 1}'), {"a": 1}, "json backend not used")
+        finally:
+            decoder.backend = None
+
+class TestConditionalRequests(unittest.TestCase):
+    """
+    Test conditional and compressed requests against the local stand-in server
+    """
+
+    def setUp(self):
+        self.base_url = fbc.base_url
+        transport.clear_cache()
+
+    def tearDown(self):
+        fbc.base_url = self.base_url
+        transport.clear_cache()
+
+    def test_not_modified_served_from_cache(self):
+        with StandInServer() as server:
+            fbc.base_url = server.base_url
+            server.entities[STAND_IN_ENTITY_ID] = stand_in_entity([{"date": "2019-10-01 00:00:00"}])
+            entity = fbc.Entity.get(STAND_IN_ENTITY_ID)
+            first = list(entity.get_transactions())
+            second = list(entity.get_transactions(reload=True))
+            self.assertEqual(first, second, "transactions changed on not modified response")
+            self.assertEqual([status for path, status in server.requests], [200, 304], "conditional request not sent")
+
+    def test_modified_refetched(self):
+        with StandInServer() as server:
+            fbc.base_url = server.base_url
+            server.entities[STAND_IN_ENTITY_ID] = stand_in_entity([{"date": "2019-10-01 00:00:00"}])
+            entity = fbc.Entity.get(STAND_IN_ENTITY_ID)
+            list(entity.get_transactions())
+            server.entities[STAND_IN_ENTITY_ID] = stand_in_entity([{"date": "2019-10-02 00:00:00"}])
+            rows = list(entity.get_transactions(reload=True))
+            self.assertEqual(rows, [{"date": "2019-10-02 00:00:00"}], "modified response not fetched again")
+
+    def test_incremental_reload_unchanged(self):
+        with StandInServer() as server:
+            fbc.base_url = server.base_url
+            server.entities[STAND_IN_ENTITY_ID] = stand_in_entity([{"date": "2019-10-01 00:00:00"}])
+            entity = fbc.Entity.get(STAND_IN_ENTITY_ID)
+            list(entity.get_transactions())
+            list(entity.get_transactions(reload=True, incremental=True))
+            resources = [path.split('/')[5] for path, status in server.requests]
+            self.assertEqual(resources, ["transactions", "accounts"], "unchanged transactions fetched again on incremental reload")
+
+class TestScopedFetch(unittest.TestCase):
+    """
+    Test that account and date scoping is passed to the API and cached per scope
+    """
+
+    rows = [
+        {"account_id": "11111111-1111-4111-8111-111111111111", "date": "2019-10-01 00:00:00"},
+        {"account_id": "11111111-1111-4111-8111-111111111111", "date": "2019-12-01 00:00:00"},
+        {"account_id": "22222222-2222-4222-8222-222222222222", "date": "2019-12-02 00:00:00"},
+    ]
+
+    def setUp(self):
+        self.base_url = fbc.base_url
+        transport.clear_cache()
+
+    def tearDown(self):
+        fbc.base_url = self.base_url
+        transport.clear_cache()
+
+    def fetch(self, scoped):
+        with StandInServer() as server:
+            fbc.base_url = server.base_url
+            server.scoped = scoped
+            server.entities[STAND_IN_ENTITY_ID] = stand_in_entity(self.rows)
+            entity = fbc.Entity.get(STAND_IN_ENTITY_ID)
+            results = [list(entity.get_transactions(account_id=self.rows[0]["account_id"], from_date=datetime.date(2019, 11, 1)))
+                for i in range(2)]
+            return results, server.requests
+
+    def test_scope_sent(self):
+        results, requests = self.fetch(True)
+        self.assertEqual(results, [self.rows[1:2]] * 2, "scoped transactions not correct")
+        self.assertEqual(len(requests), 1, "scoped transactions not cached")
+        self.assertEqual("from_date=2019-11-01" in requests[0][0], True, "scope not passed to the API")
+
+    def test_scope_ignored(self):
+        results, requests = self.fetch(False)
+        self.assertEqual(results, [self.rows[1:2]] * 2, "transactions not filtered when API ignores the scope")
+
+    def test_scope_keeps_accounts(self):
+        with StandInServer() as server:
+            fbc.base_url = server.base_url
+            server.entities[STAND_IN_ENTITY_ID] = stand_in_entity(self.rows)
+            accounts = [{"account_id": self.rows[0]["account_id"]}, {"account_id": self.rows[2]["account_id"]}]
+            server.entities[STAND_IN_ENTITY_ID]["accounts"] = accounts
+            entity = fbc.Entity.get(STAND_IN_ENTITY_ID)
+            list(entity.get_transactions(account_id=self.rows[0]["account_id"]))
+            self.assertEqual(list(entity.get_accounts()), accounts, "accounts of a scoped response saved as all the accounts")
+
+class TestDerivedViews(unittest.TestCase):
+    """
+    Test that salary, lender and recurring rows are derived from one fetch of tagged transactions
+    """
+
+    account_id = "11111111-1111-4111-8111-111111111111"
+
+    def setUp(self):
+        self.config = (fbc.base_url, fbc.derived_views)
+        fbc.derived_views = True
+        transport.clear_cache()
+
+    def tearDown(self):
+        fbc.base_url, fbc.derived_views = self.config
+        transport.clear_cache()
+
+    def rows(self, tagged, recurring_tagged=True):
+        rows = []
+        for month in range(1, 5):
+            rows.append({"account_id": self.account_id, "date": "2020-0{}-01 00:00:00".format(month), "transaction_type": "credit",
+                "amount": 50000.0, "transaction_note": "SALARY ACME {}".format(month), "category": "Salary", "recurring_group": "r1"})
+            rows.append({"account_id": self.account_id, "date": "2020-0{}-05 00:00:00".format(month), "transaction_type": "debit",
+                "amount": 10000.0 + month, "transaction_note": "EMI LOAN/{}".format(month), "category": "EMI", "recurring_group": "r2"})
+            # same note every month, but not recurring for the API
+            rows.append({"account_id": self.account_id, "date": "2020-0{}-07 00:00:00".format(month), "transaction_type": "debit",
+                "amount": 20.0 * month, "transaction_note": "UPI GROCERY", "category": "Shopping", "recurring_group": None})
+        rows.append({"account_id": self.account_id, "date": "2020-04-09 00:00:00", "transaction_type": "debit",
+            "amount": 99.0, "transaction_note": "SHOP", "category": "Shopping"})
+        for row in rows:
+            if not tagged:
+                del row["category"]
+            if not recurring_tagged:
+                row.pop("recurring_group", None)
+        return rows
+
+    def paths(self, server):
+        return [path.split('/')[5] for path, status in server.requests]
+
+    def test_derived(self):
+        with StandInServer() as server:
+            fbc.base_url = server.base_url
+            server.entities[STAND_IN_ENTITY_ID] = stand_in_entity(self.rows(True))
+            entity = fbc.Entity.get(STAND_IN_ENTITY_ID)
+            salary = list(entity.get_salary())
+            lender_transactions = list(entity.get_lender_transactions(from_date=datetime.date(2020, 3, 1)))
+            credit_recurring = list(entity.get_credit_recurring())
+            debit_recurring = list(entity.get_debit_recurring())
+            self.assertEqual(self.paths(server), ["transactions"], "views not derived from one transactions fetch")
+        self.assertEqual([row["amount"] for row in salary], [50000.0] * 4, "salary rows not derived")
+        self.assertEqual([row["amount"] for row in lender_transactions], [10003.0, 10004.0], "lender rows not derived")
+        self.assertEqual([(len(group["transactions"]), group["median"]) for group in credit_recurring], [(4, 50000.0)], "credit recurring not derived")
+        self.assertEqual([(len(group["transactions"]), group["median"]) for group in debit_recurring], [(4, 10002.5)], "debit recurring not derived")
+
+    def test_untagged_fallback(self):
+        with StandInServer() as server:
+            fbc.base_url = server.base_url
+            server.entities[STAND_IN_ENTITY_ID] = stand_in_entity(self.rows(False))
+            entity = fbc.Entity.get(STAND_IN_ENTITY_ID)
+            list(entity.get_salary())
+            list(entity.get_salary())
+            self.assertEqual(self.paths(server), ["transactions", "salary"], "untagged transactions not falling back to the endpoint")
+
+    def test_recurring_untagged_fallback(self):
+        with StandInServer() as server:
+            fbc.base_url = server.base_url
+            server.entities[STAND_IN_ENTITY_ID] = stand_in_entity(self.rows(True, recurring_tagged=False))
+            server.entities[STAND_IN_ENTITY_ID]["recurring_transactions"] = {"credit_transactions": [], "debit_transactions": [{"median": 1.0}]}
+            entity = fbc.Entity.get(STAND_IN_ENTITY_ID)
+            list(entity.get_salary())
+            debit_recurring = list(entity.get_debit_recurring())
+            list(entity.get_credit_recurring())
+            self.assertEqual(self.paths(server), ["transactions", "recurring_transactions"], "recurring rows guessed locally")
+        self.assertEqual(debit_recurring, [{"median": 1.0}], "recurring endpoint not used")
+
+class TestPipeline(unittest.TestCase):
+    """
+    Test the multi-process post processing pipeline against the local stand-in server
+    """
+
+    rows = [{"date": "2019-10-01 00:00:00"}, {"date": "2019-10-02 00:00:00"}]
+
+    def setUp(self):
+        self.config = (fbc.base_url, fbc.poll_interval, fbc.poll_timeout)
+        fbc.poll_interval = 0.05
+        fbc.poll_timeout = 5
+
+    def tearDown(self):
+        fbc.base_url, fbc.poll_interval, fbc.poll_timeout = self.config
+
+    def run_pipeline(self, server, entity_ids):
+        fbc.base_url = server.base_url
+        return dict((entity_id, (result, error)) for entity_id, result, error in
+            process_entities(entity_ids, extract=count_rows, processes=1, io_threads=2))
+
+    def test_success_and_not_found(self):
+        with StandInServer() as server:
+            server.entities[STAND_IN_ENTITY_ID] = stand_in_entity(self.rows)
+            results = self.run_pipeline(server, [STAND_IN_ENTITY_ID, NOT_EXISTS_ENTITY_ID, STAND_IN_ENTITY_ID])
+        self.assertEqual(results[STAND_IN_ENTITY_ID], (2, None), "entity not processed")
+        self.assertEqual(isinstance(results[NOT_EXISTS_ENTITY_ID][1], EntityNotFoundError), True, "missing entity not reported")
+        self.assertEqual(len(server.requests), 2, "repeated entity fetched again")
+
+    def test_polls_till_completed(self):
+        with StandInServer() as server:
+            entity = stand_in_entity(self.rows)
+            entity["progress"] = [{"statement_id": "s1", "status": "processing"}]
+            server.entities[STAND_IN_ENTITY_ID] = entity
+            completed = threading.Timer(0.2, lambda: entity.update(progress=[{"statement_id": "s1", "status": "completed"}]))
+            completed.start()
+            results = self.run_pipeline(server, [STAND_IN_ENTITY_ID])
+        self.assertEqual(results[STAND_IN_ENTITY_ID], (2, None), "processing entity not polled till completed")
+        self.assertEqual(len(server.requests) > 1, True, "processing entity not polled again")
+
+    def test_shared_memory_owned_by_parent(self):
+        # the small first payload isn't shared, so the worker starts before any shared memory block is created
+        script = "\n".join([
+            "import finbox_bankconnect as fbc, tests",
+            "from finbox_bankconnect.pipeline import process_entities",
+            "rows = [{'date': '2019-10-01 00:00:00', 'transaction_note': 'x' * 200} for i in range(8000)]",
+            "with tests.StandInServer() as server:",
+            "    fbc.base_url = server.base_url",
+            "    entity_ids = [str(uuid) for uuid in range(3)]",
+            "    for entity_id in entity_ids:",
+            "        server.entities[entity_id] = tests.stand_in_entity(rows if entity_id != '0' else rows[:2])",
+            "    results = process_entities(entity_ids, extract=tests.count_rows, processes=1, io_threads=1)",
+            "    print(sorted(result for entity_id, result, error in results))"
+        ])
+        completed = subprocess.run([sys.executable, "-c", script], cwd=os.path.dirname(os.path.abspath(__file__)),
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE, timeout=60)
+        self.assertEqual(completed.stdout.strip(), b"[2, 8000, 8000]", "shared payloads not processed")
+        self.assertEqual(b"resource_tracker" in completed.stderr, False, "shared memory tracked by the worker")
+
+    def test_timeout(self):
+        fbc.poll_timeout = 0.2
+        with StandInServer() as server:
+            entity = stand_in_entity(self.rows)
+            entity["progress"] = [{"statement_id": "s1", "status": "processing"}]
+            server.entities[STAND_IN_ENTITY_ID] = entity
+            results = self.run_pipeline(server, [STAND_IN_ENTITY_ID])
+        self.assertEqual(isinstance(results[STAND_IN_ENTITY_ID][1], ServiceTimeOutError), True, "polling not timed out")
+
+class TestScheduler(unittest.TestCase):
+    """
+    Test the priority scheduling of requests
+    """
+
+    def setUp(self):
+        self.admitted = threading.Condition()
+
+    def wait_until(self, condition, predicate):
+        with condition:
+            self.assertEqual(condition.wait_for(predicate, 5), True, "threads didn't reach the expected state")
+
+    def start_waiters(self, scheduler, priorities, order):
+        def admit(priority):
+            scheduler.acquire(priority)
+            with self.admitted:
+                order.append(priority)
+                self.admitted.notify_all()
+        threads = []
+        for priority in priorities:
+            thread = threading.Thread(target=admit, args=(priority,))
+            thread.start()
+            threads.append(thread)
+            # queued or admitted before the next one starts
+            started = len(threads)
+            while True:
+                with scheduler._condition:
+                    if len(scheduler._waiting) + len(order) >= started:
+                        break
+                with self.admitted:
+                    self.admitted.wait(0.01)
+        return threads
+
+    def test_weighted_order(self):
+        scheduler = Scheduler(types.SimpleNamespace(max_concurrent_requests=1, reserved_interactive_requests=0))
+        scheduler.acquire('backfill')
+        order = []
+        threads = self.start_waiters(scheduler, ['backfill', 'backfill', 'interactive'], order)
+        for i in range(3):
+            scheduler.release()
+            self.wait_until(self.admitted, lambda: len(order) == i + 1)
+        for thread in threads:
+            thread.join()
+        self.assertEqual(order, ['interactive', 'backfill', 'backfill'], "interactive request queued behind backfill")
+
+    def test_reserved_slots(self):
+        scheduler = Scheduler(types.SimpleNamespace(max_concurrent_requests=2, reserved_interactive_requests=1))
+        scheduler.acquire('backfill')
+        order = []
+        threads = self.start_waiters(scheduler, ['backfill', 'interactive'], order)
+        self.assertEqual(order, ['interactive'], "reserved slot not used by interactive request only")
+        scheduler.release()
+        scheduler.release()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(order, ['interactive', 'backfill'], "waiting backfill request not admitted")
+
+    def test_invalid_priority(self):
+        with self.assertRaises(ValueError):
+            fbc.Entity.get(STAND_IN_ENTITY_ID, priority='urgent')
+
+    def test_single_flight_priority(self):
+        flights = SingleFlight()
+        release = threading.Event()
+        started = threading.Event()
+        def background():
+            with request_priority('backfill'):
+                flights.do('key', lambda: (started.set(), release.wait(5), 'backfill')[2])
+        thread = threading.Thread(target=background)
+        thread.start()
+        started.wait(5)
+        # not held back by the backfill call in flight
+        with request_priority('interactive'):
+            self.assertEqual(flights.do('key', lambda: 'interactive'), 'interactive', "interactive call waited for backfill")
+        release.set()
+        thread.join()
+
+class TestHedging(unittest.TestCase):
+    """
+    Test that slow GET requests are hedged within the budget
+    """
+
+    def setUp(self):
+        metrics.reset()
+
+    def warm_up(self, server, client):
+        for i in range(hedging.MIN_SAMPLES):
+            connector.fetch_raw(STAND_IN_ENTITY_ID, 'transactions', client)
+
+    def test_slow_request_hedged(self):
+        with StandInServer() as server:
+            server.entities[STAND_IN_ENTITY_ID] = stand_in_entity([{"date": "2019-10-01 00:00:00"}])
+            client = fbc.Client(api_key="hedge_key", base_url=server.base_url, hedge_percentile=50, hedge_budget=1)
+            self.warm_up(server, client)
+            server.delays = [1]
+            started = time.time()
+            status_code, content = connector.fetch_raw(STAND_IN_ENTITY_ID, 'transactions', client)
+            self.assertEqual(status_code, 200, "hedged request failed")
+            self.assertEqual(time.time() - started < 0.8, True, "slow request not hedged")
+            self.assertEqual(metrics.snapshot()['counters'].get('hedge_won'), 1, "hedge win not counted")
+
+    def test_budget_exhausted(self):
+        with StandInServer() as server:
+            server.entities[STAND_IN_ENTITY_ID] = stand_in_entity([{"date": "2019-10-01 00:00:00"}])
+            client = fbc.Client(api_key="hedge_key", base_url=server.base_url, hedge_percentile=50, hedge_budget=0)
+            self.warm_up(server, client)
+            server.delays = [0.3]
+            connector.fetch_raw(STAND_IN_ENTITY_ID, 'transactions', client)
+            counters = metrics.snapshot()['counters']
+            self.assertEqual(counters.get('hedge_sent'), None, "hedge sent without budget")
+            self.assertEqual(counters.get('hedge_budget_exhausted'), 1, "exhausted budget not counted")
+            self.assertEqual(len(server.requests), hedging.MIN_SAMPLES + 1, "extra request sent")
+
+    def test_unhedged_request_inline(self):
+        with StandInServer() as server:
+            server.entities[STAND_IN_ENTITY_ID] = stand_in_entity([{"date": "2019-10-01 00:00:00"}])
+            client = fbc.Client(api_key="hedge_key", base_url=server.base_url, hedge_percentile=50, hedge_budget=0)
+            self.warm_up(server, client)
+            thread = client.transport.hedger.send(threading.current_thread)
+            self.assertEqual(thread, threading.current_thread(), "request without budget not sent on the calling thread")
+
+class TestDeadlines(unittest.TestCase):
+    """
+    Test that deadlines cut the network waits and that polls can be cancelled
+    """
+
+    def setUp(self):
+        self.config = (fbc.base_url, fbc.poll_timeout, fbc.poll_interval)
+        transport.clear_cache()
+
+    def tearDown(self):
+        fbc.base_url, fbc.poll_timeout, fbc.poll_interval = self.config
+        transport.clear_cache()
+
+    def test_deadline_cuts_read(self):
+        with StandInServer() as server:
+            fbc.base_url = server.base_url
+            server.delay = 1
+            server.entities[STAND_IN_ENTITY_ID] = stand_in_entity([])
+            started = time.time()
+            with self.assertRaises(DeadlineExceededError):
+                fbc.Entity.get(STAND_IN_ENTITY_ID).get_transactions(deadline=0.2)
+            self.assertEqual(time.time() - started < 0.8, True, "request not cut at the deadline")
+
+    def test_slow_read_outlasts_poll_timeout(self):
+        with StandInServer() as server:
+            fbc.base_url = server.base_url
+            fbc.poll_timeout = 0.2
+            server.delay = 0.5
+            server.entities[STAND_IN_ENTITY_ID] = stand_in_entity([{"date": "2019-10-01 00:00:00"}])
+            transactions = list(fbc.Entity.get(STAND_IN_ENTITY_ID).get_transactions())
+        self.assertEqual(len(transactions), 1, "download cut at the poll timeout")
+
+    def test_reads_during_upload(self):
+        with StandInServer() as server:
+            fbc.base_url = server.base_url
+            server.delay = 1
+            server.delays = [0] * 4
+            server.entities[STAND_IN_ENTITY_ID] = stand_in_entity([{"date": "2019-10-01 00:00:00"}])
+            entity = fbc.Entity.get(STAND_IN_ENTITY_ID)
+            upload = threading.Thread(target=entity.upload_statement, args=('samples/test_statement_1.pdf',), kwargs={'pdf_password': 'finbox'})
+            upload.start()
+            server.posted.wait(5)
+            started = time.time()
+            transactions = list(entity.get_transactions())
+            self.assertEqual(time.time() - started < 0.8, True, "read blocked by the upload in flight")
+            upload.join()
+        self.assertEqual(len(transactions), 1, "transactions not read during the upload")
+
+    def test_cancel_poll(self):
+        with StandInServer() as server:
+            fbc.base_url = server.base_url
+            fbc.poll_timeout = 30
+            fbc.poll_interval = 10
+            server.entities[STAND_IN_ENTITY_ID] = stand_in_entity([])
+            server.entities[STAND_IN_ENTITY_ID]["progress"] = [{"statement_id": "s1", "status": "processing"}]
+            deadline = Deadline()
+            threading.Timer(0.2, deadline.cancel).start()
+            started = time.time()
+            with self.assertRaises(OperationCancelledError):
+                fbc.Entity.get(STAND_IN_ENTITY_ID).get_transactions(deadline=deadline)
+            self.assertEqual(time.time() - started < 2, True, "poll not cancelled")
+
+class TestUploadSpool(unittest.TestCase):
+    """
+    Test the durable upload spool against the local stand-in server
+    """
+
+    def setUp(self):
+        self.base_url = fbc.base_url
+        self.directory = tempfile.TemporaryDirectory()
+        self.file_path = os.path.join(self.directory.name, "statement.pdf")
+        with open(self.file_path, 'wb') as file_obj:
+            file_obj.write(b"%PDF-1.4 stand-in")
+
+    def tearDown(self):
+        fbc.base_url = self.base_url
+        self.directory.cleanup()
+
+    def uploads(self, server):
+        return [path for path, status in server.requests if '/statement/' in path]
+
+    def test_drain(self):
+        with StandInServer() as server:
+            fbc.base_url = server.base_url
+            spool = UploadSpool(os.path.join(self.directory.name, "spool"), workers=2)
+            upload_ids = [spool.submit(self.file_path) for i in range(3)]
+            spool.start()
+            self.assertEqual(spool.wait(timeout=10), True, "spool not drained")
+            spool.close()
+            states = [spool.status(upload_id)["state"] for upload_id in upload_ids]
+            self.assertEqual(states, ["done"] * 3, "spooled uploads not done")
+            self.assertEqual(len(self.uploads(server)), 3, "spooled uploads not sent once each")
+
+    def test_resume_after_restart(self):
+        with StandInServer() as server:
+            fbc.base_url = server.base_url
+            spool_directory = os.path.join(self.directory.name, "spool")
+            spool = UploadSpool(spool_directory)
+            done_id = spool.submit(self.file_path)
+            spool.start()
+            spool.wait(timeout=10)
+            spool.stop()
+            pending_id = spool.submit(self.file_path)
+            spool.close()
+
+            # a new process opening the same spool
+            spool = UploadSpool(spool_directory)
+            self.assertEqual(spool.pending_count(), 1, "pending upload not recovered")
+            spool.start()
+            spool.wait(timeout=10)
+            spool.close()
+            self.assertEqual(spool.status(pending_id)["state"], "done", "recovered upload not done")
+            self.assertEqual(is_valid_uuid4(spool.status(done_id)["entity_id"]), True, "entity_id not journaled")
+            self.assertEqual(len(self.uploads(server)), 2, "done upload sent again after restart")
+
+    def test_retry_keeps_created_entity(self):
+        with StandInServer() as server:
+            fbc.base_url = server.base_url
+            # every try of the first attempt fails
+            server.upload_failures = fbc.max_retry_limit
+            spool = UploadSpool(os.path.join(self.directory.name, "spool"), retry_interval=0.1)
+            upload_id = spool.submit(self.file_path, link_id="link")
+            spool.start()
+            spool.wait(timeout=10)
+            spool.close()
+            status = spool.status(upload_id)
+            creates = [path for path, status_code in server.requests if path.endswith('/entity/')]
+            self.assertEqual((status["state"], status["attempts"]), ("done", 2), "failed upload not retried")
+            self.assertEqual(len(creates), 1, "entity created again on retry")
+            self.assertEqual(server.entities[status["entity_id"]]["link_id"], "link", "upload not sent to the created entity")
+
+    def test_history_and_journal_bounded(self):
+        with StandInServer() as server:
+            fbc.base_url = server.base_url
+            spool_directory = os.path.join(self.directory.name, "spool")
+            spool = UploadSpool(spool_directory, history=2)
+            upload_ids = [spool.submit(self.file_path) for i in range(4)]
+            spooled_path = os.path.join(spool_directory, "{}.pdf".format(upload_ids[0]))
+            self.assertEqual(os.stat(spooled_path).st_mode & 0o777, 0o600, "spooled copy readable by others")
+            spool.start()
+            spool.wait(timeout=10)
+            spool.close()
+            states = [(spool.status(upload_id) or {}).get("state") for upload_id in upload_ids]
+            self.assertEqual(states.count("done"), 2, "finished uploads beyond the history kept")
+            self.assertEqual(states.count(None), 2, "finished uploads beyond the history kept")
+
+            # reopening compacts the journal to the records kept
+            spool = UploadSpool(spool_directory, history=2)
+            spool.close()
+            with open(os.path.join(spool_directory, "journal.log")) as journal:
+                self.assertEqual(len(journal.readlines()), 2, "journal not compacted")
+
+    def test_optimizer(self):
+        with StandInServer() as server:
+            fbc.base_url = server.base_url
+            optimizer = PdfOptimizer(workers=1)
+            spool = UploadSpool(os.path.join(self.directory.name, "spool"), optimizer=optimizer)
+            upload_id = spool.submit(self.file_path)
+            spool.start()
+            spool.wait(timeout=30)
+            spool.close()
+            optimizer.close()
+            # the stand-in file can't be rewritten, it is uploaded as it is
+            status = spool.status(upload_id)
+            self.assertEqual((status["state"], status["bytes_saved"]), ("done", 0), "unoptimizable file not uploaded")
+
+    def test_upload_waits_for_optimizer(self):
+        with StandInServer() as server:
+            fbc.base_url = server.base_url
+            optimizer = StandInOptimizer(server, 0.3)
+            spool = UploadSpool(os.path.join(self.directory.name, "spool"), optimizer=optimizer)
+            upload_id = spool.submit(self.file_path)
+            spool.start()
+            spool.wait(timeout=10)
+            spool.close()
+            status = spool.status(upload_id)
+            self.assertEqual(optimizer.uploaded_early, False, "file uploaded before its rewriting finished")
+            self.assertEqual(status["state"], "done", "optimized upload not done")
+            self.assertEqual(status["bytes_saved"], len(b"%PDF-1.4 stand-in") - len(b"%PDF"), "bytes saved not journaled")
+
+    @unittest.skipUnless(import_optional('pikepdf'), "pikepdf is not installed")
+    def test_rewrite_with_pikepdf(self):
+        pikepdf = import_optional('pikepdf')
+        file_path = os.path.join(self.directory.name, "scanned.pdf")
+        pdf = pikepdf.new()
+        for i in range(3):
+            page = pdf.add_blank_page(page_size=(100, 100))
+            # the same image stored again on every page, and a thumbnail
+            image = pikepdf.Stream(pdf, zlib.compress(bytes(bytearray(range(256))) * 40, 1))
+            image.Type, image.Subtype = pikepdf.Name.XObject, pikepdf.Name.Image
+            image.Width, image.Height, image.BitsPerComponent = 100, 100, 8
+            image.ColorSpace, image.Filter = pikepdf.Name.DeviceGray, pikepdf.Name.FlateDecode
+            page.Resources = pikepdf.Dictionary(XObject=pikepdf.Dictionary(Im0=image))
+            page.Contents = pikepdf.Stream(pdf, b"q 100 0 0 100 0 0 cm /Im0 Do Q")
+            page.obj.Thumb = pdf.make_indirect(pikepdf.Stream(pdf, os.urandom(2000)))
+        pdf.save(file_path, object_stream_mode=pikepdf.ObjectStreamMode.disable)
+        result = optimize_file(file_path)
+        self.assertEqual((result.error, result.bytes_saved > 0), (None, True), "file not rewritten smaller")
+        with pikepdf.open(file_path) as pdf:
+            self.assertEqual(len(pdf.pages), 3, "pages lost in the rewrite")
+            images = [page.Resources.XObject.Im0 for page in pdf.pages]
+            self.assertEqual(len(set(image.objgen for image in images)), 1, "identical images not stored once")
+            self.assertEqual(images[0].read_bytes(), bytes(bytearray(range(256))) * 40, "image content changed")
+
+    def test_optimize_file(self):
+        file_path = os.path.join(self.directory.name, "sample.pdf")
+        with open("samples/test_statement_1.pdf", 'rb') as source, open(file_path, 'wb') as file_obj:
+            file_obj.write(source.read())
+        optimizer = PdfOptimizer(workers=1)
+        result = optimizer.submit(file_path).result(timeout=30)
+        optimizer.close()
+        # rewritten smaller with pikepdf installed, else left as it is
+        self.assertEqual(result.optimized_size, os.path.getsize(file_path), "reported size not the size of the file kept")
+        self.assertEqual(result.bytes_saved >= 0 and optimizer.bytes_saved == result.bytes_saved, True, "bytes saved not reported")
+
+class TestMemoryBudget(unittest.TestCase):
+    """
+    Test that cached entity data over the memory budget is evicted and reloaded transparently
+    """
+
+    rows = [{"date": "2019-10-01 00:00:00", "transaction_note": "NOTE {}".format(i)} for i in range(100)]
+
+    def setUp(self):
+        self.config = (fbc.base_url, fbc.cache_memory_budget, fbc.cache_spill_directory, cache.MIN_IDLE_SECONDS)
+        cache.MIN_IDLE_SECONDS = 0
+        fbc.cache_memory_budget = 0
+        self.directory = tempfile.TemporaryDirectory()
+        transport.clear_cache()
+
+    def tearDown(self):
+        fbc.base_url, fbc.cache_memory_budget, fbc.cache_spill_directory, cache.MIN_IDLE_SECONDS = self.config
+        self.directory.cleanup()
+        transport.clear_cache()
+
+    def test_compressed_in_memory(self):
+        with StandInServer() as server:
+            fbc.base_url = server.base_url
+            server.entities[STAND_IN_ENTITY_ID] = stand_in_entity(self.rows)
+            entity = fbc.Entity.get(STAND_IN_ENTITY_ID)
+            entity.get_transactions()
+            fbc.Entity.get(STAND_IN_ENTITY_ID).get_transactions()
+            self.assertEqual(cache.usage()["compressed_bytes"] > 0, True, "payload over budget not compressed")
+            self.assertEqual(list(entity.get_transactions()), self.rows, "evicted payload not reloaded")
+            self.assertEqual(len(server.requests), 2, "evicted payload fetched again")
+
+    def test_spill_lost(self):
+        with StandInServer() as server:
+            fbc.base_url = server.base_url
+            fbc.cache_spill_directory = self.directory.name
+            server.entities[STAND_IN_ENTITY_ID] = stand_in_entity(self.rows)
+            entity = fbc.Entity.get(STAND_IN_ENTITY_ID)
+            entity.get_transactions()
+            fbc.Entity.get(STAND_IN_ENTITY_ID).get_transactions()
+            spilled = os.listdir(self.directory.name)
+            self.assertEqual(len(spilled), 1, "payload over budget not spilled")
+            os.remove(os.path.join(self.directory.name, spilled[0]))
+            self.assertEqual(list(entity.get_transactions()), self.rows, "lost payload not fetched again")
+            self.assertEqual(len(server.requests), 3, "lost payload not fetched again")
+
+    def test_evicted_rows_released(self):
+        other_entity_id = str(uuid.uuid4())
+        with StandInServer() as server:
+            fbc.base_url = server.base_url
+            server.entities[STAND_IN_ENTITY_ID] = stand_in_entity(self.rows)
+            server.entities[other_entity_id] = stand_in_entity(self.rows)
+            entity = fbc.Entity.get(STAND_IN_ENTITY_ID)
+            row = list(entity.get_transactions())[0]
+            fbc.Entity.get(other_entity_id).get_transactions()
+            self.assertEqual(cache.usage()["evicted_entries"], 1, "payload over budget not evicted")
+            gc.collect()
+            # only the row list of the transport kept payload (or of the entity) would refer to the row
+            self.assertEqual([referrer for referrer in gc.get_referrers(row) if isinstance(referrer, list)], [], "evicted rows still referenced")
+            self.assertEqual(list(entity.get_transactions()), self.rows, "evicted payload not reloaded")
+
+class TestIdentityMatching(unittest.TestCase):
+    """
+    Test normalization, blocking and scoring of the batch identity matching
+    """
+
+    def setUp(self):
+        self.records = [
+            {"name": "Rahul Kumar Sharma", "address": "12, M.G. Rd, Pune 411001", "account_number": "001234567890"},
+            {"name": "Priya Nair", "address": "4 Church Street, Kochi", "account_number": "998877665544"},
+            {"name": "Vikram Iyer", "address": "Flat 9, Lake Road, Chennai", "account_number": None}
+        ]
+
+    def test_normalize(self):
+        self.assertEqual(matching.normalize_name("Mr. RAHUL  Kumar-Sharma"), "rahul kumar sharma", "name not normalized")
+        self.assertEqual(matching.normalize_address("12, M.G. Rd"), "12 m g road", "address not normalized")
+        self.assertEqual(matching.soundex("chaudhary"), matching.soundex("choudhury"), "phonetic keys differ")
+
+    def test_masked_account(self):
+        self.assertEqual(matching.account_score("XXXXXXXX7890", "001234567890"), 1.0, "masked account number not matched")
+        self.assertEqual(matching.account_score("XXXXXXXX7891", "001234567890"), 0.0, "different account number matched")
+        self.assertEqual(matching.account_score("XXXXXXXXXX90", "001234567890"), None, "too few visible digits compared")
+
+    def test_best_match(self):
+        identities = [
+            {"name": "SHARMA RAHUL KUMAR", "address": "12 MG Road Pune 411001", "account_number": "XXXXXXXX7890"},
+            {"name": "Vikram Iyer", "address": "Flat 9 Lake Rd Chennai"}
+        ]
+        result = matching.match_identities(identities, self.records)
+        best = result.best()
+        self.assertEqual(best[0][0], 0, "identity not matched to its record")
+        self.assertEqual(best[1][0], 2, "identity not matched to its record")
+        self.assertEqual(best[0][1] > 0.8, True, "matching identity scored low")
+
+    def test_blocking(self):
+        index = matching.RecordIndex(self.records)
+        self.assertEqual(index.candidates({"name": "Priya Nair"}), [1], "records without a shared key compared")
+        self.assertEqual(len(index.match([{"name": "Zed Quon"}])), 0, "records without a shared key compared")
+
+    @unittest.skipUnless(import_optional('numpy'), "numpy is not installed")
+    def test_numpy_parity(self):
+        np = import_optional('numpy')
+        records = self.records + [
+            {"name": "Rahul Sharma", "address": None, "account_number": "XXXXXXXX7890"},
+            {"name": "Priya Nair", "account_number": "5544"},
+            {"name": "Rahul Verma", "address": "12 MG Road Pune", "account_number": "111234567890"}
+        ]
+        identities = [
+            {"name": "SHARMA RAHUL KUMAR", "address": "12 MG Road Pune 411001", "account_number": "XXXXXXXX7890"},
+            {"name": "Priya Nair", "address": "Zq Xw", "account_number": "998877665544"},
+            {"name": "Vikram Iyer", "account_number": "XXXXXXXXXX90"},
+            {"name": "Zed Quon"},
+            None
+        ]
+        index = matching.RecordIndex(records)
+        prepared = index._prepare(identities)
+        expected = index._match_python(prepared)
+        result = index._match_numpy(np, prepared)
+        for column in matching.MatchResult.COLUMNS:
+            self.assertEqual(np.allclose(getattr(result, column), np.array(getattr(expected, column)), equal_nan=True), True,
+                "numpy {} differs from the python path".format(column))
+        self.assertEqual(len(result) > 0, True, "no pairs compared")
+
+class TestAccountIndex(unittest.TestCase):
+    """
+    Test that fetched accounts are indexed across entities
+    """
+
+    def setUp(self):
+        self.config = (fbc.base_url, fbc.account_index_path)
+        self.directory = tempfile.mkdtemp()
+        transport.clear_cache()
+
+    def tearDown(self):
+        fbc.base_url, fbc.account_index_path = self.config
+        account_index.close_all()
+        transport.clear_cache()
+
+    def test_account_key(self):
+        self.assertEqual(account_index.account_key("0012-3456 789", "sbin0001234"), "00123456789|ifsc:SBIN0001234", "account key not normalized")
+        self.assertEqual(account_index.account_key("00123456789", name="Mr. Rahul Kumar"), "00123456789|name:rahul kumar", "holder name not used")
+        self.assertEqual(account_index.account_key(None), None, "key made without account number")
+
+    def test_shared_account(self):
+        with StandInServer() as server:
+            fbc.base_url = server.base_url
+            fbc.account_index_path = os.path.join(self.directory, "accounts")
+            shared_account = {"account_id": "a", "account_number": "00123456789", "ifsc": "SBIN0001234"}
+            other_entity_id = str(uuid.uuid4())
+            server.entities[STAND_IN_ENTITY_ID] = stand_in_entity([])
+            server.entities[STAND_IN_ENTITY_ID]["accounts"] = [shared_account]
+            server.entities[other_entity_id] = stand_in_entity([])
+            server.entities[other_entity_id]["accounts"] = [dict(shared_account, account_id="b"), {"account_number": "555", "ifsc": "HDFC0000001"}]
+            list(fbc.Entity.get(STAND_IN_ENTITY_ID).get_accounts())
+            list(fbc.Entity.get(other_entity_id).get_accounts())
+            index = account_index.open_index(fbc.account_index_path)
+            self.assertEqual(index.shared_accounts(other_entity_id), {"00123456789|ifsc:SBIN0001234": [STAND_IN_ENTITY_ID]}, "shared account not found")
+            self.assertEqual(sorted(index.entities("00123456789", "SBIN0001234")), sorted([STAND_IN_ENTITY_ID, other_entity_id]), "account lookup failed")
+        # persisted across reopening
+        account_index.close_all()
+        index = account_index.open_index(fbc.account_index_path)
+        self.assertEqual(len(index.accounts(other_entity_id)), 2, "index not persisted")
+
+    def test_masked_accounts(self):
+        index = account_index.AccountIndex(os.path.join(self.directory, "masked"))
+        full, masked, other_masked = str(uuid.uuid4()), str(uuid.uuid4()), str(uuid.uuid4())
+        index.add(full, [{"account_number": "00123456789", "ifsc": "SBIN0001234"}])
+        index.add(masked, [{"account_number": "XXXXXXX6789", "ifsc": "SBIN0001234"}])
+        index.add(other_masked, [{"account_number": "XXXXXXX6789", "ifsc": "SBIN0001234"}])
+        self.assertEqual(index.shared_accounts(masked), dict(), "masked account number used as an exact key")
+        self.assertEqual(index.possible_matches(masked), {"~6789|ifsc:SBIN0001234": sorted([full, other_masked])}, "possible match not found")
+        self.assertEqual(index.possible_matches(full), {"~6789|ifsc:SBIN0001234": sorted([masked, other_masked])}, "possible match not found")
+        index.close()
+
+    def test_add_writes_small_records(self):
+        index = account_index.AccountIndex(os.path.join(self.directory, "shared"))
+        entity_ids = [str(uuid.uuid4()) for i in range(50)]
+        for entity_id in entity_ids:
+            index.add(entity_id, [{"account_number": "00123456789", "ifsc": "SBIN0001234"}])
+        self.assertEqual(sorted(index.entities("00123456789", "SBIN0001234")), sorted(entity_ids), "holders not indexed")
+        largest = max(len(index._db[key]) for key in index._db.keys())
+        self.assertEqual(largest < 200, True, "holders of an account stored in one growing record")
+        index.close()
+
+class TestPreflight(unittest.TestCase):
+    """
+    Test the local checks of statement pdf files before uploading them
+    """
+
+    def setUp(self):
+        self.base_url = fbc.base_url
+        self.directory = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        fbc.base_url = self.base_url
+        self.directory.cleanup()
+
+    def write_pdf(self, name, resources, trailer=b"<< /Size 5 /Root 1 0 R /Info 4 0 R >>"):
+        # one page pdf with the given resources and trailer dictionaries
+        body = b"%PDF-1.4\n1 0 obj << /Type /Catalog /Pages 2 0 R >> endobj\n"
+        body += b"2 0 obj << /Type /Pages /Kids [3 0 R] /Count 1 >> endobj\n"
+        body += b"3 0 obj << /Type /Page /Parent 2 0 R /Resources " + resources + b" >> endobj\n"
+        body += b"4 0 obj << /Producer (HDFC Bank Ltd) >> endobj\n"
+        offset = len(body)
+        body += b"xref\n0 1\n0000000000 65535 f \ntrailer " + trailer + b"\n"
+        body += "startxref\n{}\n%%EOF\n".format(offset).encode('ascii')
+        file_path = os.path.join(self.directory.name, name)
+        with open(file_path, 'wb') as file_obj:
+            file_obj.write(body)
+        return file_path
+
+    def test_text_layer(self):
+        report = preflight.check(self.write_pdf("text.pdf", b"<< /Font << /F1 << /Type /Font /Subtype /Type1 >> >> >>"))
+        self.assertEqual((report.error, report.text_layer, report.version), (None, True, "1.4"), "text pdf rejected")
+        self.assertEqual(report.bank_markers, ["hdfc"], "bank marker not found in the metadata")
+        # the font of an object no page uses doesn't count
+        report = preflight.validate(self.write_pdf("image.pdf", b"<< /XObject << /Im0 << /Subtype /Image >> >> >> >> endobj\n"
+            b"5 0 obj << /Font << /F1 << /Type /Font /Subtype /Type1 >> >>"))
+        self.assertEqual((report.error, report.text_layer), (None, False), "image only pdf not reported or rejected")
+        self.assertEqual(preflight.check("README.md").error, UnparsablePDFError, "non pdf file not rejected")
+        # pdf 1.5 file with its page tree in object streams
+        self.assertEqual(preflight.check("samples/test_statement_1.pdf").text_layer, True, "fonts of compressed pages not found")
+
+    def test_password(self):
+        # the sample statement is encrypted with the password finbox
+        self.assertEqual(preflight.check("samples/test_statement_2.pdf", "finbox").password_verified, True, "password not verified")
+        for password in (None, "wrongpass"):
+            report = preflight.check("samples/test_statement_2.pdf", password)
+            self.assertEqual((report.encrypted, report.error), (True, PasswordIncorrectError), "wrong password not rejected")
+
+    def test_corrupted_trailer(self):
+        fonts = b"<< /Font << /F1 << /Type /Font /Subtype /Type1 >> >> >>"
+        report = preflight.check(self.write_pdf("int.pdf", fonts, trailer=b"5"))
+        self.assertEqual(report.error, UnparsablePDFError, "pdf without a trailer dictionary not rejected")
+        report = preflight.check(self.write_pdf("root.pdf", fonts, trailer=b"<< /Root 7 /Info [1] >>"))
+        self.assertEqual((report.error, report.text_layer), (None, None), "malformed root not left unknown")
+        encryption = b"<< /Filter /Standard /V 2 /R 3 /Length /Forty /P -4 /O (owner) /U (user) >>"
+        report = preflight.check(self.write_pdf("encrypted.pdf", fonts, trailer=b"<< /Root 1 0 R /Encrypt " + encryption + b" /ID 3 >>"), "finbox")
+        self.assertEqual((report.encrypted, report.password_verified, report.error), (True, None, None), "malformed encryption not left unknown")
+
+    def test_upload_rejected_locally(self):
+        with StandInServer() as server:
+            fbc.base_url = server.base_url
+            entity = fbc.Entity.get(STAND_IN_ENTITY_ID)
+            with self.assertRaises(PasswordIncorrectError):
+                entity.upload_statement("samples/test_statement_2.pdf", "wrongpass", preflight=True)
+            self.assertEqual(server.requests, [], "rejected file uploaded")
+
+class TestProfiling(unittest.TestCase):
+    """
+    Test the profiling mode against the local stand-in server
+    """
+
+    def setUp(self):
+        self.base_url = fbc.base_url
+        self.directory = tempfile.TemporaryDirectory()
+        transport.clear_cache()
+        profiling.reset()
+
+    def tearDown(self):
+        profiling.disable()
+        profiling.reset()
+        fbc.base_url = self.base_url
+        self.directory.cleanup()
+        transport.clear_cache()
+
+    def test_report(self):
+        original = fbc.Entity.__dict__["get_transactions"]
+        with StandInServer() as server:
+            fbc.base_url = server.base_url
+            server.entities[STAND_IN_ENTITY_ID] = stand_in_entity([{"date": "2019-10-01 00:00:00"}])
+            profiling.enable()
+            fbc.Entity.get(STAND_IN_ENTITY_ID).get_transactions()
+            profiling.disable()
+        calls = dict((row["name"], row["calls"]) for row in profiling.summary())
+        self.assertEqual(calls.get("Entity.get_transactions"), 1, "Entity method not profiled")
+        self.assertEqual(calls.get("connector.get_transactions"), 1, "connector function not profiled")
+        stacks_path, summary_path = profiling.dump(self.directory.name)
+        with open(stacks_path) as stacks_file:
+            stacks = [line.rsplit(" ", 1)[0] for line in stacks_file.read().splitlines()]
+        self.assertEqual("Entity.get_transactions;connector.get_transactions" in stacks, True, "call stack not recorded")
+        self.assertEqual(fbc.Entity.__dict__["get_transactions"] is original, True, "functions not restored on disable")
+
+    def test_rate_limit_waits_not_sleep(self):
+        with StandInServer() as server:
+            server.entities[STAND_IN_ENTITY_ID] = stand_in_entity([{"date": "2019-10-01 00:00:00"}])
+            client = fbc.Client(api_key="profiled_key", base_url=server.base_url, rate_limit=5)
+            profiling.enable()
+            entity = client.Entity.get(STAND_IN_ENTITY_ID)
+            entity.link_id
+            list(entity.get_transactions())
+            profiling.disable()
+        rows = dict((row["name"], row) for row in profiling.summary())
+        self.assertEqual(rows["Transport.throttle"]["wall"] > 0.1, True, "rate limit waits not profiled")
+        self.assertEqual(rows["Entity.get_transactions"]["sleep"], 0.0, "rate limit waits counted as poll sleep")
+        self.assertEqual("sleep" in rows, False, "rate limit waits counted as poll sleep")
+
+    def test_tracemalloc_ownership(self):
+        import tracemalloc
+        profiling.enable(allocations=True)
+        profiling.disable()
+        self.assertEqual(tracemalloc.is_tracing(), False, "tracemalloc started by profiling left running")
+        tracemalloc.start()
+        try:
+            profiling.enable(allocations=True)
+            profiling.disable()
+            self.assertEqual(tracemalloc.is_tracing(), True, "tracemalloc started by the caller stopped")
+        finally:
+            tracemalloc.stop()
+
+class TestSnapshot(unittest.TestCase):
+    """
+    Test writing an entity to a snapshot file and reading it back through mmap
+    """
+
+    def setUp(self):
+        self.base_url = fbc.base_url
+        transport.clear_cache()
+
+    def tearDown(self):
+        fbc.base_url = self.base_url
+        transport.clear_cache()
+
+    def test_round_trip(self):
+        rows = [
+            {"date": "2019-10-01 00:00:00", "amount": 10.5, "transaction_note": "SALARY", "hash": "h1"},
+            {"date": "bad date", "amount": None, "transaction_note": None, "hash": "h2", "extra": {"a": [1]}},
+        ]
+        with StandInServer() as server, tempfile.TemporaryDirectory() as directory:
+            fbc.base_url = server.base_url
+            server.entities[STAND_IN_ENTITY_ID] = stand_in_entity(rows)
+            entity = fbc.Entity.get(STAND_IN_ENTITY_ID)
+            entity.get_transactions()
+            path = os.path.join(directory, "entity.snap")
+            entity.write_snapshot(path)
+            fetched = len(server.requests)
+
+            loaded = fbc.Entity.from_snapshot(path)
+            self.assertEqual(list(loaded.get_transactions()), rows, "transactions changed in snapshot")
+            self.assertEqual(list(loaded.get_accounts()), [{"account_id": "a"}], "accounts changed in snapshot")
+            self.assertEqual(list(loaded.get_transactions(from_date=datetime.date(2019, 10, 1))), rows[:1], "snapshot dates not usable")
+            self.assertEqual(len(server.requests), fetched, "snapshot backed entity fetched from API")
+
+            with open_snapshot(path) as snapshot:
+                self.assertEqual(list(snapshot.tables["transactions"].dates), [datetime.date(2019, 10, 1), None], "dates changed in snapshot")
+
+    def test_dumps_loads(self):
+        rows = [{"date": "2019-10-01 00:00:00", "amount": 10.5, "transaction_note": "SALARY"}]
+        with StandInServer() as server:
+            fbc.base_url = server.base_url
+            server.entities[STAND_IN_ENTITY_ID] = stand_in_entity(rows)
+            entity = fbc.Entity.get(STAND_IN_ENTITY_ID)
+            entity.get_transactions()
+            fetched = len(server.requests)
+
+            loaded = fbc.Entity.loads(entity.dumps())
+            self.assertEqual(loaded.entity_id, STAND_IN_ENTITY_ID, "entity_id changed in dump")
+            self.assertEqual(list(loaded.get_transactions()), rows, "transactions changed in dump")
+            unpickled = pickle.loads(pickle.dumps(entity))
+            self.assertEqual(list(unpickled.get_transactions()), rows, "transactions changed in pickle")
+            self.assertEqual(len(server.requests), fetched, "loaded entity fetched from API")
+
+            with self.assertRaises(InvalidSnapshotError):
+                fbc.Entity.loads(b"not an entity dump")
+
+    def test_concurrent_writes(self):
+        rows = [{"date": "2019-10-01 00:00:00", "amount": float(i)} for i in range(2000)]
+        with StandInServer() as server, tempfile.TemporaryDirectory() as directory:
+            fbc.base_url = server.base_url
+            server.entities[STAND_IN_ENTITY_ID] = stand_in_entity(rows)
+            entity = fbc.Entity.get(STAND_IN_ENTITY_ID)
+            entity.get_transactions()
+            path = os.path.join(directory, "entity.snap")
+            errors = []
+            def write():
+                try:
+                    entity.write_snapshot(path)
+                except Exception as e:
+                    errors.append(e)
+            threads = [threading.Thread(target=write) for i in range(8)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            self.assertEqual(errors, [], "concurrent snapshot writes failed")
+            self.assertEqual(os.listdir(directory), ["entity.snap"], "temporary snapshot files left behind")
+            self.assertEqual(list(fbc.Entity.from_snapshot(path).get_transactions()), rows, "concurrent snapshot writes mixed")
+
+class TestConcurrentGetters(unittest.TestCase):
+    """
+    Test that concurrent getters for the same entity share one fetch
+    """
+
+    def setUp(self):
+        self.base_url = fbc.base_url
+        transport.clear_cache()
+
+    def tearDown(self):
+        fbc.base_url = self.base_url
+        transport.clear_cache()
+
+    def test_single_flight(self):
+        with StandInServer() as server:
+            fbc.base_url = server.base_url
+            server.delay = 0.3
+            server.entities[STAND_IN_ENTITY_ID] = stand_in_entity([{"date": "2019-10-01 00:00:00"}])
+            entities = [fbc.Entity.get(STAND_IN_ENTITY_ID) for i in range(4)]
+            results = []
+            threads = [threading.Thread(target=lambda e: results.append(list(e.get_transactions())), args=(e,))
+                for e in entities + entities]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            self.assertEqual(len(results), 8, "concurrent getters failed")
+            self.assertEqual(len(server.requests), 1, "concurrent getters did not share the fetch")
+
+class TestBulkEntities(unittest.TestCase):
+    """
+    Test bulk creation and lookup of entities against the local stand-in server
+    """
+
+    def setUp(self):
+        self.base_url = fbc.base_url
+
+    def tearDown(self):
+        fbc.base_url = self.base_url
+
+    def test_create_many(self):
+        with StandInServer() as server:
+            fbc.base_url = server.base_url
+            entities, errors = fbc.Entity.create_many(["link_{}".format(i) for i in range(20)])
+            self.assertEqual((len(entities), errors), (20, {}), "bulk entity creation failed")
+            self.assertEqual(is_valid_uuid4(entities["link_7"].entity_id), True, "entity_id not created")
+
+    def test_get_many_partial_failure(self):
+        with StandInServer() as server:
+            fbc.base_url = server.base_url
+            server.entities[STAND_IN_ENTITY_ID] = dict(stand_in_entity([]), link_id="link")
+            entities, errors = fbc.Entity.get_many([STAND_IN_ENTITY_ID, NOT_EXISTS_ENTITY_ID, "invalid"])
+            self.assertEqual(entities[STAND_IN_ENTITY_ID].link_id, "link", "link_id not fetched")
+            self.assertIsInstance(errors[NOT_EXISTS_ENTITY_ID], EntityNotFoundError)
+            self.assertIsInstance(errors["invalid"], ValueError)
+
+    def test_duplicates_and_bounded_submission(self):
+        with StandInServer() as server:
+            fbc.base_url = server.base_url
+            server.delay = 0.05
+            unanswered = []
+            def link_ids():
+                for i in range(12):
+                    # distinct link_ids handed out so far without a response yet
+                    unanswered.append(i // 2 - len(server.requests))
+                    yield "link_{}".format(i // 2)
+            entities, errors = fbc.Entity.create_many(link_ids(), max_workers=2)
+            self.assertEqual((len(entities), errors), (6, {}), "bulk entity creation failed")
+            self.assertEqual(len(server.requests), 6, "duplicate link_ids created more than once")
+            self.assertEqual(max(unanswered) <= 2, True, "link_ids submitted beyond max_workers")
+
+class TestClient(unittest.TestCase):
+    """
+    Test isolated Client objects against the local stand-in server
+    """
+
+    def test_invalid_api_key(self):
+        with self.assertRaises(ValueError):
+            fbc.Client(api_key=None)
+
+    def test_clients_isolated(self):
+        with StandInServer() as server:
+            server.entities[STAND_IN_ENTITY_ID] = stand_in_entity([{"date": "2019-10-01 00:00:00"}])
+            first = fbc.Client(api_key="first_key", base_url=server.base_url)
+            second = fbc.Client(api_key="second_key", base_url=server.base_url)
+            first_entity = first.Entity.get(STAND_IN_ENTITY_ID)
+            second_entity = second.Entity.get(STAND_IN_ENTITY_ID)
+            self.assertIsInstance(first_entity, fbc.Entity)
+            list(first_entity.get_transactions())
+            list(second_entity.get_transactions())
+            self.assertEqual(server.api_keys, ["first_key", "second_key"], "client configuration not isolated")
+
+    def test_positional_arguments(self):
+        # the arguments added later come after the original ones
+        client = fbc.Client("positional_key", "http://127.0.0.1", "v1", 2, 10, 2, 32, 256, 5, 16)
+        self.assertEqual((client.rate_limit, client.max_concurrent_requests), (5, 16), "positional arguments moved")
+
+    def test_http2_falls_back(self):
+        # the stand-in server only speaks HTTP/1.1, and httpx may not be installed at all
+        with StandInServer() as server:
+            server.entities[STAND_IN_ENTITY_ID] = stand_in_entity([{"date": "2019-10-01 00:00:00"}])
+            client = fbc.Client(api_key="http2_key", base_url=server.base_url, http2=True)
+            transactions = list(client.Entity.get(STAND_IN_ENTITY_ID).get_transactions())
+            self.assertEqual(len(transactions), 1, "request failed without HTTP/2")
+
+class TestHTTP2Transport(unittest.TestCase):
+    """
+    Test the HTTP/2 transport and its fallbacks to the HTTP/1.1 requests session
+    """
+
+    rows = [{"date": "2019-10-01 00:00:00", "amount": 1.0}]
+
+    def setUp(self):
+        metrics.reset()
+
+    def fetch(self, server, http2):
+        server.entities[STAND_IN_ENTITY_ID] = stand_in_entity(self.rows)
+        client = fbc.Client(api_key="http2_key", base_url=server.base_url, http2=http2)
+        transactions = list(client.Entity.get(STAND_IN_ENTITY_ID).get_transactions())
+        return client, transactions
+
+    @unittest.skipIf(import_optional('httpx') and import_optional('h2'), "httpx[http2] is installed")
+    def test_without_httpx(self):
+        import requests
+        with StandInServer() as server:
+            client, transactions = self.fetch(server, True)
+        self.assertEqual(transactions, self.rows, "transactions changed without httpx")
+        self.assertIsInstance(client.transport.get_session(), requests.Session)
+        self.assertEqual(metrics.snapshot()['counters'].get('http2_unavailable'), 1, "missing httpx not counted")
+
+    @unittest.skipUnless(import_optional('httpx') and import_optional('h2'), "httpx[http2] is not installed")
+    def test_not_negotiated(self):
+        # HTTP/2 is only negotiated over TLS, the cleartext stand-in server answers in HTTP/1.1 through httpx
+        with StandInServer() as server:
+            client, transactions = self.fetch(server, True)
+        counters = metrics.snapshot()['counters']
+        self.assertEqual(transactions, self.rows, "transactions changed over httpx")
+        self.assertIsInstance(client.transport.get_session(), transport.HTTP2Session)
+        self.assertEqual(counters.get('http2_not_negotiated', 0) > 0, True, "HTTP/1.1 answers not counted")
+        self.assertEqual(counters.get('http2_fallbacks'), None, "negotiating session fallen back")
+
+    @unittest.skipUnless(import_optional('httpx') and import_optional('h2'), "httpx[http2] is not installed")
+    def test_prior_knowledge_fallback(self):
+        # the stand-in server doesn't speak HTTP/2, the session falls back to the requests session
+        with StandInServer() as server:
+            client, transactions = self.fetch(server, 'prior_knowledge')
+        self.assertEqual(transactions, self.rows, "transactions changed after falling back")
+        self.assertEqual(metrics.snapshot()['counters'].get('http2_fallbacks'), 1, "fallback not counted")
+
+    @unittest.skipUnless(import_optional('httpx') and import_optional('h2'), "httpx[http2] is not installed")
+    def test_prior_knowledge(self):
+        from benchmarks.http2_transport import HTTP2Server, payload
+        body = payload(3)
+        server = HTTP2Server(body)
+        try:
+            client = fbc.Client(api_key="http2_key", base_url="http://{}:{}".format(*server.server_address), http2='prior_knowledge')
+            responses = [connector.fetch_raw(STAND_IN_ENTITY_ID, 'transactions', client) for i in range(3)]
+        finally:
+            server.close()
+        counters = metrics.snapshot()['counters']
+        self.assertEqual(responses, [(200, body)] * 3, "HTTP/2 responses changed")
+        self.assertEqual(server.connections, 1, "HTTP/2 connection not reused")
+        self.assertEqual((counters.get('http2_fallbacks'), counters.get('http2_not_negotiated')), (None, None), "HTTP/2 not used")
+
 class TestGetEntityEdgeCases(unittest.TestCase):
     """
     Test edge cases for Entity.get function